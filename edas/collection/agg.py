@@ -1,11 +1,14 @@
-import os, time, math
+import os, time, math, threading, sys, json
 from datetime import datetime, timezone
 from collections import OrderedDict
 import numpy as np
-from netCDF4 import MFDataset, Variable
+import xarray as xa
+from netCDF4 import MFDataset, Variable, Dataset
 from typing import List, Dict, Any, Sequence, BinaryIO, TextIO, ValuesView, Optional, Tuple
 from edas.process.source import VID
 from edas.config import EdasEnv
+from edas.process.domain import Domain, AxisBounds, Axis as DomainAxis
+from edas.portal.parsers import SizeParser
 import defusedxml.ElementTree as ET
 from edas.util.logging import EDASLogger
 
@@ -92,8 +95,7 @@ class Collection:
 
     @classmethod
     def new(cls, name: str ):
-        spec_file = os.path.join( cls.baseDir, name + ".csv" )
-        return Collection(name, spec_file)
+        return EDASCollections.getCollection( name )
 
     def __init__(self, _name, _spec_file ):
         self.logger = EDASLogger.getLogger()
@@ -120,12 +122,12 @@ class Collection:
         return self.aggs.get( varName )
 
     def getAggregation( self, aggId: str ) -> "Aggregation":
-        agg_file = os.path.join( Collection.baseDir, aggId + ".ag1")
-        return Aggregation( self.name, agg_file )
+        return EDASCollections.getAggregation( self.name, aggId )
 
     def getVariableSpec( self, varName: str ):
-        agg =  self.getAggregation( self.getAggId( varName ) )
-        return agg.toXml(varName)
+        aggId = self.getAggId( varName )
+        assert aggId is not None, "Can't find aggregation for variable " + varName
+        return self.getAggregation( aggId ).toXml(varName)
 
     def getVariable( self, varName ) -> Variable:
         agg =  self.getAggregation( self.getAggId( varName ) )
@@ -152,6 +154,10 @@ class Collection:
         agg = self.getAggregation( aggId )
         return agg.periodPathList( start, end )
 
+    def indexPathList(self, aggId: str, startIndex: int, endIndex: int ) -> Tuple[List[str],int]:
+        agg = self.getAggregation( aggId )
+        return agg.indexPathList( startIndex, endIndex )
+
 class Axis:
 
    def __init__(self, *args ):
@@ -231,55 +237,446 @@ class AggProcessing:
         fileMap = [ ( os.path.join(aggDir, f), os.path.join(newDir, f) ) for f in target_files ]
         for aggFile,newFile  in fileMap: cls.changeBasePath( aggFile, newFile, pathmap )
 
+    @classmethod
+    def getZarrChunks( cls, dset: xa.Dataset, timeDim: str, layout: str ) -> Dict[str,int]:
+        # 'maps': whole grids, blocked in time.  'timeseries': spatial tiles, long in time.
+        assert layout in [ "maps", "timeseries" ], f"Unknown zarr layout '{layout}', expecting 'maps' or 'timeseries'"
+        target = SizeParser.parse( EdasEnv.get( "zarr.chunk.size", "64M" ) )
+        chunks: Dict[str,int] = {}
+        stepBytes = max( [ var.dtype.itemsize for var in dset.data_vars.values() ] )
+        for dim, size in dset.sizes.items():
+            if dim != timeDim:
+                chunks[dim] = size if layout == "maps" else int( math.ceil( size / Aggregation.maxSpatialSplits ) )
+                stepBytes *= chunks[dim]
+        if timeDim in dset.sizes: chunks[timeDim] = min( max( 1, int( target // stepBytes ) ), dset.sizes[timeDim] )
+        return chunks
+
+    @classmethod
+    def toZarr( cls, collectionName: str, aggId: str, layout: str = "maps", storePath: str = None ) -> str:
+        agg: Aggregation = EDASCollections.getAggregation( collectionName, aggId )
+        storePath = os.path.expanduser( storePath or agg.zarrStorePath or os.path.join( EdasEnv.get( "zarr.dir", os.path.join( Collection.cacheDir, "zarr" ) ), aggId + ".zarr" ) )
+        nIngested = agg.getIngestedFiles( storePath )
+        nFiles = len( agg.index )
+        if nIngested < nFiles:
+            t0 = time.time()
+            metadata = agg.buildMetadata()
+            assert metadata is not None, f"Can't build the metadata of aggregation {aggId}"
+            timeDim = metadata.timeDim
+            dset = agg.openDataset( agg.pathList()[nIngested:], list( metadata.variables.keys() ) )
+            dset.attrs.update( edas_files=nFiles, edas_last_file=agg.index.getRelPath( nFiles - 1 ) )
+            if nIngested == 0:
+                chunks = cls.getZarrChunks( dset, timeDim, layout )
+                print( f"Writing aggregation {aggId} to zarr store {storePath}: {nFiles} files, chunks = {chunks}" )
+                dset.chunk( chunks ).to_zarr( storePath, mode="w", consolidated=True )
+            else:
+                with xa.open_zarr( storePath, consolidated=True ) as store:
+                    var = next( iter( store.data_vars.values() ) )
+                    chunks = dict( zip( var.dims, var.encoding["chunks"] ) )
+                    storedSteps = store.sizes[timeDim]
+                tchunk, nSteps = chunks[timeDim], dset.sizes[timeDim]
+                head = min( ( tchunk - storedSteps % tchunk ) % tchunk or tchunk, nSteps )
+                chunks[timeDim] = tuple( [ head ] + [ tchunk ] * ( ( nSteps - head ) // tchunk ) + ( [ ( nSteps - head ) % tchunk ] if ( nSteps - head ) % tchunk else [] ) )
+                print( f"Appending {nFiles-nIngested} files of aggregation {aggId} to zarr store {storePath}" )
+                dset.chunk( chunks ).to_zarr( storePath, mode="a", append_dim=timeDim, consolidated=True )
+            print( f"Completed zarr store {storePath}: time = {time.time()-t0} sec" )
+        agg.registerZarrStore( storePath )
+        return storePath
+
+class AggIndex:
+    # Compiled sidecar for the file records ('F;' lines) of an .ag1 file: memory-mapped numpy arrays sorted by start time, rebuilt whenever the .ag1 file changes.
+
+    arrayNames = [ "start_times", "sizes", "path_offsets", "paths" ]
+
+    def __init__(self, _agg_file: str ):
+        self.logger = EDASLogger.getLogger()
+        self.spec = _agg_file
+        self.header: List[str] = []
+        self.start_times: np.ndarray = None
+        self.sizes: np.ndarray = None
+        self.path_offsets: np.ndarray = None
+        self.paths: np.ndarray = None
+        self._step_offsets: np.ndarray = None
+        if not any( [ self.load( indexDir ) for indexDir in self.getIndexDirs() ] ): self.build()
+
+    def getIndexDirs(self) -> List[str]:
+        return [ self.spec + ".idx", os.path.join( EdasEnv.TRANSIENTS_DIR, "collections", "index", os.path.basename( self.spec ) + ".idx" ) ]
+
+    @property
+    def stamp(self) -> str:
+        return "{}:{}".format( os.path.getmtime( self.spec ), os.path.getsize( self.spec ) )
+
+    def __len__(self) -> int:
+        return len( self.start_times )
+
+    @property
+    def step_offsets(self) -> np.ndarray:
+        if self._step_offsets is None: self._step_offsets = np.concatenate( [ [0], np.cumsum( self.sizes, dtype=np.int64 ) ] )
+        return self._step_offsets
+
+    def getRelPath(self, index: int ) -> str:
+        return self.paths[ self.path_offsets[index]:self.path_offsets[index+1] ].tobytes().decode()
+
+    def load(self, indexDir: str ) -> bool:
+        try:
+            with open( os.path.join( indexDir, "stamp" ), "r" ) as file:
+                if file.read().strip() != self.stamp: return False
+            with open( os.path.join( indexDir, "header.ag1" ), "r" ) as file:
+                self.header = file.readlines()
+            for name in self.arrayNames:
+                setattr( self, name, np.load( os.path.join( indexDir, name + ".npy" ), mmap_mode="r" ) )
+            self.logger.info( f"Loaded Agg index {indexDir}: {len(self)} files" )
+            return True
+        except Exception:
+            return False
+
+    def build(self):
+        assert os.path.isfile(self.spec), "Unknown Aggregation: " + os.path.basename(self.spec)
+        self.logger.info( "Building Agg index for file: " + self.spec )
+        stamp = self.stamp
+        records: Dict[str,Tuple[float,int,str]] = OrderedDict()
+        with open(self.spec, "r") as file:
+            for line in file.readlines():
+                if not line: break
+                if line[:2] == "F;":
+                    try:
+                        value = line[2:].split(";")
+                        records[ value[0].strip() ] = ( float( value[0].strip() ), int( value[1].strip() ), value[2].strip() )
+                    except Exception as err:
+                        self.logger.error( "Error parsing line: " + line )
+                        raise err
+                else: self.header.append( line )
+        sortedRecords = sorted( records.values(), key=lambda record: record[0] )
+        relpaths = [ record[2].encode() for record in sortedRecords ]
+        self.start_times = np.array( [ record[0] for record in sortedRecords ], dtype=np.float64 )
+        self.sizes = np.array( [ record[1] for record in sortedRecords ], dtype=np.int64 )
+        self.path_offsets = np.cumsum( [0] + [ len(relpath) for relpath in relpaths ], dtype=np.int64 )
+        self.paths = np.frombuffer( b"".join( relpaths ), dtype=np.uint8 )
+        for indexDir in self.getIndexDirs():
+            try: return self.save( indexDir, stamp )
+            except OSError as err: self.logger.warning( f"Can't write Agg index to {indexDir}: {err}" )
+
+    def save(self, indexDir: str, stamp: str ):
+        os.makedirs( indexDir, exist_ok=True )
+        tmpext = ".{}.tmp".format( os.getpid() )
+        for name in self.arrayNames:
+            with open( os.path.join( indexDir, name + tmpext ), "wb" ) as file: np.save( file, getattr( self, name ) )
+            os.replace( os.path.join( indexDir, name + tmpext ), os.path.join( indexDir, name + ".npy" ) )
+        for name, content in [ ( "header.ag1", "".join( self.header ) ), ( "stamp", stamp ) ]:
+            with open( os.path.join( indexDir, name + tmpext ), "w" ) as file: file.write( content )
+            os.replace( os.path.join( indexDir, name + tmpext ), os.path.join( indexDir, name ) )
+        self.logger.info( f"Saved Agg index {indexDir}: {len(self)} files" )
+
+class AggFileArray:
+    # Lazy, picklable handle on one variable of one aggregation file: the file is only opened when a block is read.
+
+    def __init__(self, path: str, varName: str, shape: Tuple[int,...], dtype: np.dtype ):
+        self.path = path
+        self.varName = varName
+        self.shape = shape
+        self.dtype = dtype
+        self.ndim = len( shape )
+
+    def __getitem__(self, key ) -> np.ndarray:
+        with xa.open_dataset( self.path, engine="netcdf4", decode_times=False, cache=False ) as dset:
+            return dset[ self.varName ].variable[ key ].values
+
+class AggMetadata:
+    # Consolidated coordinates and variable definitions of all files in an aggregation, saved with the AggIndex,
+    # so that lazy datasets over any run of files can be assembled without opening the file headers.
+    # Building it opens every file of the aggregation, so it's done at warmup or offline (see Aggregation.buildMetadata), requests only load it.
+
+    def __init__(self, agg: "Aggregation" ):
+        self.logger = EDASLogger.getLogger()
+        self.agg = agg
+        self.coords: xa.Dataset = None
+        self.variables: Dict[str,Dict[str,Any]] = {}
+        self.file_steps: np.ndarray = None
+        self.step_offsets: np.ndarray = None
+        self.timeDim: str = None
+
+    @classmethod
+    def open( cls, agg: "Aggregation", build: bool = False ) -> Optional["AggMetadata"]:
+        metadata = AggMetadata( agg )
+        if not any( [ metadata.load( indexDir ) for indexDir in agg.index.getIndexDirs() ] ):
+            if not build: return None
+            metadata.build()
+        metadata.step_offsets = np.concatenate( [ [0], np.cumsum( metadata.file_steps, dtype=np.int64 ) ] )
+        return metadata
+
+    def load(self, indexDir: str ) -> bool:
+        try:
+            with open( os.path.join( indexDir, "meta.stamp" ), "r" ) as file:
+                if file.read().strip() != self.agg.index.stamp: return False
+            with open( os.path.join( indexDir, "variables.json" ), "r" ) as file:
+                spec = json.load( file )
+            self.timeDim, self.variables = spec["timeDim"], spec["variables"]
+            self.file_steps = np.load( os.path.join( indexDir, "file_steps.npy" ) )
+            with xa.open_dataset( os.path.join( indexDir, "coords.nc" ) ) as coords: self.coords = coords.load()
+            self.logger.info( f"Loaded Agg metadata {indexDir}: {len(self.file_steps)} files" )
+            return True
+        except Exception:
+            return False
+
+    def build(self):
+        t0 = time.time()
+        stamp = self.agg.index.stamp
+        timeAxis = self.agg.getAxis("t")
+        self.timeDim = timeAxis.name if timeAxis is not None else "time"
+        timeCoords: Dict[str,List[xa.DataArray]] = OrderedDict()
+        file_steps = []
+        for path in self.agg.pathList():
+            with xa.open_dataset( path, engine="netcdf4" ) as dset:
+                if self.coords is None:
+                    self.coords = xa.Dataset( coords={ name: coord.load() for name, coord in dset.coords.items() if self.timeDim not in coord.dims }, attrs=dset.attrs )
+                    self.variables = { name: dict( dims=list(var.dims), shape=list(var.shape), dtype=str(var.dtype), attrs=var.attrs ) for name, var in dset.data_vars.items() }
+                for name, coord in dset.coords.items():
+                    if self.timeDim in coord.dims: timeCoords.setdefault( name, [] ).append( coord.load() )
+                file_steps.append( dset.sizes.get( self.timeDim, 0 ) )
+        for name, coords in timeCoords.items(): self.coords.coords[name] = xa.concat( coords, dim=self.timeDim )
+        self.file_steps = np.array( file_steps, dtype=np.int64 )
+        self.logger.info( f"Built Agg metadata for {self.agg.spec}: {len(file_steps)} files, time = {time.time()-t0} sec" )
+        for indexDir in self.agg.index.getIndexDirs():
+            try: return self.save( indexDir, stamp )
+            except OSError as err: self.logger.warning( f"Can't write Agg metadata to {indexDir}: {err}" )
+
+    def save(self, indexDir: str, stamp: str ):
+        os.makedirs( indexDir, exist_ok=True )
+        tmpext = ".{}.tmp".format( os.getpid() )
+        self.coords.to_netcdf( os.path.join( indexDir, "coords" + tmpext ) )
+        os.replace( os.path.join( indexDir, "coords" + tmpext ), os.path.join( indexDir, "coords.nc" ) )
+        with open( os.path.join( indexDir, "file_steps" + tmpext ), "wb" ) as file: np.save( file, self.file_steps )
+        os.replace( os.path.join( indexDir, "file_steps" + tmpext ), os.path.join( indexDir, "file_steps.npy" ) )
+        spec = json.dumps( dict( timeDim=self.timeDim, variables=self.variables ), default=lambda x: x.tolist() if hasattr( x, "tolist" ) else str(x) )
+        for name, content in [ ( "variables.json", spec ), ( "meta.stamp", stamp ) ]:
+            with open( os.path.join( indexDir, name + tmpext ), "w" ) as file: file.write( content )
+            os.replace( os.path.join( indexDir, name + tmpext ), os.path.join( indexDir, name ) )
+
+    def openDataset(self, paths: List[str], varNames: List[str], chunks: Dict[str,int] = None, preprocess = None ) -> xa.Dataset:
+        import dask.array as da
+        from dask.base import tokenize
+        fileIndices = [ self.agg.pathIndex[path] for path in paths ]
+        assert fileIndices == list( range( fileIndices[0], fileIndices[-1] + 1 ) ), "Agg metadata requires a contiguous run of files"
+        chunks = chunks if chunks is not None else {}
+        timeSlice = slice( int( self.step_offsets[ fileIndices[0] ] ), int( self.step_offsets[ fileIndices[-1] + 1 ] ) )
+        coords = self.coords.isel( { self.timeDim: timeSlice } ) if self.timeDim in self.coords.dims else self.coords
+        data_vars = OrderedDict()
+        for varName in varNames:
+            spec = self.variables[varName]
+            dtype = np.dtype( spec["dtype"] )
+            blocks = []
+            for ( iFile, path ) in zip( fileIndices, paths ) if self.timeDim in spec["dims"] else [ ( fileIndices[0], paths[0] ) ]:
+                shape = tuple( [ int( self.file_steps[iFile] ) if dim == self.timeDim else size for dim, size in zip( spec["dims"], spec["shape"] ) ] )
+                blockChunks = tuple( [ min( chunks.get( dim, size ), size ) if size else 1 for dim, size in zip( spec["dims"], shape ) ] )
+                name = "agg-{}-{}".format( varName, tokenize( path, varName, shape, blockChunks ) )
+                blocks.append( da.from_array( AggFileArray( path, varName, shape, dtype ), chunks=blockChunks, name=name, meta=np.empty( (0,)*len(shape), dtype=dtype ) ) )
+            data = da.concatenate( blocks, axis=spec["dims"].index( self.timeDim ) ) if len( blocks ) > 1 else blocks[0]
+            data_vars[varName] = xa.Variable( spec["dims"], data, spec["attrs"] )
+        dset = xa.Dataset( data_vars, coords=coords.coords, attrs=coords.attrs )
+        return preprocess( dset ) if preprocess is not None else dset
+
 class Aggregation:
+    maxSpatialSplits = 8
 
     def __init__(self, _name, _agg_file ):
         self.logger = EDASLogger.getLogger()
         self.name = _name
         self.spec = _agg_file
         self.parms = {}
-        self.files: Dict[str,File] = OrderedDict()
+        self._files: Optional[Dict[str,File]] = None
         self.axes: Dict[str,Axis] = {}
         self.dims = {}
         self.vars = {}
+        self.index: AggIndex = None
+        self._itemSizes: Dict[str,int] = {}
+        self._metadata: Optional[AggMetadata] = None
+        self._metadataFailure: Optional[str] = None
+        self._pathIndex: Optional[Dict[str,int]] = None
+        self._zarrState: Optional[Tuple[Tuple[str,float],int]] = None
+        self._lock = threading.RLock()
         self._parseAggFile()
 
-    def getChunkSize(self, maxFiles: int, nfiles: int ) -> Tuple[Optional[int], int]:
-        from statistics import median
-        files: List[File] = list(self.fileList())
-        fileSize = median( [ f.size for f in files ] )
-        nchunks = None
-        if nfiles > maxFiles:
-            nchunks = int( math.ceil(nfiles/float(maxFiles)) * fileSize )
-        return ( nchunks, fileSize )
+    @property
+    def metadata(self) -> Optional[AggMetadata]:
+        # Only loads saved metadata, None until buildMetadata has run for the current agg file
+        with self._lock:
+            if self._metadata is None: self._metadata = AggMetadata.open( self )
+            return self._metadata
+
+    def buildMetadata(self) -> Optional[AggMetadata]:
+        # Opens every file of the aggregation, without holding the aggregation lock. A failed build isn't retried until the agg file changes.
+        metadata = self.metadata
+        if metadata is not None: return metadata
+        stamp = self.index.stamp
+        if self._metadataFailure == stamp: return None
+        try:
+            metadata = AggMetadata.open( self, build=True )
+        except Exception as err:
+            self.logger.error( f"Error building metadata for aggregation {self.name}: {err}" )
+            self._metadataFailure = stamp
+            return None
+        with self._lock:
+            self._metadata = metadata
+        return metadata
+
+    @property
+    def pathIndex(self) -> Dict[str,int]:
+        if self._pathIndex is None: self._pathIndex = { path: iF for iF, path in enumerate( self.pathList() ) }
+        return self._pathIndex
+
+    def openDataset(self, paths: List[str], varNames: List[str], chunks: Dict[str,int] = None, preprocess = None ) -> Optional[xa.Dataset]:
+        metadata = self.metadata
+        return None if metadata is None else metadata.openDataset( paths, varNames, chunks, preprocess )
+
+    @property
+    def zarrStorePath(self) -> Optional[str]:
+        for indexDir in self.index.getIndexDirs():
+            try:
+                with open( os.path.join( indexDir, "zarr.store" ), "r" ) as file: return file.read().strip()
+            except OSError: pass
+        return None
+
+    def registerZarrStore(self, storePath: str ):
+        for indexDir in self.index.getIndexDirs():
+            try:
+                os.makedirs( indexDir, exist_ok=True )
+                with open( os.path.join( indexDir, "zarr.store" ), "w" ) as file: file.write( storePath )
+                return
+            except OSError as err: self.logger.warning( f"Can't register zarr store in {indexDir}: {err}" )
+
+    def getIngestedFiles(self, storePath: str ) -> int:
+        # Number of leading aggregation files held by the zarr store, 0 if the store is missing or doesn't match the aggregation
+        stamps = [ os.path.getmtime( os.path.join( storePath, f ) ) for f in [ ".zmetadata", "zarr.json" ] if os.path.exists( os.path.join( storePath, f ) ) ]
+        if not stamps: return 0
+        with self._lock:
+            if ( self._zarrState is None ) or ( self._zarrState[0] != ( storePath, max(stamps) ) ):
+                try:
+                    with xa.open_zarr( storePath, consolidated=True ) as store: attrs = dict( store.attrs )
+                    nFiles = int( attrs.get( "edas_files", 0 ) )
+                    valid = ( 0 < nFiles <= len( self.index ) ) and ( self.index.getRelPath( nFiles - 1 ) == attrs.get( "edas_last_file" ) )
+                except Exception as err:
+                    self.logger.warning( f"Can't read zarr store {storePath}: {err}" )
+                    valid, nFiles = False, 0
+                self._zarrState = ( ( storePath, max(stamps) ), nFiles if valid else 0 )
+            return self._zarrState[1]
+
+    def getZarrStore(self, paths: List[str] ) -> Optional[str]:
+        storePath = self.zarrStorePath
+        if storePath is None: return None
+        nIngested = self.getIngestedFiles( storePath )
+        return storePath if ( nIngested > 0 ) and all( [ self.pathIndex.get( path, nIngested ) < nIngested for path in paths ] ) else None
+
+    @property
+    def files(self) -> Dict[str,File]:
+        if self._files is None:
+            self._files = OrderedDict( [ ( str( self.index.start_times[iF] ), File( self, str( self.index.start_times[iF] ), str( self.index.sizes[iF] ), self.index.getRelPath(iF) ) ) for iF in range( len(self.index) ) ] )
+        return self._files
+
+    def getItemSize(self, varName: str ) -> int:
+        if varName not in self._itemSizes:
+            try:
+                with Dataset( self.getPath(0) ) as dset: self._itemSizes[varName] = dset.variables[varName].dtype.itemsize
+            except Exception as err:
+                self.logger.warning( f"Can't read dtype of variable {varName}, assuming float32: {err}" )
+                self._itemSizes[varName] = 4
+        return self._itemSizes[varName]
+
+    def getAxisByName(self, dimName: str ) -> Optional["Axis"]:
+        return next( ( axis for axis in self.axes.values() if axis.name == dimName ), None )
+
+    def getSubsetLength(self, length: int, bounds: Optional[AxisBounds], resolution: Optional[float], axis: Optional["Axis"] ) -> int:
+        if bounds is None: return length
+        if not bounds.isValueType: return max( 1, min( int(bounds.end) - int(bounds.start), length ) )
+        try:
+            span = abs( float(bounds.end) - float(bounds.start) )
+            if not resolution: resolution = abs( axis.bounds[1] - axis.bounds[0] ) / max( length - 1, 1 )
+            return max( 1, min( int( math.ceil( span / resolution ) ) + 1, length ) )
+        except Exception:
+            return length
+
+    def getChunkPlan(self, varNames: List[str], domain: Optional[Domain], memoryBudget: Optional[int] = None, croppedAxes: List[DomainAxis] = None ) -> Dict[str,int]:
+        # Axes in croppedAxes are windowed at open time, so they are left unsplit and only the window contributes to the chunk size
+        target = SizeParser.parse( EdasEnv.get( "mfdataset.chunk.size", "128M" ) )
+        if memoryBudget: target = min( target, memoryBudget )
+        chunks: Dict[str,int] = {}
+        for varName in varNames:
+            varRec: VarRec = self.vars.get( varName )
+            if varRec is None: continue
+            stepBytes = self.getItemSize( varName )
+            timeDim = None
+            for dim, length in zip( varRec.dims, varRec.shape ):
+                axis = self.getAxisByName( dim )
+                axisType = DomainAxis.parse( axis.type if axis is not None else dim )
+                if axisType == DomainAxis.T:
+                    timeDim = dim
+                else:
+                    bounds = domain.findAxisBounds( axisType ) if domain is not None else None
+                    subsetLength = self.getSubsetLength( length, bounds, varRec.resolution.get( axis.type if axis is not None else dim ), axis )
+                    if croppedAxes and ( axisType in croppedAxes ):
+                        chunks[dim] = length
+                        stepBytes *= subsetLength
+                    else:
+                        chunks[dim] = min( chunks.get( dim, length ), max( subsetLength, int( math.ceil( length / self.maxSpatialSplits ) ) ) )
+                        stepBytes *= chunks[dim]
+            if timeDim is not None: chunks[timeDim] = min( chunks.get( timeDim, sys.maxsize ), max( 1, int( target // stepBytes ) ), int( self.index.sizes.max() ) )
+        return chunks
 
     def _parseAggFile(self):
         assert os.path.isfile(self.spec), "Unknown Aggregation: " + os.path.basename(self.spec)
         self.logger.info( "Parsing Agg file: " + self.spec )
         try:
-            with open(self.spec, "r") as file:
-                for line in file.readlines():
-                    if not line: break
-                    if line[1] == ";":
-                        try:
-                            type = line[0]
-                            value = line[2:].split(";")
-                            if type == 'P': self.parms[ value[0].replace('"',' ').strip() ] = ";".join( value[1:] ).replace('"',' ').strip()
-                            elif type == 'A': self.axes[ value[2].strip() ] = Axis( *value )
-                            elif type == 'C': self.dims[ value[0].strip() ] = File.getNumber( value[1].strip(), True )
-                            elif type == 'V': self.vars[ value[0].strip() ] = VarRec.new( value )
-                            elif type == 'F': self.files[ value[0].strip() ] = File( self, *value )
-                        except Exception as err:
-                            self.logger.error( "Error parsing line: " + line )
-                            raise err
+            self.index = AggIndex( self.spec )
+            for line in self.index.header:
+                if not line: break
+                if line[1] == ";":
+                    try:
+                        type = line[0]
+                        value = line[2:].split(";")
+                        if type == 'P': self.parms[ value[0].replace('"',' ').strip() ] = ";".join( value[1:] ).replace('"',' ').strip()
+                        elif type == 'A': self.axes[ value[2].strip() ] = Axis( *value )
+                        elif type == 'C': self.dims[ value[0].strip() ] = File.getNumber( value[1].strip(), True )
+                        elif type == 'V': self.vars[ value[0].strip() ] = VarRec.new( value )
+                    except Exception as err:
+                        self.logger.error( "Error parsing line: " + line )
+                        raise err
         except Exception as err:
             self.logger.error(f"Parsing Agg file {self.spec}: " + repr(err) )
             raise err
-        self.logger.info( f"Completed Parsing Agg spec: {len(self.files)} files, {len(self.vars)} vars")
+        self.logger.info( f"Completed Parsing Agg spec: {len(self.index)} files, {len(self.vars)} vars")
+
+    def getVarRec(self, varName: str ) -> VarRec:
+        # Answered from the agg file records, a single representative file is opened only for a variable or axis they don't describe
+        with self._lock:
+            varRec: VarRec = self.vars.get( varName )
+            if ( varRec is None ) or any( [ self.getAxisByName( dim ) is None for dim in varRec.dims ] ):
+                self._readRepresentativeFile( varName )
+            return self.vars[varName]
+
+    def _readRepresentativeFile(self, varName: str ):
+        path = self.getPath(0)
+        self.logger.info( f"Reading metadata for variable {varName} from representative file {path}" )
+        with Dataset( path ) as dset:
+            assert varName in dset.variables, f"Unknown variable {varName} in aggregation {self.name}"
+            variable = dset.variables[varName]
+            shape = []
+            for dim in variable.dimensions:
+                axis = self.getAxisByName( dim )
+                if axis is None:
+                    coord = dset.variables.get( dim )
+                    atype = DomainAxis.parse( getattr( coord, "axis", dim ) )
+                    length = int( self.index.step_offsets[-1] ) if atype == DomainAxis.T else len( dset.dimensions[dim] )
+                    bounds = [ coord[0], coord[-1] ] if ( coord is not None ) and ( coord.size > 0 ) else [ 0, length - 1 ]
+                    axis = Axis( dim, getattr( coord, "long_name", dim ), dim if atype == DomainAxis.UNKNOWN else atype.name.lower(), str(length), getattr( coord, "units", "" ), str(bounds[0]), str(bounds[1]) )
+                    self.axes[ axis.type ] = axis
+                shape.append( axis.length )
+            if varName not in self.vars:
+                longName = getattr( variable, "long_name", varName )
+                metadata = { "shortName": varName, "longName": longName, "dodsName": varName, "description": getattr( variable, "description", longName ) }
+                self.vars[varName] = VarRec( varName, shape, {}, list( variable.dimensions ), getattr( variable, "units", "" ), metadata )
+            self._itemSizes.setdefault( varName, variable.dtype.itemsize )
 
     def toXml(self, varName: str )-> str:
         specs = []
-        specs.append( self.vars[ varName ].toXml() )
+        specs.append( self.getVarRec( varName ).toXml() )
         specs.extend( [ axis.toXml() for axis in self.axes.values() ] )
         for name, value in self.parms.items():
             xml_str = '<parm name="{}" value="{}"/>'.format(name, value)
@@ -299,34 +696,89 @@ class Aggregation:
     def fileList(self) -> ValuesView[File]:
         return self.files.values()
 
+    def getPath(self, index: int )-> str:
+        return self.parm("base.path") + "/" + self.index.getRelPath( index )
+
     def pathList(self)-> List[str]:
-        return [ file.getPath() for file in self.files.values() ]
+        return [ self.getPath(iF) for iF in range( len(self.index) ) ]
 
     def periodPathList(self, start:datetime, end:datetime  )-> List[str]:
         t0 = time.time()
-        filesView = self.files.values()
-        if len( filesView ) == 1:
-            paths: List[str] = [ file.getPath() for file in filesView ]
+        nFiles = len( self.index )
+        if nFiles == 1:
+            indices = [ 0 ]
         else:
-            paths: List[str] = []
-            prev_file = None
-            for file in filesView:
-                if file.date > end: break
-                if file.date >= start:
-                    if (len(paths) == 0) and (prev_file is not None):
-                        paths.append( prev_file.getPath() )
-                    paths.append( file.getPath() )
-                prev_file = file
-        self.logger.info(f"@PPL: extracted {len(paths)} paths from {len(self.files)}: time = {time.time()-t0} sec")
+            start_times = self.index.start_times
+            iStart = max( np.searchsorted( start_times, start.timestamp()/60.0, side="right" ) - 1, 0 )
+            iEnd = np.searchsorted( start_times, end.timestamp()/60.0, side="right" )
+            indices = range( iStart, iEnd )
+        paths: List[str] = [ self.getPath(iF) for iF in indices ]
+        self.logger.info(f"@PPL: extracted {len(paths)} paths from {nFiles}: time = {time.time()-t0} sec")
         return paths
 
+    def indexPathList(self, startIndex: int, endIndex: int )-> Tuple[List[str],int]:
+        step_offsets = self.index.step_offsets
+        nFiles = len( self.index )
+        iStart = min( max( np.searchsorted( step_offsets, startIndex, side="right" ) - 1, 0 ), nFiles - 1 )
+        iEnd = max( np.searchsorted( step_offsets[:-1], endIndex, side="left" ), iStart + 1 )
+        paths: List[str] = [ self.getPath(iF) for iF in range( iStart, iEnd ) ]
+        self.logger.info(f"@IPL: extracted {len(paths)} paths from {nFiles} for time indices [{startIndex},{endIndex}), offset = {step_offsets[iStart]}")
+        return ( paths, int( step_offsets[iStart] ) )
+
     def getVariable( self, varName: str ) -> Variable:
-        ds = self.getDataset()
+        # Metadata view of the variable from the representative (first) file, see getDataset for the full aggregation
+        ds = Dataset( self.getPath(0) )
         return ds.variables[varName]
 
     def getDataset( self ) -> MFDataset:
         return MFDataset( self.pathList() )
 
+class CollectionRegistry:
+    # Process-wide cache of parsed Collections and Aggregations, each entry invalidated when its spec file's mtime changes.
+
+    def __init__(self):
+        self.logger = EDASLogger.getLogger()
+        self._collections: Dict[str,Tuple[float,Collection]] = {}
+        self._aggregations: Dict[Tuple[str,str],Tuple[float,Aggregation]] = {}
+        self._lock = threading.RLock()
+
+    def getCollection(self, name: str ) -> Collection:
+        spec_file = os.path.join( Collection.baseDir, name + ".csv" )
+        return self._get( self._collections, name, spec_file, lambda: Collection( name, spec_file ) )
+
+    def getAggregation(self, collectionName: str, aggId: str ) -> Aggregation:
+        agg_file = os.path.join( Collection.baseDir, aggId + ".ag1" )
+        return self._get( self._aggregations, ( collectionName, aggId ), agg_file, lambda: Aggregation( collectionName, agg_file ) )
+
+    def _get(self, entries: Dict, key: Any, spec_file: str, factory ):
+        try: mtime = os.path.getmtime( os.path.expanduser( spec_file ) )
+        except OSError: return factory()
+        with self._lock:
+            entry = entries.get( key )
+            if ( entry is not None ) and ( entry[0] == mtime ): return entry[1]
+        value = factory()
+        with self._lock: entries[key] = ( mtime, value )
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._collections.clear()
+            self._aggregations.clear()
+
+    def warmup(self):
+        t0 = time.time()
+        collectionNames = [ f[0:-4] for f in os.listdir( Collection.baseDir ) if f.endswith(".csv") ] if os.path.isdir( Collection.baseDir ) else []
+        for collectionName in collectionNames:
+            try:
+                collection = self.getCollection( collectionName )
+                for aggId in set( collection.aggs.values() ):
+                    agg = self.getAggregation( collectionName, aggId )
+                    if EdasEnv.getBool( "mfdataset.metadata.cache", True ): agg.buildMetadata()
+            except Exception as err:
+                self.logger.error( f"Error loading collection {collectionName}: {err}" )
+        self.logger.info( f"Loaded {len(self._collections)} collections, {len(self._aggregations)} aggregations: time = {time.time()-t0} sec" )
+
+EDASCollections = CollectionRegistry()
 
 if __name__ == "__main__":
 # AggProcessing.changeBasePaths( "/dass/adm/edas/cache/collection/agg",
@@ -1,37 +1,481 @@
-from edas.workflow.data import EDASArray
-from typing import Dict
+from edas.workflow.data import EDASArray, EDASDataset, EDASDatasetCollection
+from edas.process.domain import Domain
+from typing import Dict, Optional, Type, List, Tuple, Any, Set
 from collections import OrderedDict
 from edas.config import EdasEnv
 from edas.portal.parsers import SizeParser
+from edas.util.logging import EDASLogger
+from urllib.parse import quote, unquote
+import xarray as xa
+import abc, threading, os, time, hashlib
 
-class CacheManager:
+class EvictionPolicy:
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self):
+        self.entries: Dict[str,int] = OrderedDict()
+
+    @abc.abstractmethod
+    def add(self, key: str, bsize: int, cost: float ): pass
+
+    @abc.abstractmethod
+    def access(self, key: str ): pass
+
+    @abc.abstractmethod
+    def victim(self) -> Optional[str]: pass
+
+    def remove(self, key: str ):
+        self.entries.pop( key, None )
+
+class LRUPolicy(EvictionPolicy):
+
+    def add(self, key: str, bsize: int, cost: float ):
+        self.entries[key] = bsize
+        self.entries.move_to_end( key )
+
+    def access(self, key: str ):
+        if key in self.entries: self.entries.move_to_end( key )
+
+    def victim(self) -> Optional[str]:
+        return next( iter(self.entries), None )
+
+class LFUPolicy(EvictionPolicy):
+
+    def __init__(self):
+        super(LFUPolicy, self).__init__()
+        self.counts: Dict[str,int] = {}
+
+    def add(self, key: str, bsize: int, cost: float ):
+        self.entries[key] = bsize
+        self.entries.move_to_end( key )
+        self.counts[key] = 1
+
+    def access(self, key: str ):
+        if key in self.counts: self.counts[key] += 1
+
+    def victim(self) -> Optional[str]:
+        # Ties are broken in favor of evicting the least recently added entry
+        return min( self.entries.keys(), key=lambda k: self.counts[k], default=None )
+
+    def remove(self, key: str ):
+        super(LFUPolicy, self).remove( key )
+        self.counts.pop( key, None )
+
+class CostAwarePolicy(EvictionPolicy):
+    # GreedyDual-Size-Frequency: evicts the entry with the lowest (hits*cost/bsize) credit, aged by the credit of the last eviction.
 
     def __init__(self):
+        super(CostAwarePolicy, self).__init__()
+        self.costs: Dict[str,float] = {}
+        self.counts: Dict[str,int] = {}
+        self.credits: Dict[str,float] = {}
+        self.inflation = 0.0
+
+    def add(self, key: str, bsize: int, cost: float ):
+        self.entries[key] = bsize
+        self.costs[key] = cost
+        self.counts[key] = 1
+        self.updateCredit( key )
+
+    def updateCredit(self, key: str ):
+        self.credits[key] = self.inflation + self.counts[key] * self.costs[key] / max( self.entries[key], 1 )
+
+    def access(self, key: str ):
+        if key in self.credits:
+            self.counts[key] += 1
+            self.updateCredit( key )
+
+    def victim(self) -> Optional[str]:
+        key = min( self.entries.keys(), key=lambda k: self.credits[k], default=None )
+        if key is not None: self.inflation = self.credits[key]
+        return key
+
+    def remove(self, key: str ):
+        super(CostAwarePolicy, self).remove( key )
+        for record in ( self.costs, self.counts, self.credits ): record.pop( key, None )
+
+class SpillStore:
+    # Second cache tier: arrays evicted from (or too big for) memory are written to netcdf under the transients dir
+    # and re-opened lazily through dask on the next access. Arrays are staged (held in memory) until their file is written,
+    # so the (slow) netcdf write can run after the cache lock is released.
+
+    def __init__(self, maxSize: int ):
+        self.logger = EDASLogger.getLogger()
+        self.directory = os.path.join( EdasEnv.TRANSIENTS_DIR, "cache", "spill" )
+        os.makedirs( self.directory, mode=0o777, exist_ok=True )
+        self.maxSize = maxSize
+        self.files: Dict[str,int] = OrderedDict()
+        self.pending: Dict[str,EDASArray] = {}
+        self.currentSize = 0
+        self._lock = threading.RLock()
+        self._scan()
+
+    def _scan(self):
+        for fname in sorted( os.listdir( self.directory ), key=lambda f: os.path.getmtime( os.path.join( self.directory, f ) ) ):
+            if fname.endswith(".nc"):
+                fsize = os.path.getsize( os.path.join( self.directory, fname ) )
+                self.files[ unquote( fname[:-3] ) ] = fsize
+                self.currentSize += fsize
+
+    def path(self, id: str ) -> str:
+        return os.path.join( self.directory, quote( id, safe="" ) + ".nc" )
+
+    def write(self, id: str, variable: EDASArray ):
+        self.stage( id, variable )
+        self.flush( id, variable )
+
+    def stage(self, id: str, variable: EDASArray ):
+        with self._lock:
+            self.remove( id )
+            self.pending[id] = variable
+
+    def flush(self, id: str, variable: EDASArray ):
+        xarray: xa.DataArray = variable.xrArray.copy( deep=False )
+        xarray.attrs["domid"] = variable.domId
+        filePath = self.path( id )
+        tmpPath = "{}.{}.tmp".format( filePath, threading.get_ident() )
+        try:
+            xarray.to_netcdf( path=tmpPath )
+            with self._lock:
+                # Skipped if the array was removed or staged again while its file was written
+                if self.pending.get( id ) is not variable: return
+                os.replace( tmpPath, filePath )
+                fsize = os.path.getsize( filePath )
+                self.files[id] = fsize
+                self.currentSize += fsize
+                self.logger.info( f"Spilled cached array {id} to {filePath}: size = {fsize}" )
+                while (self.currentSize > self.maxSize) and (len(self.files) > 1):
+                    self.remove( next( iter(self.files) ) )
+        finally:
+            with self._lock:
+                if self.pending.get( id ) is variable: del self.pending[id]
+            if os.path.exists( tmpPath ): os.remove( tmpPath )
+
+    def read(self, id: str ) -> Optional[EDASArray]:
+        with self._lock:
+            if id in self.pending: return self.pending[id]
+            if id not in self.files: return None
+            self.files.move_to_end( id )
+        xarray: xa.DataArray = xa.open_dataarray( self.path( id ), chunks={} )
+        return EDASArray( xarray.name, xarray.attrs.pop( "domid", None ), xarray )
+
+    def remove(self, id: str ):
+        with self._lock:
+            self.pending.pop( id, None )
+            fsize = self.files.pop( id, None )
+            if fsize is not None:
+                self.currentSize -= fsize
+                try: os.remove( self.path( id ) )
+                except FileNotFoundError: pass
+
+    def __contains__( self, id: str ) -> bool: return (id in self.files) or (id in self.pending)
+
+class WorkerStore:
+    # Worker-resident cache tier: arrays are persisted on the dask-distributed workers and published under a named key,
+    # so they are shared by every request and endpoint connected to the same scheduler.
+    # The names published by this store are tracked locally, so its own arrays are fetched without a dataset listing;
+    # other names are looked up on the scheduler. The CacheManager calls this store without holding its lock.
+    prefix = "edas-cache:"
+
+    def __init__(self):
+        self.logger = EDASLogger.getLogger()
+        self.published: Set[str] = set()
+
+    @staticmethod
+    def getClient():
+        try:
+            from dask.distributed import default_client
+            return default_client()
+        except (ImportError, ValueError):
+            return None
+
+    def put(self, id: str, variable: EDASArray ) -> EDASArray:
+        client = self.getClient()
+        if client is None: return variable
+        xarray: xa.DataArray = variable.xrArray.copy( deep=False )
+        xarray.attrs["domid"] = variable.domId
+        xarray = client.persist( xarray )
+        client.publish_dataset( override=True, **{ self.prefix + id: xarray } )
+        self.published.add( id )
+        self.logger.info( f"Published cached array {id} on workers" )
+        return EDASArray( variable.name, variable.domId, xarray )
+
+    def get(self, id: str ) -> Optional[EDASArray]:
+        client = self.getClient()
+        if client is None: return None
+        name = self.prefix + id
+        if ( id not in self.published ) and ( name not in client.list_datasets() ): return None
+        try: xarray: xa.DataArray = client.get_dataset( name )
+        except KeyError:
+            self.published.discard( id )
+            return None
+        return EDASArray( xarray.name, xarray.attrs.get( "domid" ), xarray )
+
+    def remove(self, id: str ):
+        # Only arrays published by this store are released, those of other endpoints are left to them
+        if id not in self.published: return
+        self.published.discard( id )
+        client = self.getClient()
+        if client is None: return
+        try:
+            client.unpublish_dataset( self.prefix + id )
+            self.logger.info( f"Released cached array {id} from workers" )
+        except KeyError: pass
+
+class CacheManager:
+    policies: Dict[str,Type[EvictionPolicy]] = { "lru": LRUPolicy, "lfu": LFUPolicy, "cost": CostAwarePolicy }
+
+    def __init__(self, policy: str = None, maxSize: str = None ):
+        self.logger = EDASLogger.getLogger()
         self.arrayCache: Dict[str,EDASArray] = OrderedDict()
-        self.maxSize = SizeParser.parse(EdasEnv.get("cache.size.max", "500M"))
+        self.sizes: Dict[str,int] = {}
+        self.maxSize = SizeParser.parse( maxSize if maxSize else EdasEnv.get("cache.size.max", "500M") )
+        self.policy: EvictionPolicy = self.getPolicy( policy if policy else EdasEnv.get("cache.policy", "lru") )
         self.currentSize = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.spillHits = 0
+        self.workers: Optional[WorkerStore] = WorkerStore() if EdasEnv.getBool( "cache.distributed", False ) else None
+        self.spill: Optional[SpillStore] = SpillStore( SizeParser.parse( EdasEnv.get("cache.spill.size.max", "50G") ) ) if EdasEnv.getBool( "cache.spill", True ) else None
+        self._lock = threading.RLock()
 
-    def cache(self, id: str, variable: EDASArray ):
-        assert id not in self.arrayCache,  "Error: id {} already exists in cache".format( id )
+    @classmethod
+    def getPolicy(cls, name: str ) -> EvictionPolicy:
+        policy_class = cls.policies.get( name.lower().strip() )
+        assert policy_class is not None, f"Unknown cache eviction policy '{name}', available policies: {list(cls.policies.keys())}"
+        return policy_class()
+
+    def cache(self, id: str, variable: EDASArray, cost: float = None ):
         input_size = variable.bsize
-        assert input_size <= self.maxSize, "Error: array {} is too big for cache".format( id )
-        self.clearSpace( input_size )
-        self.arrayCache[id] = variable
-        self.currentSize += input_size
+        if input_size > self.maxSize:
+            assert self.spill is not None, "Error: array {} is too big for cache".format( id )
+            with self._lock:
+                if id in self.arrayCache: self.remove( id )
+                self.spill.stage( id, variable )
+            self.releaseEvicted( [ ( id, variable ) ] )
+            return
+        if self.workers is not None: variable = self.workers.put( id, variable )
+        with self._lock:
+            if id in self.arrayCache: self.remove( id )
+            if self.spill is not None: self.spill.remove( id )
+            evicted = self.clearSpace( input_size )
+            self.admit( id, variable, input_size, cost )
+        self.releaseEvicted( evicted )
+        self.logger.info( f"Cached array {id}: size = {input_size}, cache usage = {self.currentSize}/{self.maxSize}" )
+
+    def admit(self, id: str, variable: EDASArray, input_size: int, cost: float = None ):
+        with self._lock:
+            self.arrayCache[id] = variable
+            self.sizes[id] = input_size
+            self.policy.add( id, input_size, float(input_size) if cost is None else cost )
+            self.currentSize += input_size
+
+    def clearSpace( self, bsize: int ) -> List[Tuple[str,EDASArray]]:
+        evicted: List[Tuple[str,EDASArray]] = []
+        with self._lock:
+            while self.currentSize + bsize > self.maxSize:
+                key = self.policy.victim()
+                if key is None: break
+                evicted.append( ( key, self.evict( key ) ) )
+        return evicted
+
+    def evict(self, key: str ) -> EDASArray:
+        self.logger.info( f"Evicting array {key} from cache" )
+        self.evictions += 1
+        value = self.remove( key )
+        if self.spill is not None: self.spill.stage( key, value )
+        return value
+
+    def releaseEvicted(self, evicted: List[Tuple[str,EDASArray]] ):
+        # Called without holding the cache lock: the staged arrays are still served from memory until their files are written
+        for key, value in evicted:
+            if self.workers is not None: self.workers.remove( key )
+            if self.spill is None: continue
+            try: self.spill.flush( key, value )
+            except Exception as err: self.logger.error( f"Error spilling cached array {key} to disk: {err}" )
 
-    def clearSpace( self, bsize: int ):
-        if self.currentSize + bsize > self.maxSize:
-            for key, value in self.arrayCache.items():
-               del self[key]
-               if self.currentSize + bsize < self.maxSize:  break
+    def remove(self, key: str ) -> EDASArray:
+        with self._lock:
+            value = self.arrayCache.pop( key )
+            self.currentSize -= self.sizes.pop( key )
+            self.policy.remove( key )
+            return value
 
+    def get(self, key: str ) -> Optional[EDASArray]:
+        evicted: List[Tuple[str,EDASArray]] = []
+        with self._lock:
+            value = self.arrayCache.get( key, None )
+        if (value is None) and (self.workers is not None):
+            value = self.workers.get( key )
+            if value is not None:
+                input_size = value.bsize
+                with self._lock:
+                    if (key not in self.arrayCache) and (input_size <= self.maxSize):
+                        evicted = self.clearSpace( input_size )
+                        self.admit( key, value, input_size )
+        with self._lock:
+            if value is None:
+                value = self.spill.read( key ) if self.spill is not None else None
+                if value is None: self.misses += 1
+                else:             self.spillHits += 1
+            else:
+                self.hits += 1
+                if key in self.arrayCache: self.policy.access( key )
+        self.releaseEvicted( evicted )
+        return value
 
-    def __getitem__( self, key: str ) -> EDASArray: return self.arrayCache.get( key, None )
+    @property
+    def stats(self) -> Dict[str,int]:
+        stats = dict( hits=self.hits, misses=self.misses, evictions=self.evictions, entries=len(self.arrayCache), size=self.currentSize, maxSize=self.maxSize )
+        if self.spill is not None: stats.update( spillHits=self.spillHits, spillEntries=len(self.spill.files), spillSize=self.spill.currentSize )
+        return stats
+
+    def __contains__( self, key: str ) -> bool: return (key in self.arrayCache) or ( (self.spill is not None) and (key in self.spill) )
+    def __len__( self ) -> int: return len( self.arrayCache )
+    def __getitem__( self, key: str ) -> Optional[EDASArray]: return self.get( key )
     def __setitem__( self, key: str, value: EDASArray ): self.cache( key, value )
 
-    def __delitem__( self, key ):
-        value = self.arrayCache[key]
-        del self.arrayCache[key]
-        self.currentSize = self.currentSize - value.bsize
+    def __delitem__( self, key: str ):
+        with self._lock:
+            if key in self.arrayCache: self.remove( key )
+            if self.spill is not None: self.spill.remove( key )
+        if self.workers is not None: self.workers.remove( key )
+
+class ResultCache:
+    # Memoizes completed workflow results across requests, keyed by the canonical fingerprint of the workflow subtree.
+    # Only materialized results (result nodes and branches persisted by the request plan) are admitted, charged their persisted size:
+    # a lazy result would only be recomputed on a hit.
+
+    def __init__(self):
+        self.logger = EDASLogger.getLogger()
+        self.enabled = EdasEnv.getBool( "cache.results", True )
+        self.maxSize = SizeParser.parse( EdasEnv.get("cache.results.size.max", "1G") )
+        self.ttl = float( EdasEnv.get("cache.results.ttl", 3600) )
+        self.entries: Dict[str,Tuple[EDASDatasetCollection,List[str],float,int]] = OrderedDict()
+        self.currentSize = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def getSize( results: EDASDatasetCollection ) -> int:
+        return sum( [ array.persistedSize for array in results.arrays ] )
+
+    @staticmethod
+    def isMaterialized( results: EDASDatasetCollection ) -> bool:
+        arrays = results.arrays
+        return ( len( arrays ) > 0 ) and all( [ array.persisted for array in arrays ] )
+
+    @staticmethod
+    def detach( dset: EDASDataset ) -> EDASDataset:
+        # New EDASArray wrappers over the same (persisted) data, so that a request releasing its arrays doesn't release the cached data
+        return EDASDataset( OrderedDict( [ ( id, EDASArray( array.name, array.domId, array.xr ) ) for id, array in dset.arrayMap.items() ] ), dict( dset.attrs ) )
+
+    def cache(self, key: Optional[str], outputs: List[str], results: EDASDatasetCollection ):
+        if not self.enabled or key is None or not self.isMaterialized( results ): return
+        bsize = self.getSize( results )
+        if bsize > self.maxSize: return
+        results = EDASDatasetCollection( "ResultCache-" + key[:8], OrderedDict( [ ( dsid, self.detach( dset ) ) for dsid, dset in results.items() ] ) )
+        with self._lock:
+            self.remove( key )
+            while (self.currentSize + bsize > self.maxSize) and len(self.entries):
+                self.remove( next( iter(self.entries) ) )
+            self.entries[key] = ( results, outputs, time.time(), bsize )
+            self.currentSize += bsize
+
+    def get(self, key: Optional[str], outputs: List[str] ) -> Optional[EDASDatasetCollection]:
+        if not self.enabled or key is None: return None
+        with self._lock:
+            entry = self.entries.get( key )
+            if (entry is not None) and ( time.time() - entry[2] > self.ttl ):
+                self.remove( key )
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end( key )
+        ( results, cached_outputs, timestamp, bsize ) = entry
+        keyMap = dict( zip( cached_outputs, outputs ) )
+        self.logger.info( f"Result cache hit for workflow {key}: {results.arrayIds}" )
+        return EDASDatasetCollection( "ResultCache-" + key[:8], OrderedDict( [ ( keyMap.get( dsid, dsid ), self.detach( dset ) ) for dsid, dset in results.items() ] ) )
+
+    def remove(self, key: str ):
+        with self._lock:
+            entry = self.entries.pop( key, None )
+            if entry is not None: self.currentSize -= entry[3]
+
+    @property
+    def stats(self) -> Dict[str,int]:
+        return dict( hits=self.hits, misses=self.misses, entries=len(self.entries), size=self.currentSize, maxSize=self.maxSize )
+
+class RegionCache:
+    # Indexes input ROIs held in the array cache so that requests for a contained sub-region can be served by slicing the cached superset.
+    # Regions are persisted before they are admitted, so they are charged their materialized size and a hit doesn't re-read the source.
+    # The array cache is never called while the region index lock is held.
+
+    def __init__(self, cacheMgr: CacheManager ):
+        self.logger = EDASLogger.getLogger()
+        self.enabled = EdasEnv.getBool( "cache.regions", True )
+        self.cacheMgr = cacheMgr
+        self.regions: Dict[str,List[Tuple[Domain,Dict[str,str],Dict[str,Any],int]]] = {}
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def getCacheId( sourceKey: str, domain: Domain, name: str ) -> str:
+        return "roi:" + hashlib.sha1( "|".join( [ sourceKey, domain.signature, name ] ).encode() ).hexdigest()
+
+    def cache(self, sourceKey: str, domain: Domain, arrays: Dict[str,EDASArray], attrs: Dict[str,Any] ):
+        if not self.enabled: return
+        bsize = sum( [ array.bsize for array in arrays.values() ] )
+        if bsize > self.cacheMgr.maxSize: return
+        persisted = { name: EDASArray( array.name, array.domId, array.persist().copy( deep=False ) ) for name, array in arrays.items() }
+        with self._lock:
+            stale = [ entry for entry in self.regions.get( sourceKey, [] ) if domain.contains( entry[0] ) ]
+            for entry in stale: self.unindex( sourceKey, entry )
+        for entry in stale: self.release( entry )
+        cacheIds: Dict[str,str] = {}
+        for name, array in persisted.items():
+            cacheIds[name] = self.getCacheId( sourceKey, domain, name )
+            self.cacheMgr.cache( cacheIds[name], array )
+        with self._lock:
+            self.regions.setdefault( sourceKey, [] ).append( ( domain, cacheIds, dict(attrs), bsize ) )
+        self.logger.info( f"Cached region {domain.signature} for source {sourceKey}" )
+
+    def find(self, sourceKey: str, domain: Domain ) -> Optional[Tuple[Domain,Dict[str,EDASArray],Dict[str,Any]]]:
+        if not self.enabled: return None
+        with self._lock:
+            candidates = sorted( [ entry for entry in self.regions.get( sourceKey, [] ) if entry[0].contains( domain ) ], key=lambda entry: entry[3] )
+        for entry in candidates:
+            arrays = { name: self.cacheMgr.get( cacheId ) for name, cacheId in entry[1].items() }
+            if None in arrays.values():
+                self.remove( sourceKey, entry )
+            else:
+                with self._lock: self.hits += 1
+                self.logger.info( f"Region cache hit: serving {domain.signature} from cached region {entry[0].signature}" )
+                return ( entry[0], arrays, entry[2] )
+        with self._lock: self.misses += 1
+        return None
+
+    def unindex(self, sourceKey: str, entry: Tuple[Domain,Dict[str,str],Dict[str,Any],int] ):
+        with self._lock:
+            entries = self.regions.get( sourceKey, [] )
+            if entry in entries: entries.remove( entry )
+
+    def release(self, entry: Tuple[Domain,Dict[str,str],Dict[str,Any],int] ):
+        for cacheId in entry[1].values(): del self.cacheMgr[ cacheId ]
+
+    def remove(self, sourceKey: str, entry: Tuple[Domain,Dict[str,str],Dict[str,Any],int] ):
+        self.unindex( sourceKey, entry )
+        self.release( entry )
+
+    @property
+    def stats(self) -> Dict[str,int]:
+        return dict( hits=self.hits, misses=self.misses, entries=sum( [ len(entries) for entries in self.regions.values() ] ) )
 
 EDASKCacheMgr = CacheManager()
+EDASResultCache = ResultCache()
+EDASRegionCache = RegionCache( EDASKCacheMgr )
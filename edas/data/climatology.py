@@ -0,0 +1,137 @@
+from typing import Dict, List, Optional, Tuple
+from collections import OrderedDict
+from edas.config import EdasEnv
+from edas.portal.parsers import SizeParser
+from edas.util.logging import EDASLogger
+from edas.data.reduction import GroupReduction
+from dask.base import tokenize
+import xarray as xa
+import numpy as np
+import threading, hashlib, string
+
+class Climatology:
+    # Per-period (e.g. month or day of year) mean and std of an array along its time dim, over an optional base period.
+    # Both statistics come from one grouped moment reduction. Anomalies are computed block-wise, by indexing the climatology
+    # with the period code of every time step, so the subtraction streams with the data instead of going through groupby arithmetic.
+
+    Statistics = [ "mean", "std" ]
+
+    def __init__(self, dim: str, period: str, statistics: Dict[str,xa.DataArray] ):
+        self.dim = dim
+        self.period = period
+        self.statistics = statistics
+
+    @staticmethod
+    def parseGrouping( grouping: str ) -> Tuple[str,str]:
+        toks = grouping.split(".")
+        assert len( toks ) == 2, f"Unrecognised groupby parameter '{grouping}', expected <dim>.<period>, e.g. 't.month'"
+        return toks[0], toks[1]
+
+    @staticmethod
+    def parseBaseline( baseline: Optional[str] ) -> Optional[slice]:
+        if not baseline: return None
+        toks = [ tok.strip() for tok in str(baseline).split(",") ]
+        assert len( toks ) == 2, f"Unrecognised baseline parameter '{baseline}', expected <start>,<end>, e.g. '1981-01-01,2010-12-31'"
+        return slice( toks[0] or None, toks[1] or None )
+
+    @classmethod
+    def compute( cls, xarray: xa.DataArray, grouping: str, baseline: Optional[str] = None ) -> "Climatology":
+        dim, period = cls.parseGrouping( grouping )
+        base = cls.parseBaseline( baseline )
+        baseData = xarray if base is None else xarray.sel( { dim: base } )
+        assert baseData.sizes[dim] > 0, f"Baseline {baseline} doesn't overlap the time range of the input {xarray.name}"
+        return Climatology( dim, period, GroupReduction.groupby( baseData, dim, period ).reduce( cls.Statistics ) )
+
+    @property
+    def bsize(self) -> int: return sum( [ stat.nbytes for stat in self.statistics.values() ] )
+
+    def load(self) -> "Climatology":
+        return Climatology( self.dim, self.period, { op: stat.load() for op, stat in self.statistics.items() } )
+
+    def getCodes( self, xarray: xa.DataArray ) -> np.ndarray:
+        labels = self.statistics["mean"][self.period].values
+        values = getattr( xarray[self.dim].dt, self.period ).values
+        codes = np.minimum( np.searchsorted( labels, values ), len(labels) - 1 )
+        missing = np.unique( values[ labels[codes] != values ] )
+        assert len( missing ) == 0, f"The climatology base period doesn't cover {len(missing)} {self.period} values of the input {xarray.name}, e.g. {missing[:8].tolist()}"
+        return codes
+
+    def anomalies( self, xarray: xa.DataArray, norm: bool = False ) -> xa.DataArray:
+        axis = xarray.get_axis_num( self.dim )
+        codes = self.getCodes( xarray )
+        stats = [ self.statistics[op].transpose( *[ self.period if d == self.dim else d for d in xarray.dims ] ).data for op in ( self.Statistics if norm else [ "mean" ] ) ]
+        resultType = np.result_type( xarray.dtype, stats[0].dtype )
+        data = xarray.data
+        if not hasattr( data, "dask" ):
+            result = self.blockAnomalies( np.asarray( data ), codes, *[ np.asarray( stat ) for stat in stats ], axis=axis )
+        else:
+            import dask.array as da
+            index = string.ascii_letters[ :xarray.ndim ]
+            statIndex = index.replace( index[axis], "Z" )
+            statChunks = tuple( [ -1 if iAx == axis else c for iAx, c in enumerate( data.chunks ) ] )
+            statArgs = [ arg for stat in stats for arg in ( da.asarray( stat ).rechunk( statChunks ), statIndex ) ]
+            result = da.blockwise( self.blockAnomalies, index, data, index, da.from_array( codes, chunks=( data.chunks[axis], ) ), index[axis], *statArgs, axis=axis, dtype=resultType, concatenate=True )
+        return xa.DataArray( result, coords=xarray.coords, dims=xarray.dims, name=xarray.name, attrs=xarray.attrs )
+
+    @staticmethod
+    def blockAnomalies( block: np.ndarray, codes: np.ndarray, mean: np.ndarray, std: Optional[np.ndarray] = None, axis: int = 0 ) -> np.ndarray:
+        anomalies = block - np.take( mean, codes, axis=axis )
+        if std is not None: anomalies = anomalies / np.take( std, codes, axis=axis )
+        return anomalies
+
+class ClimatologyCache:
+    # Memoizes climatologies across requests, keyed by the fingerprints of the input (source, version and domain), the variable,
+    # the grouping and the base period, so repeated decycle requests on the same variable don't recompute the baseline.
+    # Cached climatologies are loaded in memory (they are small: one step per period), least recently used ones are removed first.
+
+    def __init__(self):
+        self.logger = EDASLogger.getLogger()
+        self.enabled = EdasEnv.getBool( "climatology.cache", True )
+        self.maxSize = SizeParser.parse( EdasEnv.get( "climatology.cache.size.max", "200M" ) )
+        self.entries: Dict[str,Climatology] = OrderedDict()
+        self.currentSize = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def getKey( inputFingerprints: List[Optional[str]], xarray: xa.DataArray, grouping: str, baseline: Optional[str] ) -> Optional[str]:
+        # The input fingerprints don't cover the subset taken by the op's own domain, so the key includes a token of the subset coordinates
+        if not len( inputFingerprints ) or ( None in inputFingerprints ): return None
+        coordsToken = tokenize( [ ( dim, xarray[dim].values ) for dim in xarray.dims if dim in xarray.coords ] )
+        return hashlib.sha1( "|".join( sorted( inputFingerprints ) + [ str(xarray.name), coordsToken, grouping, str(baseline) ] ).encode() ).hexdigest()
+
+    def getClimatology( self, key: Optional[str], xarray: xa.DataArray, grouping: str, baseline: Optional[str] = None ) -> Climatology:
+        if not self.enabled or key is None: return Climatology.compute( xarray, grouping, baseline )
+        with self._lock:
+            climatology = self.entries.get( key )
+            if climatology is not None:
+                self.hits += 1
+                self.entries.move_to_end( key )
+                self.logger.info( f"Climatology cache hit for {xarray.name}, grouping = {grouping}, baseline = {baseline}" )
+                return climatology
+            self.misses += 1
+        climatology = Climatology.compute( xarray, grouping, baseline ).load()
+        self.cache( key, climatology )
+        return climatology
+
+    def cache(self, key: str, climatology: Climatology ):
+        bsize = climatology.bsize
+        if bsize > self.maxSize: return
+        with self._lock:
+            self.remove( key )
+            while (self.currentSize + bsize > self.maxSize) and len(self.entries):
+                self.remove( next( iter(self.entries) ) )
+            self.entries[key] = climatology
+            self.currentSize += bsize
+
+    def remove(self, key: str ):
+        with self._lock:
+            climatology = self.entries.pop( key, None )
+            if climatology is not None: self.currentSize -= climatology.bsize
+
+    @property
+    def stats(self) -> Dict[str,int]:
+        return dict( hits=self.hits, misses=self.misses, entries=len(self.entries), size=self.currentSize, maxSize=self.maxSize )
+
+EDASClimatologies = ClimatologyCache()
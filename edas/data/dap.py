@@ -0,0 +1,224 @@
+from typing import Dict, Optional, Tuple, Any
+from collections import OrderedDict
+from urllib.parse import urlparse
+from edas.config import EdasEnv
+from edas.portal.parsers import SizeParser
+from edas.util.logging import EDASLogger
+from requests import Session
+import xarray as xa
+import numpy as np
+import threading, time, os, hashlib
+
+class DapBlockCache:
+    # Read-through disk cache of remote hyperslabs, keyed by (url, variable, hyperslab), saved as .npy files under the transients dir.
+    # The directory is shared by the worker processes: when a process sees the cache exceed 'dap.cache.size.max', it rebuilds the
+    # index from the directory and removes the least recently used blocks of all processes (reads touch the file mtime).
+
+    def __init__(self):
+        self.logger = EDASLogger.getLogger()
+        self.enabled = EdasEnv.getBool( "dap.cache", True )
+        self.maxSize = SizeParser.parse( EdasEnv.get( "dap.cache.size.max", "10G" ) )
+        self.directory = os.path.join( EdasEnv.TRANSIENTS_DIR, "cache", "dap" )
+        self.files: Dict[str,int] = OrderedDict()
+        self.currentSize = 0
+        self._lock = threading.RLock()
+        if self.enabled: self._scan()
+
+    def _scan(self):
+        os.makedirs( self.directory, mode=0o777, exist_ok=True )
+        entries = []
+        for fname in os.listdir( self.directory ):
+            if fname.endswith(".npy"):
+                try:
+                    stat = os.stat( os.path.join( self.directory, fname ) )
+                    entries.append( ( stat.st_mtime, fname[:-4], stat.st_size ) )
+                except FileNotFoundError: pass
+        with self._lock:
+            self.files = OrderedDict( [ ( id, fsize ) for ( mtime, id, fsize ) in sorted( entries ) ] )
+            self.currentSize = sum( self.files.values() )
+
+    @staticmethod
+    def getKey( address: str, varName: str, key: Tuple[slice,...], shape: Tuple[int,...] ) -> str:
+        hyperslab = [ s.indices( size ) if isinstance( s, slice ) else int(s) for s, size in zip( key, shape ) ]
+        return hashlib.sha1( "|".join( [ address, varName, str(hyperslab) ] ).encode() ).hexdigest()
+
+    def path(self, id: str ) -> str:
+        return os.path.join( self.directory, id + ".npy" )
+
+    def get(self, id: str ) -> Optional[np.ndarray]:
+        # Looked up on disk, so that blocks written by the other processes are found
+        try:
+            data = np.load( self.path( id ) )
+            os.utime( self.path( id ) )
+        except OSError:
+            self.remove( id )
+            return None
+        with self._lock:
+            if id in self.files: self.files.move_to_end( id )
+        return data
+
+    def put(self, id: str, data: np.ndarray ):
+        tmpPath = self.path( id ) + ".{}.{}.tmp".format( os.getpid(), threading.get_ident() )
+        try:
+            with open( tmpPath, "wb" ) as file: np.save( file, data )
+            os.replace( tmpPath, self.path( id ) )
+            fsize = os.path.getsize( self.path( id ) )
+        except OSError as err:
+            self.logger.warning( f"Can't write DAP block cache file {self.path( id )}: {err}" )
+            return
+        with self._lock:
+            self.currentSize += fsize - self.files.pop( id, 0 )
+            self.files[id] = fsize
+            if self.currentSize <= self.maxSize: return
+        self._scan()
+        with self._lock:
+            while (self.currentSize > self.maxSize) and (len(self.files) > 1):
+                self.remove( next( iter(self.files) ) )
+
+    def remove(self, id: str ):
+        with self._lock:
+            fsize = self.files.pop( id, None )
+            if fsize is not None:
+                self.currentSize -= fsize
+                try: os.remove( self.path( id ) )
+                except FileNotFoundError: pass
+
+class DapSessionPool:
+    # Per-process pool of authenticated requests sessions, one per (trusted server, auth) pair, shared by all requests to that server.
+    # Hyperslab reads through the pool are limited to 'dap.connections.max' concurrent requests per server and retried with exponential backoff.
+
+    def __init__(self):
+        self.logger = EDASLogger.getLogger()
+        self.sessions: Dict[Tuple[str,Optional[str]],Session] = {}
+        self.datasets: Dict[Tuple[str,Optional[str]],Any] = OrderedDict()
+        self.semaphores: Dict[str,threading.BoundedSemaphore] = {}
+        self.blockCache = DapBlockCache()
+        self.keyLocks: Dict[Tuple,threading.Lock] = {}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def getServer( address: str ) -> str:
+        for trusted_server in [ r.strip() for r in EdasEnv.get( "trusted.dap.servers", "" ).split(",") if r.strip() ]:
+            if trusted_server in address: return trusted_server
+        url = urlparse( address )
+        return f"{url.scheme}://{url.netloc}"
+
+    def getKeyLock( self, key: Tuple ) -> threading.Lock:
+        # Serializes the opening of one session or dataset, the network I/O is done outside of the pool lock so that other servers aren't blocked
+        with self._lock:
+            return self.keyLocks.setdefault( key, threading.Lock() )
+
+    def getSession( self, address: str, auth: Optional[str] ) -> Session:
+        key = ( self.getServer( address ), auth )
+        with self.getKeyLock( ( "session", ) + key ):
+            session = self.sessions.get( key )
+            if session is None:
+                session = self.newSession( address, auth )
+                with self._lock: self.sessions[key] = session
+                self.logger.info( f"Opened DAP session for server {key[0]}, auth = {auth}" )
+            return session
+
+    def newSession( self, address: str, auth: Optional[str] ) -> Session:
+        from requests.adapters import HTTPAdapter
+        if auth == "esgf":
+            from pydap.cas.esgf import setup_session
+            openid = EdasEnv.get("esgf.openid", "")
+            password = EdasEnv.get("esgf.password", "")
+            username = EdasEnv.get("esgf.username", openid.split("/")[-1])
+            session = setup_session( openid, password, username, check_url=address )
+        elif auth == "urs":
+            from pydap.cas.urs import setup_session
+            username = EdasEnv.get("urs.username", "")
+            password = EdasEnv.get("urs.password", "")
+            session = setup_session( username, password, check_url=address )
+        elif auth == "cookie":
+            from pydap.cas.get_cookies import setup_session
+            username = EdasEnv.get("auth.username", "")
+            password = EdasEnv.get("auth.password", "")
+            auth_url = EdasEnv.get("auth.url", "")
+            session = setup_session( auth_url, username, password )
+        elif auth is not None:
+            raise Exception( "Unknown authentication method: " + auth )
+        else:
+            session = Session()
+        maxConnections = int( EdasEnv.get( "dap.connections.max", "8" ) )
+        adapter = HTTPAdapter( pool_connections=1, pool_maxsize=maxConnections )
+        for prefix in [ "http://", "https://" ]: session.mount( prefix, adapter )
+        return session
+
+    def getSemaphore( self, address: str ) -> threading.BoundedSemaphore:
+        server = self.getServer( address )
+        with self._lock:
+            return self.semaphores.setdefault( server, threading.BoundedSemaphore( int( EdasEnv.get( "dap.connections.max", "8" ) ) ) )
+
+    def getDataset( self, address: str, auth: Optional[str] ):
+        # Remote dataset structure (DDS/DAS), fetched once per process through the pooled session
+        from pydap.client import open_url
+        key = ( address, auth )
+        with self.getKeyLock( ( "dataset", ) + key ):
+            dataset = self.datasets.get( key )
+            if dataset is None:
+                session = self.getSession( address, auth )
+                dataset = self.retry( address, lambda: open_url( address, session=session, timeout=float( EdasEnv.get( "dap.timeout", "120" ) ) ) )
+                with self._lock: self.datasets[key] = dataset
+            return dataset
+
+    def retry( self, address: str, request ):
+        retries = int( EdasEnv.get( "dap.retries", "3" ) )
+        backoff = float( EdasEnv.get( "dap.retry.backoff", "1.0" ) )
+        for attempt in range( retries + 1 ):
+            try:
+                with self.getSemaphore( address ): return request()
+            except Exception as err:
+                if attempt == retries: raise
+                delay = backoff * 2 ** attempt
+                self.logger.warning( f"DAP request to {address} failed ({err}), retrying in {delay} sec" )
+                time.sleep( delay )
+
+    def read( self, address: str, auth: Optional[str], varName: str, key: Tuple[slice,...], shape: Tuple[int,...] ) -> np.ndarray:
+        blockId = DapBlockCache.getKey( address, varName, key, shape ) if self.blockCache.enabled else None
+        data = self.blockCache.get( blockId ) if blockId else None
+        if data is None:
+            variable = self.getDataset( address, auth )[varName]
+            proxy = variable.array.data if hasattr( variable, "array" ) else variable.data
+            data = np.asarray( self.retry( address, lambda: proxy[key] ) )
+            if blockId: self.blockCache.put( blockId, data )
+        return data
+
+    def openDataset( self, address: str, auth: Optional[str] ) -> xa.Dataset:
+        # Lazy dataset over the remote variables: blocks along the time axis are fetched concurrently by dask, as separate hyperslab requests
+        import dask.array as da
+        from dask.base import tokenize
+        store = xa.backends.PydapDataStore( self.getDataset( address, auth ) )
+        target = SizeParser.parse( EdasEnv.get( "dap.request.size", "32M" ) )
+        variables = OrderedDict()
+        for name, variable in store.get_variables().items():
+            dtype = variable.dtype.newbyteorder("=")
+            if ( variable.ndim == 0 ) or ( variable.dtype.kind in "SUO" ):
+                variables[name] = variable
+            elif variable.dims == ( name, ):
+                variables[name] = xa.Variable( variable.dims, self.read( address, auth, name, ( slice( None ), ), variable.shape ).astype( dtype ), variable.attrs, variable.encoding )
+            else:
+                stepBytes = dtype.itemsize * int( np.prod( variable.shape[1:] ) )
+                chunks = ( max( 1, min( variable.shape[0], target // max( stepBytes, 1 ) ) ), ) + variable.shape[1:]
+                array = DapArray( address, auth, name, variable.shape, dtype )
+                data = da.from_array( array, chunks=chunks, name="dap-{}-{}".format( name, tokenize( address, name, variable.shape, chunks ) ), meta=np.empty( (0,)*variable.ndim, dtype=dtype ) )
+                variables[name] = xa.Variable( variable.dims, data, variable.attrs, variable.encoding )
+        dset = xa.Dataset( variables, attrs=store.get_attrs() )
+        return xa.decode_cf( dset )
+
+class DapArray:
+    # Lazy, picklable handle on one remote DAP variable: blocks are read as hyperslab requests through the session pool of the reading process.
+
+    def __init__(self, address: str, auth: Optional[str], varName: str, shape: Tuple[int,...], dtype: np.dtype ):
+        self.address = address
+        self.auth = auth
+        self.varName = varName
+        self.shape = shape
+        self.dtype = dtype
+        self.ndim = len( shape )
+
+    def __getitem__(self, key ) -> np.ndarray:
+        return EDASDapPool.read( self.address, self.auth, self.varName, key, self.shape ).astype( self.dtype, copy=False )
+
+EDASDapPool = DapSessionPool()
@@ -0,0 +1,84 @@
+from edas.workflow.data import EDASArray
+from typing import Dict, Optional
+from edas.config import EdasEnv
+from edas.portal.parsers import SizeParser
+from edas.util.logging import EDASLogger
+import xarray as xa
+import numpy as np
+import os, time, shutil, threading, hashlib, uuid
+
+class Rechunker:
+    # Changes the chunk layout of input arrays to the layout preferred by a kernel (e.g. contiguous time columns).
+    # Arrays that don't fit in the memory budget are rechunked in two bounded stages through a temporary zarr store
+    # under the transients dir: written with chunks that only split the source chunks, then read back with the target chunks.
+    # Stores are keyed by the source version token, and each store is claimed with its own lock while it is written,
+    # so rechunks of different inputs run concurrently.
+
+    def __init__(self):
+        self.logger = EDASLogger.getLogger()
+        self.directory = os.path.join( EdasEnv.TRANSIENTS_DIR, "rechunk" )
+        self.storeLocks: Dict[str,threading.Lock] = {}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def getTargetChunks( xarray: xa.DataArray, preferred: Dict[str,int], chunkSize: int ) -> Dict[str,int]:
+        # Preferred dims get their requested chunk size (-1 = full extent), the remaining dims are halved, largest first, until chunks fit in chunkSize
+        chunks = { dim: ( size if preferred.get(dim,0) < 0 else min( preferred[dim], size ) ) if dim in preferred else size for dim, size in xarray.sizes.items() }
+        free = [ dim for dim in xarray.dims if dim not in preferred ]
+        bsize = lambda: xarray.dtype.itemsize * int( np.prod( list( chunks.values() ) ) )
+        while ( bsize() > chunkSize ) and any( [ chunks[dim] > 1 for dim in free ] ):
+            dim = max( free, key=lambda d: chunks[d] )
+            chunks[dim] = ( chunks[dim] + 1 ) // 2
+        return chunks
+
+    @staticmethod
+    def hasChunks( xarray: xa.DataArray, chunks: Dict[str,int] ) -> bool:
+        return all( [ max( dimChunks ) == chunks[dim] and all( [ c == chunks[dim] for c in dimChunks[:-1] ] ) for dim, dimChunks in zip( xarray.dims, xarray.chunks ) ] )
+
+    def rechunk( self, variable: EDASArray, preferred: Dict[str,int], memoryBudget: Optional[int] = None, sourceToken: Optional[str] = None ) -> EDASArray:
+        xarray = variable.xr
+        if not isinstance( xarray, xa.DataArray ) or ( xarray.chunks is None ): return variable
+        budget = min( [ b for b in [ memoryBudget, SizeParser.parse( EdasEnv.get( "rechunk.memory.max", "1G" ) ) ] if b ] )
+        chunks = self.getTargetChunks( xarray, preferred, min( SizeParser.parse( EdasEnv.get( "mfdataset.chunk.size", "128M" ) ), budget ) )
+        if self.hasChunks( xarray, chunks ): return variable
+        if xarray.nbytes <= budget:
+            result = xarray.chunk( chunks )
+        else:
+            t0 = time.time()
+            result = self.rechunkThroughStore( xarray, chunks, sourceToken )
+            self.logger.info( f"Rechunked {variable.name} through store: {dict(xarray.sizes)} -> {chunks}, time = {time.time()-t0} sec" )
+        return EDASArray( variable.name, variable.domId, result )
+
+    def rechunkThroughStore( self, xarray: xa.DataArray, chunks: Dict[str,int], sourceToken: Optional[str] = None ) -> xa.DataArray:
+        # Without a source version token a store can't be validated against the source, so it isn't shared
+        name = xarray.name if xarray.name is not None else "data"
+        intermediate = { dim: min( max( dimChunks ), chunks[dim] ) for dim, dimChunks in zip( xarray.dims, xarray.chunks ) }
+        token = hashlib.sha1( "|".join( [ xarray.data.name, sourceToken if sourceToken else uuid.uuid4().hex, str(sorted(intermediate.items())) ] ).encode() ).hexdigest()
+        storePath = os.path.join( self.directory, token + ".zarr" )
+        with self._lock:
+            storeLock = self.storeLocks.setdefault( token, threading.Lock() )
+        with storeLock:
+            if os.path.exists( os.path.join( storePath, ".complete" ) ):
+                os.utime( storePath )
+            else:
+                self.prune()
+                shutil.rmtree( storePath, ignore_errors=True )
+                xa.Dataset( { name: xarray.chunk( intermediate ) } ).to_zarr( storePath, mode="w", consolidated=True )
+                open( os.path.join( storePath, ".complete" ), "w" ).close()
+            result: xa.DataArray = xa.open_zarr( storePath, consolidated=True, chunks=chunks )[name]
+        return result.rename( xarray.name )
+
+    def prune(self):
+        # Remove temporary stores that haven't been used for 'rechunk.store.ttl' seconds, except those being written
+        ttl = float( EdasEnv.get( "rechunk.store.ttl", "86400" ) )
+        if not os.path.isdir( self.directory ): return
+        with self._lock:
+            for fname in os.listdir( self.directory ):
+                token, storePath = fname.split(".")[0], os.path.join( self.directory, fname )
+                storeLock = self.storeLocks.get( token )
+                if ( storeLock is not None ) and storeLock.locked(): continue
+                if time.time() - os.path.getmtime( storePath ) > ttl:
+                    shutil.rmtree( storePath, ignore_errors=True )
+                    self.storeLocks.pop( token, None )
+
+EDASRechunker = Rechunker()
@@ -0,0 +1,254 @@
+from typing import Dict, List, Optional, Tuple
+import xarray as xa
+import pandas as pd
+import numpy as np
+from edas.config import EdasEnv
+from edas.portal.parsers import SizeParser
+
+class Moments:
+    # Partial (count, mean, M2) moments of a set of values, M2 being the sum of squared deviations from the mean.
+    # Partials are computed in float64 with two passes over each chunk and merged with Chan's parallel algorithm,
+    # so they stay accurate for long float32 series. Counts are summed weights when the values are weighted.
+
+    @staticmethod
+    def compute( values: np.ndarray, weights: Optional[np.ndarray], axis: Tuple[int,...] ) -> Tuple[np.ndarray,np.ndarray,np.ndarray]:
+        values = values.astype( np.float64 )
+        valid = ~np.isnan( values )
+        weights = valid.astype( np.float64 ) if weights is None else np.where( valid, weights, 0.0 )
+        count = weights.sum( axis=axis, keepdims=True )
+        with np.errstate( invalid="ignore", divide="ignore" ):
+            mean = np.where( valid, weights * values, 0.0 ).sum( axis=axis, keepdims=True ) / count
+            m2 = np.where( valid, weights * ( values - mean ) ** 2, 0.0 ).sum( axis=axis, keepdims=True )
+        return count, mean, np.where( count > 0, m2, np.nan )
+
+    @staticmethod
+    def merge( count: np.ndarray, mean: np.ndarray, m2: np.ndarray, axis: Tuple[int,...] ) -> Tuple[np.ndarray,np.ndarray,np.ndarray]:
+        # Merges the partials along axis (keeping dims), partials with a zero count (NaN mean and M2) don't contribute
+        valid = count > 0
+        total = count.sum( axis=axis, keepdims=True )
+        with np.errstate( invalid="ignore", divide="ignore" ):
+            merged_mean = np.where( valid, count * mean, 0.0 ).sum( axis=axis, keepdims=True ) / total
+            merged_m2 = np.where( valid, m2 + count * ( mean - merged_mean ) ** 2, 0.0 ).sum( axis=axis, keepdims=True )
+        return total, merged_mean, np.where( total > 0, merged_m2, np.nan )
+
+    @staticmethod
+    def statistic( op: str, count: np.ndarray, mean: np.ndarray, m2: np.ndarray ) -> np.ndarray:
+        if op in [ "mean", "ave" ]: return mean
+        with np.errstate( invalid="ignore", divide="ignore" ):
+            variance = m2 / count
+        if op == "var": return variance
+        if op == "std": return np.sqrt( variance )
+        raise Exception( "Unrecognised moment statistic: " + op )
+
+class MomentReduction:
+    # Streaming mean/var/std of an array over a set of dims, optionally weighted (e.g. by cos(lat) for area averages).
+    # Each chunk is reduced to (count, mean, M2) partials that dask merges tree-wise, so memory use is bounded
+    # by the chunk size whatever the length of the reduced axes.
+
+    Statistics = [ "mean", "ave", "var", "std" ]
+
+    def __init__(self, xarray: xa.DataArray, dims: List[str], weights: Optional[xa.DataArray] = None ):
+        self.xarray = xarray
+        self.dims = list( dims )
+        self.axes = tuple( sorted( [ xarray.get_axis_num( dim ) for dim in self.dims ] ) )
+        self.weights = None if weights is None else self.getBroadcastableWeights( weights, xarray )
+
+    @staticmethod
+    def getBroadcastableWeights( weights: xa.DataArray, xarray: xa.DataArray ) -> xa.DataArray:
+        # Weights keep their own (e.g. 1-D latitude) shape, with size-1 dims for the other dims of the array, and are broadcast within each block
+        weights = weights.drop_vars( list( weights.coords ) )
+        return weights.expand_dims( [ d for d in xarray.dims if d not in weights.dims ] ).transpose( *xarray.dims )
+
+    @property
+    def resultType(self) -> np.dtype: return self.xarray.dtype if np.issubdtype( self.xarray.dtype, np.floating ) else np.dtype( np.float64 )
+
+    def reduce( self, operations: List[str] ) -> Dict[str,xa.DataArray]:
+        for op in operations: assert op in self.Statistics, "Unrecognised moment statistic: " + op
+        data = self.xarray.data
+        if not hasattr( data, "dask" ):
+            partials = self.blockMoments( np.asarray( data ), None if self.weights is None else self.weights.values, axes=self.axes )
+            statistics = { op: self.blockStatistic( partials, op=op, axes=self.axes, resultType=self.resultType ) for op in operations }
+        else:
+            import dask.array as da
+            chunks = ( ( 3, ), ) + tuple( [ ( 1, ) * len(c) if iAx in self.axes else c for iAx, c in enumerate( data.chunks ) ] )
+            args = [ data ] if self.weights is None else [ data, da.asarray( self.weights.data ).rechunk( tuple( [ c if self.weights.shape[iAx] == data.shape[iAx] else ( 1, ) for iAx, c in enumerate( data.chunks ) ] ) ) ]
+            blocks = da.map_blocks( self.blockMoments, *args, axes=self.axes, new_axis=[0], chunks=chunks, dtype=np.float64 )
+            partials = da.reduction( blocks, self.identity, self.mergeBlocks, combine=self.mergeBlocks, axis=tuple( [ iAx + 1 for iAx in self.axes ] ), keepdims=True, dtype=np.float64, meta=np.empty( (0,) * blocks.ndim, dtype=np.float64 ) )
+            statistics = { op: partials.map_blocks( self.blockStatistic, op=op, axes=self.axes, resultType=self.resultType, drop_axis=[0] + [ iAx + 1 for iAx in self.axes ], dtype=self.resultType ) for op in operations }
+        return { op: self.toDataArray( result ) for op, result in statistics.items() }
+
+    @staticmethod
+    def blockMoments( block: np.ndarray, weights: Optional[np.ndarray] = None, axes: Tuple[int,...] = () ) -> np.ndarray:
+        return np.stack( Moments.compute( block, weights, axes ) )
+
+    @staticmethod
+    def identity( partials: np.ndarray, axis, keepdims ) -> np.ndarray:
+        return partials
+
+    @staticmethod
+    def mergeBlocks( partials: np.ndarray, axis, keepdims ) -> np.ndarray:
+        return np.stack( Moments.merge( partials[0], partials[1], partials[2], tuple( [ iAx - 1 for iAx in axis ] ) ) )
+
+    @staticmethod
+    def blockStatistic( partials: np.ndarray, op: str, axes: Tuple[int,...], resultType: np.dtype ) -> np.ndarray:
+        return Moments.statistic( op, *partials ).squeeze( axis=axes ).astype( resultType )
+
+    def toDataArray( self, data ) -> xa.DataArray:
+        coords = { name: coord for name, coord in self.xarray.coords.items() if not any( [ dim in coord.dims for dim in self.dims ] ) }
+        return xa.DataArray( data, coords=coords, dims=[ d for d in self.xarray.dims if d not in self.dims ], name=self.xarray.name, attrs=self.xarray.attrs )
+
+class GroupReduction:
+    # Fused reduction of an array over groups of steps along one dim (time bins or periodic groups such as months).
+    # All requested statistics are derived from one set of partials ((count, mean, M2) moments, sum, min, max), computed for
+    # every chunk in a single pass over the data, with NaN partials marking groups without any steps. Partials of contiguous
+    # groups are computed on chunks aligned to the group boundaries and concatenated, partials of periodic groups are merged tree-wise.
+    # Chunks are capped at maxChunkSize: groups longer than that are split across chunks whose partials are merged.
+
+    Partials = [ "count", "mean", "m2", "sum", "min", "max" ]
+    Statistics = { "mean": [ "count", "mean", "m2" ], "ave": [ "count", "mean", "m2" ], "sum": [ "sum" ], "max": [ "max" ], "min": [ "min" ], "std": [ "count", "mean", "m2" ] }
+
+    def __init__(self, xarray: xa.DataArray, dim: str, codes: np.ndarray, labels: np.ndarray, labelName: str, maxChunkSize: Optional[int] = None ):
+        self.xarray = xarray
+        self.dim = dim
+        self.axis = xarray.get_axis_num( dim )
+        self.codes = codes
+        self.labels = labels
+        self.labelName = labelName
+        self.maxChunkSize = maxChunkSize if maxChunkSize else min( SizeParser.parse( EdasEnv.get( "mfdataset.chunk.size", "128M" ) ), SizeParser.parse( EdasEnv.get( "rechunk.memory.max", "1G" ) ) )
+
+    @classmethod
+    def groupby( cls, xarray: xa.DataArray, dim: str, period: str, maxChunkSize: Optional[int] = None ) -> "GroupReduction":
+        labels, codes = np.unique( getattr( xarray[dim].dt, period ).values, return_inverse=True )
+        return GroupReduction( xarray, dim, codes.ravel(), labels, period, maxChunkSize )
+
+    @classmethod
+    def resample( cls, xarray: xa.DataArray, dim: str, freq: str, maxChunkSize: Optional[int] = None ) -> Optional["GroupReduction"]:
+        # Bins are computed by pandas, returns None for time axes that pandas can't resample (e.g. non-standard calendars)
+        try: index = pd.DatetimeIndex( xarray[dim].values )
+        except Exception: return None
+        if not index.is_monotonic_increasing: return None
+        bins = pd.Series( np.arange( len(index) ), index=index ).resample( freq ).groups
+        codes = np.searchsorted( np.array( list( bins.values() ) ), np.arange( len(index) ), side="right" )
+        return GroupReduction( xarray, dim, codes, np.array( list( bins.keys() ), dtype="datetime64[ns]" ), dim, maxChunkSize )
+
+    @classmethod
+    def checkStatistics( cls, operations: List[str], opName: str ):
+        for op in operations:
+            if op not in cls.Statistics: raise Exception( f"Unrecognised operation in {opName} operation: " + op )
+
+    @property
+    def ngroups(self) -> int: return len( self.labels )
+
+    @property
+    def resultType(self) -> np.dtype: return self.xarray.dtype if np.issubdtype( self.xarray.dtype, np.floating ) else np.dtype( np.float64 )
+
+    @property
+    def isContiguous(self) -> bool: return bool( np.all( np.diff( self.codes ) >= 0 ) )
+
+    def reduce( self, operations: List[str] ) -> Dict[str,xa.DataArray]:
+        moments = [ m for m in self.Partials if any( [ m in self.Statistics[op] for op in operations ] ) ]
+        data = self.xarray.data
+        if not hasattr( data, "dask" ):
+            partials = self.blockMoments( np.asarray( data ), self.codes, self.ngroups, moments, self.axis )
+            statistics = { op: self.blockStatistic( partials, op, moments, self.resultType ) for op in operations }
+        else:
+            partials = self.contiguousMoments( data, moments ) if self.isContiguous else self.treeMoments( data, moments )
+            statistics = { op: partials.map_blocks( self.blockStatistic, op=op, moments=moments, resultType=self.resultType, dtype=self.resultType, drop_axis=0 ) for op in operations }
+        return { op: self.toDataArray( result ) for op, result in statistics.items() }
+
+    def getSegments( self, data ) -> List[Tuple[int,int]]:
+        # Chunk boundaries are moved to the nearest group boundary, then segments longer than maxChunkSize are split,
+        # between groups where possible and within a group otherwise
+        stepSize = data.dtype.itemsize * int( np.prod( [ max( c ) for iAx, c in enumerate( data.chunks ) if iAx != self.axis ] ) )
+        maxSteps = max( int( self.maxChunkSize // max( stepSize, 1 ) ), 1 )
+        starts = np.searchsorted( self.codes, np.arange( self.ngroups ) )
+        bounds = sorted( set( [ 0, len(self.codes) ] + [ int( starts[ min( np.searchsorted( starts, b ), self.ngroups - 1 ) ] ) for b in np.cumsum( data.chunks[self.axis] )[:-1] ] ) )
+        segments = []
+        for start, end in zip( bounds[:-1], bounds[1:] ):
+            while end - start > maxSteps:
+                splits = starts[ ( starts > start ) & ( starts <= start + maxSteps ) ]
+                split = int( splits[-1] ) if len( splits ) else start + maxSteps
+                segments.append( ( start, split ) )
+                start = split
+            segments.append( ( start, end ) )
+        return segments
+
+    def contiguousMoments( self, data, moments: List[str] ):
+        # Each segment is reduced within a single chunk. The partials of a group split across segments are merged.
+        import dask.array as da
+        segments = self.getSegments( data )
+        data = data.rechunk( { self.axis: tuple( [ end - start for start, end in segments ] ) } )
+        blocks, g0 = [], 0
+        for iB, ( start, end ) in enumerate( segments ):
+            if ( start > 0 ) and ( self.codes[start] == self.codes[start-1] ): g0 = int( self.codes[start] )
+            g1 = int( self.codes[end-1] ) + 1 if end < len(self.codes) else self.ngroups
+            block = data.blocks[ (slice(None),) * self.axis + (iB,) ]
+            chunks = ( ( len(moments), ), ) + tuple( [ ( g1 - g0, ) if iAx == self.axis else c for iAx, c in enumerate( block.chunks ) ] )
+            blocks.append( ( g0, g1, block.map_blocks( self.blockMoments, codes=self.codes[start:end] - g0, ngroups=g1 - g0, moments=moments, axis=self.axis, new_axis=[0], chunks=chunks, dtype=np.float64 ) ) )
+            g0 = g1
+        groups = lambda partials, first, g0, g1: partials[ (slice(None),) * ( self.axis + 1 ) + ( slice( g0 - first, g1 - first ), ) ]
+        pieces, carry = [], None
+        for iB, ( g0, g1, partials ) in enumerate( blocks ):
+            continued = ( iB + 1 < len( blocks ) ) and ( blocks[iB+1][0] == g1 - 1 )
+            lo, hi = g0, ( g1 - 1 if continued else g1 )
+            if carry is not None:
+                carry = carry.map_blocks( self.combineMoments, groups( partials, g0, g0, g0 + 1 ), moments=moments, dtype=np.float64 )
+                lo = g0 + 1
+                if hi < lo: continue
+                pieces.append( carry )
+            if hi > lo: pieces.append( groups( partials, g0, lo, hi ) )
+            carry = groups( partials, g0, g1 - 1, g1 ) if continued else None
+        return da.concatenate( pieces, axis=self.axis + 1 ) if len( pieces ) > 1 else pieces[0]
+
+    def treeMoments( self, data, moments: List[str] ):
+        offsets = np.cumsum( ( 0, ) + data.chunks[self.axis] )
+        partials = []
+        for iB in range( len( data.chunks[self.axis] ) ):
+            block = data.blocks[ (slice(None),) * self.axis + (iB,) ]
+            chunks = ( ( len(moments), ), ) + tuple( [ ( self.ngroups, ) if iAx == self.axis else c for iAx, c in enumerate( block.chunks ) ] )
+            partials.append( block.map_blocks( self.blockMoments, codes=self.codes[offsets[iB]:offsets[iB+1]], ngroups=self.ngroups, moments=moments, axis=self.axis, new_axis=[0], chunks=chunks, dtype=np.float64 ) )
+        while len( partials ) > 1:
+            pairs = [ partials[i:i+2] for i in range( 0, len(partials), 2 ) ]
+            partials = [ pair[0].map_blocks( self.combineMoments, pair[1], moments=moments, dtype=np.float64 ) if len(pair) == 2 else pair[0] for pair in pairs ]
+        return partials[0]
+
+    @staticmethod
+    def blockMoments( block: np.ndarray, codes: np.ndarray, ngroups: int, moments: List[str], axis: int ) -> np.ndarray:
+        values = np.moveaxis( block, axis, 0 )
+        result = np.empty( ( len(moments), ngroups ) + values.shape[1:], dtype=np.float64 )
+        for iM, moment in enumerate( moments ): result[iM] = 0.0 if moment == "count" else np.nan
+        for group in np.unique( codes ):
+            values_g = values[ codes == group ].astype( np.float64 )
+            if "count" in moments:
+                count, mean, m2 = Moments.compute( values_g, None, (0,) )
+                result[ moments.index("count"), group ], result[ moments.index("mean"), group ], result[ moments.index("m2"), group ] = count[0], mean[0], m2[0]
+            for iM, moment in enumerate( moments ):
+                if   moment == "sum":   result[iM,group] = np.nansum( values_g, axis=0 )
+                elif moment == "min":   result[iM,group] = np.fmin.reduce( values_g, axis=0 )
+                elif moment == "max":   result[iM,group] = np.fmax.reduce( values_g, axis=0 )
+        return np.moveaxis( result, 1, axis + 1 )
+
+    @staticmethod
+    def combineMoments( partials0: np.ndarray, partials1: np.ndarray, moments: List[str] ) -> np.ndarray:
+        result = np.empty_like( partials0 )
+        if "count" in moments:
+            iMs = [ moments.index( m ) for m in [ "count", "mean", "m2" ] ]
+            merged = Moments.merge( *[ np.stack( [ partials0[iM], partials1[iM] ] ) for iM in iMs ], axis=(0,) )
+            for iM, partial in zip( iMs, merged ): result[iM] = partial[0]
+        for iM, moment in enumerate( moments ):
+            if   moment == "min": result[iM] = np.fmin( partials0[iM], partials1[iM] )
+            elif moment == "max": result[iM] = np.fmax( partials0[iM], partials1[iM] )
+            elif moment == "sum": result[iM] = np.where( np.isnan( partials0[iM] ), partials1[iM], np.where( np.isnan( partials1[iM] ), partials0[iM], partials0[iM] + partials1[iM] ) )
+        return result
+
+    @staticmethod
+    def blockStatistic( partials: np.ndarray, op: str, moments: List[str], resultType: np.dtype ) -> np.ndarray:
+        moment = lambda name: partials[ moments.index(name) ]
+        result = Moments.statistic( op, moment( "count" ), moment( "mean" ), moment( "m2" ) ) if op in [ "mean", "ave", "std" ] else moment( op )
+        return result.astype( resultType )
+
+    def toDataArray( self, data ) -> xa.DataArray:
+        dims = [ self.labelName if d == self.dim else d for d in self.xarray.dims ]
+        coords = { name: coord for name, coord in self.xarray.coords.items() if self.dim not in coord.dims }
+        coords[ self.labelName ] = self.labels
+        return xa.DataArray( data, coords=coords, dims=dims, name=self.xarray.name, attrs=self.xarray.attrs )
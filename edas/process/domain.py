@@ -154,6 +154,10 @@ class AxisBounds:
         timeDelta = self.getRelativeDelta( offsetStr )
         return AxisBounds( self.name, self.start, self.end, self.step, self.system, self.metadata, timeDelta )
 
+    def shiftIndices( self, offset: int ) -> "AxisBounds":
+        if self.isValueType or ( offset == 0 ): return self
+        return AxisBounds( self.name, self.start - offset, self.end - offset, self.step, self.system, self.metadata, self._timeDelta )
+
     def revertByDelta(self, dt64: np.datetime64) -> datetime:
         return  TimeConversions.toDatetime(dt64) - self._timeDelta
 
@@ -196,9 +200,25 @@ class AxisBounds:
             new_end = min( self.end, other.end )
             return AxisBounds( self.name, new_start, new_end, self.step, self.system, self.metadata, self._timeDelta )
 
+    def contains(self, other: "AxisBounds" ) -> bool:
+        if self.signature == other.signature: return True
+        if not ( self.isValueType and other.isValueType ) or ( self._timeDelta is not None ) or ( other._timeDelta is not None ): return False
+        try:
+            if isinstance( self.start, str ) or isinstance( other.start, str ):
+                ( start, end, otherStart, otherEnd ) = [ TimeConversions.toDatetime( val ) for val in ( self.start, self.end, other.start, other.end ) ]
+            else:
+                ( start, end, otherStart, otherEnd ) = [ float( val ) for val in ( self.start, self.end, other.start, other.end ) ]
+        except Exception:
+            return False
+        return ( min( start, end ) <= min( otherStart, otherEnd ) ) and ( max( otherStart, otherEnd ) <= max( start, end ) )
+
     def __str__(self):
         return "B({}:{})[ start: {}, end: {}, system: {}, offset: {} ]".format( self.type.name, self.name, self.start, self.end, self.system, self.offset )
 
+    @property
+    def signature(self) -> str:
+        return "{}:{}:{}:{}:{}:{}".format( self.name, self.start, self.end, self.step, self.system, self._timeDelta )
+
     @classmethod
     def getRelativeDelta(cls, offsetStr: str ) -> relativedelta:
         result = None
@@ -253,6 +273,10 @@ class Domain:
         if offset == None: return self
         return Domain( self.name, { axis:bound.offset(offset) for axis,bound in self.axisBounds.items()} )
 
+    def shiftIndices(self, axis: Axis, offset: int ) -> "Domain":
+        if ( offset == 0 ) or ( axis not in self.axisBounds ): return self
+        return Domain( self.name, { ax: ( bound.shiftIndices(offset) if ax == axis else bound ) for ax, bound in self.axisBounds.items() } )
+
     def findAxisBounds( self, type: Axis ) -> Optional[AxisBounds]:
         return self.axisBounds.get( type, None )
 
@@ -270,6 +294,12 @@ class Domain:
                 result_axes[axis] = bounds
         return Domain( name, result_axes )
 
+    def contains( self, other: "Domain" ) -> bool:
+        return all( [ ( axis in other.axisBounds ) and bounds.contains( other.axisBounds[axis] ) for ( axis, bounds ) in self.axisBounds.items() ] )
+
+    def residual( self, other: "Domain" ) -> "Domain":
+        return Domain( other.name, { axis: bounds for ( axis, bounds ) in other.axisBounds.items() if ( axis not in self.axisBounds ) or ( self.axisBounds[axis].signature != bounds.signature ) } )
+
     def hasUnknownAxes(self) -> bool :
         return self.findAxisBounds(Axis.UNKNOWN) is not None
 
@@ -285,6 +315,10 @@ class Domain:
     def slice( cls, axis: Axis, bounds: AxisBounds ) -> Tuple[str,slice]:
          return ( bounds.name if axis == Axis.UNKNOWN else axis.name.lower(), bounds.slice() )
 
+    @property
+    def signature(self) -> str:
+        return "{}[{}]".format( self.name, ";".join( sorted( [ b.signature for b in self.axisBounds.values() ] ) ) )
+
     def __str__(self):
         return "D({})[ {} ]".format( self.name, "; ".join( [ str(b) for b in self.axisBounds.values()] ) )
 
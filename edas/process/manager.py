@@ -265,6 +265,10 @@ class ProcessManager(GenericProcessManager):
       if log_metrics:
         self.metricsThread =  Thread( target=self.trackMetrics )
         self.metricsThread.start()
+      if EdasEnv.getBool( "collections.warmup", True ):
+        from edas.collection.agg import EDASCollections
+        self.warmupThread = Thread( target=EDASCollections.warmup, daemon=True )
+        self.warmupThread.start()
 
   def getCWTMetrics(self) -> Dict:
       metrics_data = { key:{} for key in ['user_jobs_queued','user_jobs_running','wps_requests','cpu_ave','cpu_count','memory_usage','memory_available']}
@@ -12,6 +12,7 @@ class SourceType(Enum):
     dap = auto()
     file = auto()
     archive = auto()
+    zarr = auto()
 
 class DataSource:
 
@@ -62,12 +63,36 @@ class DataSource:
             elif scheme == "archive":
                 self.type = SourceType.archive
                 self.address = path
+            elif scheme == "zarr":
+                self.type = SourceType.zarr
+                self.address = path
             else:
                 raise Exception( "Unrecognized scheme '{}' in url: {}".format(scheme,_address) )
         else:
             self.type = stype
             self.address = _address
 
+    def versionToken( self, varNames: List[str] ) -> Optional[str]:
+        # Changes whenever the underlying data is modified, None if the source version can't be determined
+        import os, glob
+        try:
+            if self.type == SourceType.collection:
+                from edas.collection.agg import Collection
+                collection = Collection.new( self.address )
+                aggFiles = [ os.path.join( Collection.baseDir, collection.getAggId(varName) + ".ag1" ) for varName in varNames ]
+                return ",".join( [ str( os.path.getmtime(f) ) for f in [ collection.spec ] + aggFiles ] )
+            elif self.type == SourceType.file:
+                files = glob.glob( self.address )
+                return ",".join( [ str( os.path.getmtime(f) ) for f in sorted(files) ] ) if len(files) else None
+            elif self.type == SourceType.dap:
+                return self.address
+            elif self.type == SourceType.zarr:
+                metadata = [ os.path.join( self.address, f ) for f in [ ".zmetadata", "zarr.json" ] ]
+                return ",".join( [ str( os.path.getmtime(f) ) for f in metadata if os.path.exists(f) ] ) or None
+        except Exception:
+            return None
+        return None
+
     def __str__(self):
         return "DS({})[ {} ]".format( self.type.name, self.address )
 
@@ -1,6 +1,6 @@
 from typing import Dict, Any, Union, Sequence, List, Set, Optional, Iterable
 from stratus_endpoint.handler.base import TaskResult
-import logging, random, string, traceback
+import logging, random, string, traceback, threading
 import xarray as xa
 from edas.process.domain import DomainManager, Domain, AxisBounds, Axis
 import copy, pandas as pd
@@ -9,6 +9,7 @@ from edas.process.source import VariableManager
 from edas.process.operation import OperationManager, WorkflowNode
 from edas.portal.parsers import WpsCwtParser
 from edas.workflow.data import EDASDataset, EDASArray, EDASDatasetCollection
+from edas.workflow.planner import MaterializationPlan
 from edas.collection.agg import Archive
 
 class UID:
@@ -112,7 +113,15 @@ class TaskRequest:
       self.experiment = experiment
       self.operationManager = _operationManager
       self._resultCache: Dict[ str,  EDASDatasetCollection ] = {}
+      self.fingerprints: Dict[ str, Optional[str] ] = {}
       self.runargs = runargs
+      self._nodeLocks: Dict[ str, threading.RLock ] = {}
+      self._lock = threading.Lock()
+      self.plan = MaterializationPlan()
+
+  def nodeLock( self, nodeId: str ) -> threading.RLock:
+      # Serializes the builds of a workflow node shared by concurrently built branches
+      with self._lock: return self._nodeLocks.setdefault( nodeId, threading.RLock() )
 
   def getCachedResult( self, key: str )->  EDASDatasetCollection:
       return self._resultCache.get( key )
@@ -124,8 +133,8 @@ class TaskRequest:
   def intersectDomains(self, domainIds = Set[str], allow_broadcast: bool = True  ) -> str:
       return self.operationManager.domains.intersectDomains( domainIds, allow_broadcast )
 
-  def cropDomain( self, domainId: str, inputs: Iterable[EDASArray], offset: Optional[str] = None ) -> Domain:
-      dom: Domain = self.operationManager.getDomain( domainId )
+  def cropDomain( self, domainId: str, inputs: Iterable[EDASArray], offset: Optional[str] = None, timeIndexOffset: int = 0 ) -> Domain:
+      dom: Domain = self.operationManager.getDomain( domainId ).shiftIndices( Axis.T, timeIndexOffset )
       domain = dom if offset is None else dom.offset( offset )
       new_domain = Domain( domain.name, {} )
       for axis,bound in domain.axisBounds.items():
@@ -0,0 +1,216 @@
+from edas.collection.agg import Aggregation, AggIndex, AggMetadata, AggProcessing, Collection
+from edas.process.task import TaskRequest
+from edas.workflow.module import edasOpManager
+from edas.config import EdasEnv
+from edas.process.domain import Domain, Axis as DomainAxis
+from datetime import datetime, timedelta, timezone
+from typing import List
+import numpy as np
+import pandas as pd
+import xarray as xa
+import pytest, os, time
+
+epoch = datetime( 1980, 1, 1, tzinfo=timezone.utc )
+nFiles = 12
+
+def getStartTime( iFile: int ) -> float:
+    return ( timedelta( days=30 * iFile ).total_seconds() + ( epoch - datetime( 1970, 1, 1, tzinfo=timezone.utc ) ).total_seconds() ) / 60.0
+
+def writeAggFile( path: str, nfiles: int = nFiles ):
+    # File records are written out of order: the index sorts them by start time
+    order = list( range( 1, nfiles ) ) + [ 0 ]
+    with open( path, "w" ) as file:
+        file.write( "P;base.path;/data\n" )
+        for iFile in order: file.write( f"F;{getStartTime(iFile)};30;tas_{iFile:02d}.nc\n" )
+
+@pytest.fixture
+def aggFile( tmpdir ) -> str:
+    path = os.path.join( str( tmpdir ), "test.ag1" )
+    writeAggFile( path )
+    return path
+
+def linearPathList( agg: Aggregation, start: datetime, end: datetime ) -> List[str]:
+    # File selection of periodPathList before the AggIndex: a scan of all file records
+    paths: List[str] = []
+    prev_file = None
+    for file in agg.fileList():
+        if file.date > end: break
+        if file.date >= start:
+            if (len(paths) == 0) and (prev_file is not None):
+                paths.append( prev_file.getPath() )
+            paths.append( file.getPath() )
+        prev_file = file
+    return paths
+
+def getPath( iFile: int ) -> str:
+    return f"/data/tas_{iFile:02d}.nc"
+
+def test_agg_index( aggFile ):
+    index = AggIndex( aggFile )
+    assert os.path.isfile( os.path.join( aggFile + ".idx", "stamp" ) )
+    assert np.all( np.diff( index.start_times ) > 0 )
+    assert [ index.getRelPath( iFile ) for iFile in range( nFiles ) ] == [ f"tas_{iFile:02d}.nc" for iFile in range( nFiles ) ]
+    assert index.header == [ "P;base.path;/data\n" ]
+    reloaded = AggIndex( aggFile )
+    assert isinstance( reloaded.start_times, np.memmap )
+    np.testing.assert_array_equal( reloaded.start_times, index.start_times )
+    assert reloaded.step_offsets[-1] == 30 * nFiles
+
+def test_agg_index_rebuild( aggFile ):
+    AggIndex( aggFile )
+    writeAggFile( aggFile, nFiles + 1 )
+    index = AggIndex( aggFile )
+    assert len( index ) == nFiles + 1
+    assert index.getRelPath( nFiles ) == f"tas_{nFiles:02d}.nc"
+
+def test_period_path_list( aggFile ):
+    agg = Aggregation( "test", aggFile )
+    assert agg.pathList() == [ getPath( iFile ) for iFile in range( nFiles ) ]
+    offsets = [ timedelta( days=d ) for d in ( -45, -1, 5, 29, 40, 100, 200, 320 ) ]
+    for startOffset in offsets:
+        for length in [ timedelta( days=d ) for d in ( 20, 31, 90, 400 ) ]:
+            start, end = epoch + startOffset, epoch + startOffset + length
+            expected = linearPathList( agg, start, end )
+            if len( expected ): assert agg.periodPathList( start, end ) == expected, f"Period [{start},{end}]"
+
+def test_period_path_list_edges( aggFile ):
+    agg = Aggregation( "test", aggFile )
+    lastStart = epoch + timedelta( days=30 * ( nFiles - 1 ) )
+    # Periods ending before the first file or starting before it
+    assert agg.periodPathList( epoch - timedelta( days=60 ), epoch - timedelta( days=1 ) ) == []
+    assert agg.periodPathList( epoch - timedelta( days=60 ), epoch ) == [ getPath(0) ]
+    assert agg.periodPathList( epoch - timedelta( days=60 ), epoch + timedelta( days=45 ) ) == linearPathList( agg, epoch - timedelta( days=60 ), epoch + timedelta( days=45 ) ) == [ getPath(0), getPath(1) ]
+    # Periods reaching or starting within the last file
+    assert agg.periodPathList( lastStart - timedelta( days=10 ), lastStart + timedelta( days=100 ) ) == [ getPath( nFiles - 2 ), getPath( nFiles - 1 ) ]
+    assert agg.periodPathList( lastStart + timedelta( days=5 ), lastStart + timedelta( days=100 ) ) == [ getPath( nFiles - 1 ) ]
+    assert agg.periodPathList( epoch - timedelta( days=1 ), lastStart + timedelta( days=1 ) ) == agg.pathList()
+    # Periods inside one file or starting on a file boundary, where the linear scan selected no file or one file too many
+    assert agg.periodPathList( epoch + timedelta( days=32 ), epoch + timedelta( days=40 ) ) == [ getPath(1) ]
+    assert linearPathList( agg, epoch + timedelta( days=60 ), epoch + timedelta( days=70 ) ) == [ getPath(1), getPath(2) ]
+    assert agg.periodPathList( epoch + timedelta( days=60 ), epoch + timedelta( days=70 ) ) == [ getPath(2) ]
+
+def test_index_path_list( aggFile ):
+    agg = Aggregation( "test", aggFile )
+    assert agg.indexPathList( 0, 30 ) == ( [ getPath(0) ], 0 )
+    assert agg.indexPathList( 29, 31 ) == ( [ getPath(0), getPath(1) ], 0 )
+    assert agg.indexPathList( 30, 90 ) == ( [ getPath(1), getPath(2) ], 30 )
+    assert agg.indexPathList( 30 * nFiles - 1, 30 * nFiles ) == ( [ getPath( nFiles - 1 ) ], 30 * ( nFiles - 1 ) )
+
+@pytest.fixture
+def gridAgg( tmpdir, monkeypatch ) -> Aggregation:
+    # 1 degree global grid of float32 tas, 12 files of 30 daily steps
+    monkeypatch.setitem( EdasEnv.parms, "mfdataset.chunk.size", "128M" )
+    path = os.path.join( str( tmpdir ), "grid.ag1" )
+    writeAggFile( path )
+    with open( path, "a" ) as file:
+        file.write( "A;time;time;T;360;days since 1980-01-01;0;359\nA;lat;latitude;Y;181;degrees_north;-90;90\nA;lon;longitude;X;360;degrees_east;0;359\n" )
+        file.write( "V;tas;Air Temperature;tas;Air Temperature;360,181,360;;time lat lon;K\n" )
+    agg = Aggregation( "test", path )
+    agg._itemSizes["tas"] = 4
+    return agg
+
+def getDomain( **bounds ) -> Domain:
+    return Domain.new( dict( name="d0", **{ axis: { "start": start, "end": end, "system": "values" } for axis, ( start, end ) in bounds.items() } ) )
+
+def test_chunk_plan_point( gridAgg ):
+    # A point subset is read in spatial chunks of at least 1/8 of the axis, unless the axis is windowed at open time
+    domain = getDomain( lat=( 10, 10 ), lon=( 20, 20 ) )
+    assert gridAgg.getChunkPlan( [ "tas" ], domain ) == { "lat": 23, "lon": 45, "time": 30 }
+    assert gridAgg.getChunkPlan( [ "tas" ], domain, 4 * 23 * 45 * 3 ) == { "lat": 23, "lon": 45, "time": 3 }
+    assert gridAgg.getChunkPlan( [ "tas" ], domain, 4 * 3, [ DomainAxis.Y, DomainAxis.X ] ) == { "lat": 181, "lon": 360, "time": 3 }
+
+def test_chunk_plan_cropped_axis( gridAgg ):
+    # A cropped axis is left unsplit, only its window counts in the chunk size
+    domain = getDomain( lat=( -30, 30 ) )
+    assert gridAgg.getChunkPlan( [ "tas" ], domain ) == { "lat": 61, "lon": 360, "time": 30 }
+    assert gridAgg.getChunkPlan( [ "tas" ], domain, 4 * 61 * 360 * 5, [ DomainAxis.Y ] ) == { "lat": 181, "lon": 360, "time": 5 }
+    assert gridAgg.getChunkPlan( [ "tas" ], domain, 4 * 61 * 360 * 5 ) == { "lat": 61, "lon": 360, "time": 5 }
+
+def test_chunk_plan_time_budget( gridAgg, monkeypatch ):
+    # The time chunk is capped by the target chunk size, the memory budget and the steps of a file
+    stepBytes = 4 * 181 * 360
+    assert gridAgg.getChunkPlan( [ "tas" ], None ) == { "lat": 181, "lon": 360, "time": 30 }
+    assert gridAgg.getChunkPlan( [ "tas" ], None, 7 * stepBytes + 100 )["time"] == 7
+    assert gridAgg.getChunkPlan( [ "tas" ], None, stepBytes // 2 )["time"] == 1
+    monkeypatch.setitem( EdasEnv.parms, "mfdataset.chunk.size", str( 4 * stepBytes ) )
+    assert gridAgg.getChunkPlan( [ "tas" ], None, 7 * stepBytes )["time"] == 4
+    assert gridAgg.getChunkPlan( [ "pr" ], None ) == {}
+
+@pytest.fixture
+def dataAgg( tmpdir ) -> str:
+    # Aggregation of three small netcdf files, 12, 12 and 6 monthly steps
+    rs = np.random.RandomState( 0 )
+    lat, lon = np.linspace( -45, 45, 4 ), np.arange( 0.0, 50.0, 10.0 )
+    aggFile = os.path.join( str( tmpdir ), "data.ag1" )
+    with open( aggFile, "w" ) as file:
+        file.write( f"P;base.path;{tmpdir}\n" )
+        for iFile, ( start, nsteps ) in enumerate( [ ( "1980-01-01", 12 ), ( "1981-01-01", 12 ), ( "1982-01-01", 6 ) ] ):
+            time = pd.date_range( start, periods=nsteps, freq="MS" )
+            dset = xa.Dataset( { "tas": ( ( "time", "lat", "lon" ), rs.rand( nsteps, len(lat), len(lon) ).astype( np.float32 ), { "units": "K" } ) }, coords={ "time": time, "lat": lat, "lon": lon } )
+            dset.to_netcdf( os.path.join( str( tmpdir ), f"tas_{iFile}.nc" ) )
+            file.write( f"F;{time[0].timestamp()/60.0};{nsteps};tas_{iFile}.nc\n" )
+    return aggFile
+
+def test_agg_metadata( dataAgg ):
+    agg = Aggregation( "test", dataAgg )
+    assert agg.metadata is None and agg.openDataset( agg.pathList(), [ "tas" ] ) is None
+    metadata = agg.buildMetadata()
+    assert metadata.timeDim == "time" and metadata.file_steps.tolist() == [ 12, 12, 6 ]
+    assert metadata.step_offsets.tolist() == [ 0, 12, 24, 30 ]
+    # A new Aggregation loads the saved metadata without building it
+    reloaded = Aggregation( "test", dataAgg ).metadata
+    assert reloaded is not None and reloaded.variables["tas"]["dims"] == [ "time", "lat", "lon" ]
+    np.testing.assert_array_equal( reloaded.coords["time"].values, metadata.coords["time"].values )
+
+@pytest.mark.parametrize( "files", [ slice( 0, 3 ), slice( 1, 3 ), slice( 2, 3 ) ] )
+def test_agg_metadata_open_dataset( dataAgg, files ):
+    agg = Aggregation( "test", dataAgg )
+    agg.buildMetadata()
+    paths = agg.pathList()[files]
+    dset = agg.openDataset( paths, [ "tas" ], { "time": 5, "lat": 2 } )
+    with xa.open_mfdataset( paths, engine="netcdf4", data_vars=[ "tas" ] ) as expected:
+        assert dset["tas"].dims == expected["tas"].dims and dset["tas"].attrs["units"] == "K"
+        assert dset["tas"].chunks[1] == ( 2, 2 )
+        for coord in [ "time", "lat", "lon" ]: np.testing.assert_array_equal( dset[coord].values, expected[coord].values )
+        np.testing.assert_array_equal( dset["tas"].values, expected["tas"].values )
+
+def test_agg_metadata_failure( dataAgg, monkeypatch ):
+    os.remove( os.path.join( os.path.dirname( dataAgg ), "tas_1.nc" ) )
+    agg = Aggregation( "test", dataAgg )
+    builds = []
+    build = AggMetadata.build
+    monkeypatch.setattr( AggMetadata, "build", lambda metadata: builds.append( 1 ) or build( metadata ) )
+    assert agg.buildMetadata() is None and agg.buildMetadata() is None
+    assert len( builds ) == 1
+
+def test_to_zarr( dataAgg, tmpdir, monkeypatch ):
+    # Writes the first two files to a timeseries store, appends the third one, then reads the store back through a zarr: source
+    monkeypatch.setattr( Collection, "baseDir", os.path.dirname( dataAgg ) )
+    monkeypatch.setitem( EdasEnv.parms, "zarr.chunk.size", "800" )
+    monkeypatch.setitem( EdasEnv.parms, "sources.allowed", "collection,file,zarr" )
+    with open( dataAgg, "r" ) as file: lines = file.readlines()
+    with open( dataAgg, "w" ) as file: file.writelines( lines[:-1] )
+    storePath = os.path.join( str( tmpdir ), "data.zarr" )
+    assert AggProcessing.toZarr( "test", "data", "timeseries", storePath ) == storePath
+    with xa.open_zarr( storePath, consolidated=True ) as store:
+        assert AggProcessing.getZarrChunks( store, "time", "timeseries" ) == { "lat": 1, "lon": 1, "time": 24 }
+        assert AggProcessing.getZarrChunks( store, "time", "maps" ) == { "lat": 4, "lon": 5, "time": 10 }
+        assert store.sizes["time"] == 24 and store["tas"].encoding["chunks"] == ( 24, 1, 1 )
+    with open( dataAgg, "w" ) as file: file.writelines( lines )
+    os.utime( dataAgg, ( time.time() + 10, time.time() + 10 ) )
+    agg = Aggregation( "test", dataAgg )
+    assert agg.getIngestedFiles( storePath ) == 2 and agg.getZarrStore( agg.pathList() ) is None
+    AggProcessing.toZarr( "test", "data", "timeseries", storePath )
+    agg = Aggregation( "test", dataAgg )
+    assert agg.zarrStorePath == storePath and agg.getIngestedFiles( storePath ) == 3
+    assert agg.getZarrStore( agg.pathList() ) == storePath and agg.getZarrStore( agg.pathList()[1:] ) == storePath
+    with xa.open_mfdataset( agg.pathList(), engine="netcdf4" ) as expected, xa.open_zarr( storePath, consolidated=True ) as store:
+        assert store["tas"].chunks[0] == ( 24, 6 )
+        np.testing.assert_array_equal( store["time"].values, expected["time"].values )
+        np.testing.assert_array_equal( store["tas"].values, expected["tas"].values )
+        domains = [ { "name":"d0", "time": { "start":'1980-01-01', "end":'1982-12-31', "system":"values" } } ]
+        variables = [ { "uri": "zarr://" + storePath, "name":"tas:v0", "domain":"d0" } ]
+        operations = [ { "name":"edas.max", "input":"v0", "axes":"t" } ]
+        request = TaskRequest.init( "PyTest", "test_agg", "requestId", "jobId", { "domain": domains, "variable": variables, "operation": operations } )
+        results = edasOpManager.buildRequest( request )
+        np.testing.assert_array_equal( results[0].xarrays[0].values, expected["tas"].max( "time" ).values )
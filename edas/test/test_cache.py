@@ -0,0 +1,217 @@
+from edas.process.task import TaskRequest
+from edas.workflow.module import edasOpManager
+from edas.data.cache import EDASResultCache, EDASRegionCache, EDASKCacheMgr, CacheManager, LRUPolicy, LFUPolicy, CostAwarePolicy
+from edas.workflow.data import EDASArray
+from edas.config import EdasEnv
+import numpy as np
+import pandas as pd
+import xarray as xa
+import pytest, os, threading
+
+EdasEnv.update( { "sources.allowed": "collection,https,file" } )
+
+@pytest.fixture( scope="module" )
+def dataFile( tmpdir_factory ) -> str:
+    # Small monthly tas file, read through a file:// source so that the tests don't need a remote server
+    rs = np.random.RandomState( 0 )
+    time = pd.date_range( "1980-01-01", periods=48, freq="MS" )
+    lat, lon = np.linspace( -45, 45, 10 ), np.arange( 0.0, 120.0, 10.0 )
+    data = ( 280.0 + 10 * rs.rand( len(time), len(lat), len(lon) ) ).astype( np.float32 )
+    dset = xa.Dataset( { "tas": ( ( "time", "lat", "lon" ), data ) }, coords={ "time": time, "lat": lat, "lon": lon } )
+    path = os.path.join( str( tmpdir_factory.mktemp( "data" ) ), "tas.nc" )
+    dset.to_netcdf( path )
+    return path
+
+def getDomains( latStart: float = -30 ):
+    return [{ "name":"d0",   "lat":  { "start":latStart, "end":30,  "system":"values" },
+                             "lon":  { "start":0, "end":100, "system":"values" },
+                             "time": { "start":'1980-01-01', "end":'1982-12-31', "system":"values" } } ]
+
+def getVariables( dataFile: str ):
+    return [ { "uri": "file://" + dataFile, "name":"tas:v0", "domain":"d0" } ]
+
+def execute( domains, variables, operations ):
+    request = TaskRequest.init( "PyTest", "test_cache", "requestId", "jobId", { "domain": domains, "variable": variables, "operation": operations } )
+    return edasOpManager.buildRequest( request )
+
+def getStats():
+    stats = EDASResultCache.stats
+    return stats["hits"], stats["misses"]
+
+def test_ave_result_cache( dataFile, monkeypatch ):
+    # Without the region cache, input regions are not persisted
+    monkeypatch.setattr( EDASRegionCache, "enabled", False )
+    operations = [ { "name":"edas.ave", "input":"v0", "axes":"xy" } ]
+    hits, misses = getStats()
+    results = execute( getDomains(), getVariables( dataFile ), operations )
+    assert getStats() == ( hits, misses + 2 )
+    cached_results = execute( getDomains(), getVariables( dataFile ), operations )
+    assert getStats() == ( hits + 1, misses + 2 )
+    np.testing.assert_array_equal( cached_results[0].xarrays[0].values, results[0].xarrays[0].values )
+    execute( getDomains( -20 ), getVariables( dataFile ), operations )
+    assert getStats() == ( hits + 1, misses + 4 )
+    # The lazy source node result isn't cached, only the materialized ave result
+    execute( getDomains(), getVariables( dataFile ), [ { "name":"edas.ave", "input":"v0", "axes":"t" } ] )
+    assert getStats() == ( hits + 1, misses + 6 )
+    for ( results, outputs, timestamp, bsize ) in EDASResultCache.entries.values():
+        assert not any( [ hasattr( array.xr.data, "dask" ) for array in results.arrays ] )
+        assert bsize == sum( [ array.xr.nbytes for array in results.arrays ] )
+
+def test_result_cache_keeps_materialized_results( dataFile ):
+    # The result of ave is materialized for its two consumers and released at the end of the request, but not in the result cache
+    operations = [ { "name":"edas.ave", "input":"v0:v1", "axes":"xy" }, { "name":"edas.max", "input":"v1", "axes":"t" }, { "name":"edas.min", "input":"v1", "axes":"t" } ]
+    request = TaskRequest.init( "PyTest", "test_cache", "requestId", "jobId", { "domain": getDomains( -10 ), "variable": getVariables( dataFile ), "operation": operations } )
+    edasOpManager.buildRequest( request )
+    aveNode = [ op for op in request.getOperations() if op.name == "edas.ave" ][0]
+    cachedResult = EDASResultCache.entries[ request.fingerprints[ aveNode.instanceId ] ][0]
+    for array in cachedResult.arrays:
+        assert not hasattr( array.xr.data, "dask" )
+
+def getArray( name: str, size: int = 10 ) -> EDASArray:
+    return EDASArray( name, "d0", xa.DataArray( np.arange( size, dtype=np.float32 ), dims=("t",), name=name ) )
+
+def test_lru_policy():
+    policy = LRUPolicy()
+    for key in [ "a", "b", "c" ]: policy.add( key, 10, 10.0 )
+    policy.access( "a" )
+    assert policy.victim() == "b"
+    policy.remove( "b" )
+    assert policy.victim() == "c"
+
+def test_lfu_policy():
+    policy = LFUPolicy()
+    for key in [ "a", "b", "c" ]: policy.add( key, 10, 10.0 )
+    for key in [ "a", "a", "c" ]: policy.access( key )
+    assert policy.victim() == "b"
+    policy.remove( "b" )
+    policy.access( "c" )
+    assert policy.victim() == "a"
+
+def test_cost_aware_policy():
+    policy = CostAwarePolicy()
+    policy.add( "cheap", 100, 100.0 )
+    policy.add( "costly", 100, 1000.0 )
+    policy.add( "big", 1000, 100.0 )
+    assert policy.victim() == "big"
+    policy.remove( "big" )
+    for i in range( 20 ): policy.access( "cheap" )
+    assert policy.victim() == "costly"
+    policy.remove( "costly" )
+    policy.add( "new", 100, 100.0 )
+    assert policy.credits["new"] > 10.0
+    assert policy.victim() == "new"
+
+@pytest.fixture
+def localCache( monkeypatch ) -> CacheManager:
+    monkeypatch.setitem( EdasEnv.parms, "cache.spill", "false" )
+    monkeypatch.setitem( EdasEnv.parms, "cache.distributed", "false" )
+    return CacheManager( "lru", "100" )
+
+def test_cache_manager_eviction( localCache ):
+    localCache.cache( "a", getArray( "a" ) )
+    localCache.cache( "b", getArray( "b" ) )
+    assert localCache.get( "a" ) is not None
+    localCache.cache( "c", getArray( "c" ) )
+    assert "b" not in localCache and "a" in localCache and "c" in localCache
+    assert localCache.get( "b" ) is None
+    assert localCache.stats == dict( hits=1, misses=1, evictions=1, entries=2, size=80, maxSize=100 )
+    del localCache["a"]
+    assert localCache.stats["size"] == 40
+    with pytest.raises( AssertionError ): localCache.cache( "big", getArray( "big", 100 ) )
+
+def test_cache_manager_policies( monkeypatch ):
+    monkeypatch.setitem( EdasEnv.parms, "cache.spill", "false" )
+    monkeypatch.setitem( EdasEnv.parms, "cache.distributed", "false" )
+    lfuCache = CacheManager( "lfu", "100" )
+    for key in [ "a", "b" ]: lfuCache.cache( key, getArray( key ) )
+    for key in [ "b", "b", "a" ]: lfuCache.get( key )
+    lfuCache.cache( "c", getArray( "c" ) )
+    assert sorted( lfuCache.arrayCache.keys() ) == [ "b", "c" ]
+    costCache = CacheManager( "cost", "100" )
+    costCache.cache( "a", getArray( "a" ), cost=1000.0 )
+    costCache.cache( "b", getArray( "b" ), cost=10.0 )
+    costCache.cache( "c", getArray( "c" ), cost=100.0 )
+    assert sorted( costCache.arrayCache.keys() ) == [ "a", "c" ]
+    with pytest.raises( AssertionError ): CacheManager( "fifo", "100" )
+
+def isLocked( lock: threading.RLock ) -> bool:
+    acquired = {}
+    def acquire():
+        acquired["value"] = lock.acquire( timeout=5 )
+        if acquired["value"]: lock.release()
+    checker = threading.Thread( target=acquire )
+    checker.start()
+    checker.join()
+    return not acquired["value"]
+
+def test_worker_store( monkeypatch ):
+    from dask.distributed import Client
+    from edas.data.cache import WorkerStore
+    monkeypatch.setitem( EdasEnv.parms, "cache.spill", "false" )
+    monkeypatch.setitem( EdasEnv.parms, "cache.distributed", "true" )
+    with Client( processes=False, n_workers=1, dashboard_address=None ) as client:
+        workerCache, otherEndpoint = CacheManager( "lru", "100" ), CacheManager( "lru", "100" )
+        # Calls to the scheduler are made without holding the cache locks
+        for method in [ "persist", "publish_dataset", "list_datasets", "get_dataset", "unpublish_dataset" ]:
+            def checked( *args, _method=getattr( client, method ), **kwargs ):
+                assert not isLocked( workerCache._lock ) and not isLocked( otherEndpoint._lock )
+                return _method( *args, **kwargs )
+            monkeypatch.setattr( client, method, checked )
+        workerCache.cache( "a", EDASArray( "a", "d0", getArray( "a" ).xr.chunk( 5 ) ) )
+        assert list( client.list_datasets() ) == [ WorkerStore.prefix + "a" ]
+        # Arrays published by another endpoint are found on the scheduler
+        np.testing.assert_array_equal( otherEndpoint.get( "a" ).xr.values, getArray( "a" ).xr.values )
+        assert otherEndpoint.get( "b" ) is None
+        # The endpoint's own arrays are fetched without a dataset listing
+        monkeypatch.setattr( client, "list_datasets", lambda: pytest.fail( "list_datasets called" ) )
+        workerCache.remove( "a" )
+        np.testing.assert_array_equal( workerCache.get( "a" ).xr.values, getArray( "a" ).xr.values )
+        del otherEndpoint["a"]
+        del workerCache["a"]
+        monkeypatch.undo()
+        assert list( client.list_datasets() ) == []
+
+def test_spill_outside_lock( monkeypatch, tmpdir ):
+    monkeypatch.setattr( EdasEnv, "TRANSIENTS_DIR", str( tmpdir ) )
+    monkeypatch.setitem( EdasEnv.parms, "cache.spill", "true" )
+    monkeypatch.setitem( EdasEnv.parms, "cache.distributed", "false" )
+    spillCache = CacheManager( "lru", "100" )
+    flush = spillCache.spill.flush
+    def checkedFlush( id: str, variable: EDASArray ):
+        # Other threads can use the cache while an evicted array is written, and still find the array
+        found = {}
+        reader = threading.Thread( target=lambda: found.update( value=spillCache.get( id ) ) )
+        reader.start()
+        reader.join( 5 )
+        assert found.get( "value" ) is variable
+        flush( id, variable )
+    monkeypatch.setattr( spillCache.spill, "flush", checkedFlush )
+    for key in [ "a", "b", "c" ]: spillCache.cache( key, getArray( key ) )
+    spillCache.cache( "big", getArray( "big", 100 ) )
+    assert spillCache.stats["spillEntries"] == 2 and spillCache.stats["spillHits"] == 2
+    assert os.path.isfile( spillCache.spill.path( "a" ) ) and not spillCache.spill.pending
+    np.testing.assert_array_equal( spillCache.get( "a" ).xr.values, getArray( "a" ).xr.values )
+    np.testing.assert_array_equal( spillCache.get( "big" ).xr.values, getArray( "big", 100 ).xr.values )
+    assert spillCache.stats["spillHits"] == 4
+
+def test_region_cache( dataFile, monkeypatch ):
+    monkeypatch.setattr( EDASResultCache, "enabled", False )
+    operations = [ { "name":"edas.ave", "input":"v0", "axes":"xy" } ]
+    cacheCalls = []
+    cache = EDASKCacheMgr.cache
+    def checkedCache( id: str, variable: EDASArray, cost: float = None ):
+        # The region index stays usable while a region is admitted to the array cache
+        assert not isLocked( EDASRegionCache._lock )
+        cacheCalls.append( variable )
+        return cache( id, variable, cost )
+    monkeypatch.setattr( EDASKCacheMgr, "cache", checkedCache )
+    domains = getDomains( -40 )
+    domains[0]["time"]["end"] = "1983-12-31"
+    execute( domains, getVariables( dataFile ), operations )
+    assert len( cacheCalls ) == 1 and not hasattr( cacheCalls[0].xr.data, "dask" )
+    hits = EDASRegionCache.stats["hits"]
+    results = execute( getDomains(), getVariables( dataFile ), operations )
+    assert EDASRegionCache.stats["hits"] == hits + 1
+    monkeypatch.setattr( EDASRegionCache, "enabled", False )
+    expected = execute( getDomains(), getVariables( dataFile ), operations )
+    np.testing.assert_allclose( results[0].xarrays[0].values, expected[0].xarrays[0].values, rtol=1e-6 )
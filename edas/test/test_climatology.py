@@ -0,0 +1,80 @@
+from edas.data.climatology import Climatology, EDASClimatologies
+from edas.data.cache import EDASResultCache
+from edas.workflow.data import EDASArray, EDASDataset
+from edas.workflow.modules.edas import DecycleKernel, LowpassKernel
+from collections import OrderedDict
+from edas.test.test_cache import dataFile, execute, getDomains, getVariables
+import numpy as np
+import pandas as pd
+import xarray as xa
+import pytest
+
+def getTestArray( chunks = None ) -> xa.DataArray:
+    rs = np.random.RandomState( 0 )
+    time = pd.date_range( "1980-01-01", periods=300, freq="5D" )
+    data = ( 280.0 + 10 * rs.rand( len(time), 4, 5 ) ).astype( np.float32 )
+    data[3,1,2] = np.nan
+    array = xa.DataArray( data, dims=("t","y","x"), coords={ "t": time, "y": np.arange( 4.0 ), "x": np.arange( 5.0 ) }, name="tas" )
+    return array if chunks is None else array.chunk( chunks )
+
+def getAnomalies( array: xa.DataArray, grouping: str, norm: bool, base: xa.DataArray = None ) -> xa.DataArray:
+    # Reference computed in float64: the climatology is accumulated in float64 and only rounded to float32 at the end
+    array = array.astype( np.float64 )
+    base = array if base is None else base.astype( np.float64 )
+    anomalies = array.groupby( grouping ) - base.groupby( grouping ).mean( "t" )
+    if norm: anomalies = anomalies.groupby( grouping ) / base.groupby( grouping ).std( "t" )
+    return anomalies.transpose( *array.dims )
+
+@pytest.mark.parametrize( "chunks", [ None, { "t": 70 }, { "t": -1, "y": 3 } ] )
+@pytest.mark.parametrize( "grouping", [ "t.month", "t.dayofyear", "t.season" ] )
+@pytest.mark.parametrize( "norm", [ False, True ] )
+def test_anomalies( chunks, grouping, norm ):
+    array = getTestArray( chunks )
+    anomalies = Climatology.compute( array, grouping ).anomalies( array, norm )
+    assert anomalies.dims == array.dims and anomalies.dtype == array.dtype
+    np.testing.assert_allclose( anomalies.values, getAnomalies( array, grouping, norm ).values, rtol=1e-3, atol=1e-3, equal_nan=True )
+
+def test_baseline_anomalies():
+    array = getTestArray( { "t": 70 } ).transpose( "y", "t", "x" )
+    climatology = Climatology.compute( array, "t.month", "1981-01-01,1983-12-31" )
+    expected = getAnomalies( array, "t.month", False, array.sel( t=slice( "1981-01-01", "1983-12-31" ) ) )
+    np.testing.assert_allclose( climatology.anomalies( array ).values, expected.values, rtol=1e-4, atol=1e-4, equal_nan=True )
+    with pytest.raises( AssertionError ): Climatology.compute( array, "t.dayofyear", "1981-01-01,1981-02-01" ).anomalies( array )
+
+def test_climatology_cache( dataFile, monkeypatch ):
+    monkeypatch.setattr( EDASResultCache, "enabled", False )
+    operations = [ { "name":"edas.decycle", "input":"v0" } ]
+    stats = lambda: ( EDASClimatologies.stats["hits"], EDASClimatologies.stats["misses"] )
+    hits, misses = stats()
+    results = execute( getDomains(), getVariables( dataFile ), operations )
+    assert stats() == ( hits, misses + 1 )
+    cached_results = execute( getDomains(), getVariables( dataFile ), operations )
+    assert stats() == ( hits + 1, misses + 1 )
+    np.testing.assert_allclose( cached_results[0].xarrays[0].values, results[0].xarrays[0].values )
+    execute( getDomains(), getVariables( dataFile ), [ { "name":"edas.decycle", "input":"v0", "norm":"true" } ] )
+    assert stats() == ( hits + 2, misses + 1 )
+    execute( getDomains( -20 ), getVariables( dataFile ), operations )
+    assert stats() == ( hits + 2, misses + 2 )
+    execute( getDomains(), getVariables( dataFile ), [ { "name":"edas.decycle", "input":"v0", "baseline":"1980-01-01,1981-12-31" } ] )
+    assert stats() == ( hits + 2, misses + 3 )
+
+def test_climatology_cache_op_domains( dataFile, monkeypatch ):
+    # Two op domains with subsets of equal shape over the same input must not share a climatology
+    monkeypatch.setattr( EDASResultCache, "enabled", False )
+    domains = getDomains() + [ { "name":"d1", "lat": { "start":-30, "end":10, "system":"values" } }, { "name":"d2", "lat": { "start":-10, "end":30, "system":"values" } } ]
+    results = {}
+    for domain in [ "d1", "d2" ]:
+        results[domain] = execute( domains, getVariables( dataFile ), [ { "name":"edas.decycle", "input":"v0", "domain":domain } ] )[0].xarrays[0]
+    assert results["d1"].shape == results["d2"].shape
+    assert not np.array_equal( results["d1"].lat.values, results["d2"].lat.values )
+    monkeypatch.setattr( EDASClimatologies, "enabled", False )
+    for domain in [ "d1", "d2" ]:
+        expected = execute( domains, getVariables( dataFile ), [ { "name":"edas.decycle", "input":"v0", "domain":domain } ] )[0].xarrays[0]
+        np.testing.assert_allclose( results[domain].values, expected.values, rtol=1e-5, atol=1e-5 )
+
+def test_decycle_keeps_time_chunks():
+    # Climatologies and anomalies are computed blockwise, so decycle inputs are not rechunked to a contiguous time axis
+    array = getTestArray( { "t": 70 } )
+    inputs = EDASDataset( OrderedDict( [ ( "v0", EDASArray( "tas", "d0", array ) ) ] ), {} )
+    assert DecycleKernel().rechunkInputs( inputs ).arrayMap["v0"].xr.chunks == array.chunks
+    assert LowpassKernel().rechunkInputs( inputs ).arrayMap["v0"].xr.chunks[0] == ( array.sizes["t"], )
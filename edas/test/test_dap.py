@@ -0,0 +1,159 @@
+from edas.data.dap import DapSessionPool, DapBlockCache, EDASDapPool
+from edas.config import EdasEnv
+from pydap.handlers.lib import BaseHandler
+from pydap.model import DatasetType, BaseType, GridType
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+import numpy as np
+import threading, time, os
+import pytest
+
+class ThreadingWSGIServer( ThreadingMixIn, WSGIServer ):
+    daemon_threads = True
+
+class QuietHandler( WSGIRequestHandler ):
+    def log_message( self, *args ): pass
+
+class DapTestServer:
+    # Local stand-in for a DAP server: serves a small in-memory (time,lat,lon) grid, records the requests,
+    # and can delay requests or fail the next data (.dods) requests to exercise the session pool.
+
+    def __init__(self):
+        self.data = np.arange( 24 * 3 * 4, dtype=np.float32 ).reshape( 24, 3, 4 )
+        dataset = DatasetType( "test" )
+        dataset["time"] = BaseType( "time", np.arange( 24.0 ) * 30, dimensions=("time",), attributes={ "units": "days since 1980-01-01" } )
+        dataset["lat"] = BaseType( "lat", np.array( [ 0.0, 1.0, 2.0 ] ), dimensions=("lat",) )
+        dataset["lon"] = BaseType( "lon", np.array( [ 0.0, 1.0, 2.0, 3.0 ] ), dimensions=("lon",) )
+        grid = GridType( "tas" )
+        grid["tas"] = BaseType( "tas", self.data, dimensions=("time","lat","lon") )
+        for name in [ "time", "lat", "lon" ]: grid[name] = dataset[name]
+        dataset["tas"] = grid
+        self.handler = BaseHandler( dataset )
+        self.requests = []
+        self.failures = 0
+        self.delays = {}
+        self.active = 0
+        self.maxActive = 0
+        self._lock = threading.Lock()
+        self.server = make_server( "127.0.0.1", 0, self, server_class=ThreadingWSGIServer, handler_class=QuietHandler )
+        threading.Thread( target=self.server.serve_forever, daemon=True ).start()
+
+    def url( self, host: str = "127.0.0.1", path: str = "tas.nc" ) -> str:
+        return f"http://{host}:{self.server.server_port}/{path}"
+
+    def reset(self):
+        with self._lock:
+            self.requests, self.failures, self.delays, self.maxActive = [], 0, {}, 0
+
+    def count( self, suffix: str ) -> int:
+        return len( [ path for path in self.requests if path.endswith( suffix ) ] )
+
+    def __call__( self, environ, start_response ):
+        path = environ["PATH_INFO"]
+        with self._lock:
+            self.requests.append( path )
+            self.active += 1
+            self.maxActive = max( self.maxActive, self.active )
+            fail = path.endswith( ".dods" ) and ( self.failures > 0 )
+            if fail: self.failures -= 1
+        try:
+            time.sleep( sum( [ delay for key, delay in self.delays.items() if key in path ] ) )
+            if fail:
+                start_response( "429 Too Many Requests", [ ( "Content-Type", "text/plain" ) ] )
+                return [ b"Transient failure" ]
+            return list( self.handler( environ, start_response ) )
+        finally:
+            with self._lock: self.active -= 1
+
+@pytest.fixture( scope="module" )
+def dapServer():
+    server = DapTestServer()
+    yield server
+    server.server.shutdown()
+
+@pytest.fixture
+def pool( dapServer, monkeypatch, tmpdir ):
+    dapServer.reset()
+    monkeypatch.setattr( EdasEnv, "TRANSIENTS_DIR", str( tmpdir ) )
+    monkeypatch.setitem( EdasEnv.parms, "dap.retry.backoff", "0.01" )
+    monkeypatch.setitem( EdasEnv.parms, "dap.cache", "true" )
+    return DapSessionPool()
+
+def read( pool: DapSessionPool, url: str, tslice: slice ) -> np.ndarray:
+    return pool.read( url, None, "tas", ( tslice, slice( None ), slice( None ) ), ( 24, 3, 4 ) )
+
+def test_session_reuse( dapServer, pool ):
+    session = pool.getSession( dapServer.url(), None )
+    assert pool.getSession( dapServer.url( path="other.nc" ), None ) is session
+    assert pool.getSession( dapServer.url( host="localhost" ), None ) is not session
+    with pytest.raises( Exception ): pool.getSession( dapServer.url(), "unknown" )
+    pool.getDataset( dapServer.url(), None )
+    pool.getDataset( dapServer.url(), None )
+    assert dapServer.count( ".dds" ) == 1
+
+def test_slow_server_does_not_block_other_servers( dapServer, pool ):
+    dapServer.delays["slow.nc"] = 1.0
+    slowOpen = threading.Thread( target=pool.getDataset, args=( dapServer.url( path="slow.nc" ), None ) )
+    slowOpen.start()
+    time.sleep( 0.1 )
+    t0 = time.time()
+    pool.getDataset( dapServer.url( host="localhost" ), None )
+    assert time.time() - t0 < 0.5
+    slowOpen.join()
+
+def test_retry( dapServer, pool, monkeypatch ):
+    monkeypatch.setitem( EdasEnv.parms, "dap.retries", "3" )
+    pool.blockCache.enabled = False
+    dapServer.failures = 2
+    np.testing.assert_array_equal( read( pool, dapServer.url(), slice( 0, 4 ) ), dapServer.data[0:4] )
+    assert dapServer.count( ".dods" ) == 3
+    dapServer.failures = 4
+    with pytest.raises( Exception ): read( pool, dapServer.url(), slice( 4, 8 ) )
+
+def test_connection_bound( dapServer, pool, monkeypatch ):
+    monkeypatch.setitem( EdasEnv.parms, "dap.connections.max", "2" )
+    pool.blockCache.enabled = False
+    pool.getDataset( dapServer.url(), None )
+    dapServer.delays[".dods"] = 0.2
+    readers = [ threading.Thread( target=read, args=( pool, dapServer.url(), slice( 4*i, 4*i+4 ) ) ) for i in range( 6 ) ]
+    for reader in readers: reader.start()
+    for reader in readers: reader.join()
+    assert dapServer.count( ".dods" ) == 6
+    assert dapServer.maxActive == 2
+
+def test_block_cache( dapServer, pool ):
+    assert pool.blockCache.enabled
+    data = read( pool, dapServer.url(), slice( 0, 12 ) )
+    np.testing.assert_array_equal( read( pool, dapServer.url(), slice( 0, 12 ) ), data )
+    assert dapServer.count( ".dods" ) == 1
+    np.testing.assert_array_equal( read( DapSessionPool(), dapServer.url(), slice( 0, 12 ) ), dapServer.data[0:12] )
+    assert dapServer.count( ".dods" ) == 1
+    read( pool, dapServer.url(), slice( 12, 24 ) )
+    assert dapServer.count( ".dods" ) == 2
+
+def test_shared_block_cache( monkeypatch, tmpdir ):
+    # Two worker processes sharing the cache directory: blocks are found across processes and the cap applies to the whole directory
+    monkeypatch.setattr( EdasEnv, "TRANSIENTS_DIR", str( tmpdir ) )
+    monkeypatch.setitem( EdasEnv.parms, "dap.cache", "true" )
+    block = np.arange( 100.0 )
+    caches = [ DapBlockCache(), DapBlockCache() ]
+    caches[0].put( "a1", block )
+    fsize = os.path.getsize( caches[0].path( "a1" ) )
+    for cache in caches: cache.maxSize = 2 * fsize
+    caches[0].put( "a2", block )
+    caches[1].put( "b1", block )
+    caches[1].put( "b2", block )
+    np.testing.assert_array_equal( caches[1].get( "a1" ), block )
+    for iBlock, id in enumerate( [ "a2", "b1", "b2", "a1" ] ):
+        os.utime( caches[0].path( id ), ( time.time() - 100 + iBlock, time.time() - 100 + iBlock ) )
+    caches[0].put( "a3", block )
+    assert sorted( os.listdir( caches[0].directory ) ) == [ "a1.npy", "a3.npy" ]
+    assert caches[0].currentSize == 2 * fsize and list( caches[0].files.keys() ) == [ "a1", "a3" ]
+    assert caches[1].get( "b1" ) is None and "b1" not in caches[1].files
+    np.testing.assert_array_equal( caches[1].get( "a3" ), block )
+
+def test_open_dataset( dapServer, monkeypatch ):
+    monkeypatch.setattr( EDASDapPool.blockCache, "enabled", False )
+    dset = EDASDapPool.openDataset( dapServer.url(), None )
+    assert dset["tas"].dims == ( "time", "lat", "lon" )
+    np.testing.assert_array_equal( dset["tas"].values, dapServer.data )
@@ -0,0 +1,100 @@
+from edas.process.task import TaskRequest
+from edas.workflow.module import edasOpManager
+from edas.workflow.planner import MaterializationPlan
+from edas.workflow.data import EDASArray, EDASDataset, EDASDatasetCollection
+from edas.data.cache import EDASResultCache, EDASRegionCache
+from edas.config import EdasEnv
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import xarray as xa
+import pytest, os
+
+EdasEnv.update( { "sources.allowed": "collection,https,file" } )
+
+@pytest.fixture( scope="module" )
+def dataFile( tmpdir_factory ) -> str:
+    rs = np.random.RandomState( 0 )
+    time = pd.date_range( "1980-01-01", periods=24, freq="MS" )
+    lat, lon = np.linspace( -45, 45, 10 ), np.arange( 0.0, 120.0, 10.0 )
+    dset = xa.Dataset( { "tas": ( ( "time", "lat", "lon" ), ( 280.0 + 10 * rs.rand( len(time), len(lat), len(lon) ) ).astype( np.float32 ) ) }, coords={ "time": time, "lat": lat, "lon": lon } )
+    path = os.path.join( str( tmpdir_factory.mktemp( "data" ) ), "tas.nc" )
+    dset.to_netcdf( path )
+    return path
+
+class Node:
+    # Workflow node stand-in exposing the attributes read by the plan
+    def __init__( self, name: str, inputNodes = () ):
+        self.name = self.instanceId = name
+        self.inputNodes = list( inputNodes )
+        self.outputNodes = []
+        for inputNode in inputNodes: inputNode.outputNodes.append( self )
+
+    @property
+    def isBranch(self) -> bool: return len( self.outputNodes ) > 1
+
+    def isResult(self) -> bool: return len( self.outputNodes ) == 0
+
+def getResult( name: str, size: int ) -> EDASDataset:
+    return EDASDataset( OrderedDict( [ ( name, EDASArray( name, "d0", xa.DataArray( np.zeros( size, dtype=np.float32 ), dims=("t",), name=name ).chunk( 10 ) ) ) ] ), {} )
+
+def getCollection( dset: EDASDataset ) -> EDASDatasetCollection:
+    collection = EDASDatasetCollection( "test" )
+    collection["d0"] = dset
+    return collection
+
+def test_get_size_grouped():
+    array = xa.DataArray( np.zeros( 24, dtype=np.float32 ), dims=("t",), coords={ "t": pd.date_range( "1980-01-01", periods=24, freq="MS" ) }, name="tas" )
+    dset = EDASDataset( OrderedDict( [ ( "tas", EDASArray( "tas", "d0", array.groupby( "t.month" ) ) ) ] ), {} )
+    assert MaterializationPlan.getSize( dset ) == 96
+
+def test_plan_peak():
+    # source -> branch -> ( result1, result2 ): the branch is retained until both results are built
+    source = Node( "source" )
+    branch = Node( "branch", [ source ] )
+    results = [ Node( "result1", [ branch ] ), Node( "result2", [ branch ] ) ]
+    plan = MaterializationPlan()
+    sourceResult = getResult( "source", 100 )
+    plan.completed( source, getCollection( sourceResult ) )
+    assert plan.peakSize == 400 and plan.retainedSize == 0
+    assert plan.materialize( source, sourceResult ) is sourceResult and not sourceResult.arrays[0].persisted
+    branchResult = plan.materialize( branch, getResult( "branch", 80 ) )
+    assert branchResult.arrays[0].persisted and plan.retainedSize == 320
+    plan.completed( branch, getCollection( branchResult ) )
+    plan.completed( results[0], getCollection( getResult( "result1", 50 ) ) )
+    assert plan.retainedSize == 320 and branchResult.arrays[0].persisted
+    plan.completed( results[1], getCollection( getResult( "result2", 30 ) ) )
+    assert plan.retainedSize == 0 and not branchResult.arrays[0].persisted
+    assert ( plan.peakSize, plan.peakNode ) == ( 520, "result1" )
+    assert "predicted peak memory = 520 bytes (at node result1)" in plan.report()
+
+def test_plan_release():
+    # A branch whose consumers are not all built is released at the end of the request
+    branch = Node( "branch" )
+    Node( "result1", [ branch ] ), Node( "result2", [ branch ] )
+    plan = MaterializationPlan()
+    branchResult = plan.materialize( branch, getResult( "branch", 80 ) )
+    plan.completed( branch, getCollection( branchResult ) )
+    assert branchResult.arrays[0].persisted and plan.retainedSize == 320
+    plan.release()
+    assert not branchResult.arrays[0].persisted and plan.retainedSize == 0 and plan.pending == {}
+
+def test_workflow_branch( dataFile, monkeypatch ):
+    # The ave result feeds max and min: it is persisted once, and released once the request is built
+    monkeypatch.setattr( EDASResultCache, "enabled", False )
+    monkeypatch.setattr( EDASRegionCache, "enabled", False )
+    persisted = []
+    persist = EDASDataset.persist
+    monkeypatch.setattr( EDASDataset, "persist", lambda dset: persisted.append( dset ) or persist( dset ) )
+    domains = [ { "name":"d0", "lat": { "start":-30, "end":30, "system":"values" }, "time": { "start":'1980-01-01', "end":'1981-12-31', "system":"values" } } ]
+    variables = [ { "uri": "file://" + dataFile, "name":"tas:v0", "domain":"d0" } ]
+    operations = [ { "name":"edas.ave", "input":"v0:v1", "axes":"xy" }, { "name":"edas.max", "input":"v1", "axes":"t" }, { "name":"edas.min", "input":"v1", "axes":"t" } ]
+    request = TaskRequest.init( "PyTest", "test_planner", "requestId", "jobId", { "domain": domains, "variable": variables, "operation": operations } )
+    results = edasOpManager.buildRequest( request )
+    aveNode = [ op for op in request.getOperations() if op.name == "edas.ave" ][0]
+    assert list( request.plan.materialized.keys() ) == [ aveNode.instanceId ]
+    aveResults = request.plan.materialized[ aveNode.instanceId ]
+    assert len( aveResults ) == 1 and persisted.count( aveResults[0] ) == 1
+    assert not any( [ array.persisted for array in aveResults[0].arrays ] ) and request.plan.retainedSize == 0
+    values = sorted( [ float( array.values ) for result in results for array in result.xarrays ] )
+    assert len( values ) == 2 and values[0] < values[1]
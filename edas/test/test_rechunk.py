@@ -0,0 +1,88 @@
+from edas.data.rechunk import Rechunker
+from edas.workflow.data import EDASArray
+from edas.config import EdasEnv
+import numpy as np
+import xarray as xa
+import pytest, os, time, threading
+
+def getArray( chunks ) -> EDASArray:
+    data = np.arange( 40 * 6 * 8, dtype=np.float32 ).reshape( 40, 6, 8 )
+    xarray = xa.DataArray( data, dims=("t","y","x"), coords={ "t": np.arange( 40.0 ), "y": np.arange( 6.0 ), "x": np.arange( 8.0 ) }, name="tas" )
+    return EDASArray( "tas", "d0", xarray.chunk( chunks ) )
+
+@pytest.fixture
+def rechunker( monkeypatch, tmpdir ) -> Rechunker:
+    monkeypatch.setattr( EdasEnv, "TRANSIENTS_DIR", str( tmpdir ) )
+    monkeypatch.setitem( EdasEnv.parms, "rechunk.memory.max", "1G" )
+    return Rechunker()
+
+def getStores( rechunker: Rechunker ):
+    return sorted( os.listdir( rechunker.directory ) ) if os.path.isdir( rechunker.directory ) else []
+
+def test_rechunk_in_memory( rechunker ):
+    variable = getArray( { "t": 5 } )
+    assert rechunker.rechunk( variable, { "t": 5, "y": 6, "x": 8 } ) is variable
+    result = rechunker.rechunk( variable, { "t": -1 } )
+    assert result.xr.chunks == ( ( 40, ), ( 6, ), ( 8, ) )
+    np.testing.assert_array_equal( result.xr.values, variable.xr.values )
+    assert getStores( rechunker ) == []
+
+def test_rechunk_through_store( rechunker ):
+    variable = getArray( { "t": 5 } )
+    result = rechunker.rechunk( variable, { "t": -1 }, memoryBudget=4000, sourceToken="v1" )
+    # Contiguous time series, the other dims split so that a chunk fits in the budget, read back from the store
+    assert result.xr.chunks == ( ( 40, ), ( 6, ), ( 4, 4 ) )
+    assert result.xr.data.name.startswith( "open_dataset" )
+    np.testing.assert_array_equal( result.xr.values, variable.xr.values )
+    stores = getStores( rechunker )
+    assert len( stores ) == 1
+    # The same source version reuses the store, a new version of the source or an unversioned source doesn't
+    rechunker.rechunk( variable, { "t": -1 }, memoryBudget=4000, sourceToken="v1" )
+    assert getStores( rechunker ) == stores
+    rechunker.rechunk( variable, { "t": -1 }, memoryBudget=4000, sourceToken="v2" )
+    assert len( getStores( rechunker ) ) == 2
+    rechunker.rechunk( variable, { "t": -1 }, memoryBudget=4000 )
+    rechunker.rechunk( variable, { "t": -1 }, memoryBudget=4000 )
+    assert len( getStores( rechunker ) ) == 4
+
+def test_concurrent_rechunks( rechunker, monkeypatch ):
+    # A store being written doesn't block the rechunk of another input
+    variables = [ getArray( { "t": 5 } ), getArray( { "t": 4 } ) ]
+    writing = threading.Event()
+    release = threading.Event()
+    to_zarr = xa.Dataset.to_zarr
+    def slowWrite( dset, *args, **kwargs ):
+        if dset["tas"].chunks[0][0] == 5:
+            writing.set()
+            release.wait( 10 )
+        return to_zarr( dset, *args, **kwargs )
+    monkeypatch.setattr( xa.Dataset, "to_zarr", slowWrite )
+    slowRechunk = threading.Thread( target=rechunker.rechunk, args=( variables[0], { "t": -1 }, 4000, "v1" ) )
+    slowRechunk.start()
+    assert writing.wait( 10 )
+    results = []
+    fastRechunk = threading.Thread( target=lambda: results.append( rechunker.rechunk( variables[1], { "t": -1 }, 4000, "v1" ) ) )
+    fastRechunk.start()
+    fastRechunk.join( 5 )
+    blocked = fastRechunk.is_alive()
+    release.set()
+    fastRechunk.join()
+    assert not blocked and results[0].xr.chunks[0] == ( 40, )
+    slowRechunk.join()
+    assert len( getStores( rechunker ) ) == 2
+
+def test_prune( rechunker, monkeypatch ):
+    variable = getArray( { "t": 5 } )
+    rechunker.rechunk( variable, { "t": -1 }, memoryBudget=4000, sourceToken="v1" )
+    rechunker.rechunk( variable, { "t": -1 }, memoryBudget=4000, sourceToken="v2" )
+    stores = getStores( rechunker )
+    old = time.time() - 100
+    os.utime( os.path.join( rechunker.directory, stores[0] ), ( old, old ) )
+    monkeypatch.setitem( EdasEnv.parms, "rechunk.store.ttl", "50" )
+    lockedToken = stores[1].split(".")[0]
+    os.utime( os.path.join( rechunker.directory, stores[1] ), ( old, old ) )
+    with rechunker.storeLocks[ lockedToken ]:
+        rechunker.prune()
+    assert getStores( rechunker ) == [ stores[1] ]
+    rechunker.prune()
+    assert getStores( rechunker ) == []
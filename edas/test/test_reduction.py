@@ -0,0 +1,91 @@
+from edas.data.reduction import GroupReduction, MomentReduction
+from edas.workflow.data import EDASArray
+import numpy as np
+import pandas as pd
+import xarray as xa
+import pytest
+
+def getTestArray( freq: str = "MS", nsteps: int = 61, chunks = None ) -> xa.DataArray:
+    rs = np.random.RandomState( 0 )
+    time = pd.date_range( "1980-01-01", periods=nsteps, freq=freq )
+    data = ( 280.0 + 10 * rs.rand( nsteps, 4, 5 ) ).astype( np.float32 )
+    data[3,1,2] = data[17,0,:] = np.nan
+    data[:,2,3] = np.nan
+    array = xa.DataArray( data, dims=("time","y","x"), coords={ "time": time, "y": np.linspace( -60, 60, 4 ), "x": np.arange( 5.0 ) }, name="tas" )
+    return array if chunks is None else array.chunk( chunks )
+
+def assertEqual( result: xa.DataArray, expected: xa.DataArray ):
+    assert result.dims == expected.dims
+    np.testing.assert_allclose( result.values, expected.values, rtol=1e-5, atol=1e-5, equal_nan=True )
+
+@pytest.mark.parametrize( "chunks", [ None, { "time": 7 }, { "time": 5, "y": 2 } ] )
+@pytest.mark.parametrize( "period", [ "month", "season", "year" ] )
+def test_groupby_reduction( chunks, period ):
+    array = getTestArray( chunks=chunks )
+    statistics = GroupReduction.groupby( array, "time", period ).reduce( [ "mean", "std", "max", "min", "sum" ] )
+    grouped = array.groupby( "time." + period )
+    for op, result in statistics.items():
+        assertEqual( result, getattr( grouped, op )( "time" ) )
+
+@pytest.mark.parametrize( "chunks", [ None, { "time": 7 }, { "time": 40, "x": 2 } ] )
+@pytest.mark.parametrize( "freq", [ "QS-DEC", "YS", "7D" ] )
+def test_resample_reduction( chunks, freq ):
+    array = getTestArray( freq="5D", nsteps=200, chunks=chunks )
+    reduction = GroupReduction.resample( array, "time", freq )
+    assert reduction.isContiguous
+    statistics = reduction.reduce( [ "mean", "std", "max", "min" ] )
+    resampled = array.resample( time=freq )
+    for op, result in statistics.items():
+        assertEqual( result, getattr( resampled, op )( "time" ) )
+
+@pytest.mark.parametrize( "chunks,maxSteps", [ ( { "time": 400 }, 50 ), ( { "time": 90, "y": 2 }, 100 ) ] )
+@pytest.mark.parametrize( "freq", [ "YS", "QS-DEC", "10D" ] )
+def test_resample_reduction_budget( chunks, maxSteps, freq ):
+    # Daily data resampled over long groups, with a 4000 bytes chunk cap: groups are split across chunks and their partials merged
+    array = getTestArray( freq="D", nsteps=800, chunks=chunks )
+    reduction = GroupReduction.resample( array, "time", freq, maxChunkSize=4000 )
+    segments = reduction.getSegments( array.data )
+    assert max( [ end - start for start, end in segments ] ) <= maxSteps and segments[0][0] == 0 and segments[-1][1] == 800
+    assert all( [ segments[i][1] == segments[i+1][0] for i in range( len(segments) - 1 ) ] )
+    statistics = reduction.reduce( [ "mean", "std", "max", "min", "sum" ] )
+    resampled = array.resample( time=freq )
+    for op, result in statistics.items():
+        assertEqual( result, getattr( resampled, op )( "time" ) )
+
+def test_timeAgg():
+    array = getTestArray( chunks={ "time": 7 } ).rename( { "time": "t" } )
+    results = EDASArray( "tas", "d0", array ).timeAgg( "month", "mean,std" )
+    assertEqual( results[0].xr, array.groupby( "t.month" ).mean( "t" ).rename( { "month": "m" } ) )
+    assertEqual( results[1].xr, array.groupby( "t.month" ).std( "t" ).rename( { "month": "m" } ) )
+
+def test_timeResample():
+    array = getTestArray( chunks={ "time": 7 } ).rename( { "time": "t" } )
+    results = EDASArray( "tas", "d0", array ).timeResample( "QS-DEC", "mean,max" )
+    assertEqual( results[0].xr, array.resample( t="QS-DEC" ).mean( "t" ).rename( { "t": "time" } ) )
+    assertEqual( results[1].xr, array.resample( t="QS-DEC" ).max( "t" ).rename( { "t": "time" } ) )
+
+@pytest.mark.parametrize( "chunks", [ None, { "time": 7, "y": 2 } ] )
+def test_grouped_ave( chunks ):
+    array = getTestArray( chunks=chunks ).rename( { "time": "t" } )
+    weights = np.cos( np.deg2rad( array.y ) )
+    assertEqual( EDASArray( "tas", "d0", array ).groupby( "t.season" ).ave( ["t"] ).xr, array.groupby( "t.season" ).mean( "t" ) )
+    assertEqual( EDASArray( "tas", "d0", array ).groupby( "t.season" ).ave( ["t","y"] ).xr, array.groupby( "t.season" ).map( lambda group: group.weighted( weights ).mean( ["t","y"] ) ) )
+    assertEqual( EDASArray( "tas", "d0", array ).groupby( "t.year" ).std( ["t"] ).xr, array.groupby( "t.year" ).std( "t" ) )
+    assertEqual( EDASArray( "tas", "d0", array ).resample( "t.QS-DEC" ).ave( ["t"] ).xr, array.resample( t="QS-DEC" ).mean( "t" ) )
+
+@pytest.mark.parametrize( "chunks", [ None, { "time": 7 }, { "time": 20, "y": 3, "x": 2 } ] )
+@pytest.mark.parametrize( "dims", [ ["time"], ["y","x"], ["time","y","x"] ] )
+def test_moment_reduction( chunks, dims ):
+    array = getTestArray( chunks=chunks )
+    statistics = MomentReduction( array, dims ).reduce( [ "mean", "var", "std" ] )
+    for op, result in statistics.items():
+        assertEqual( result, getattr( array, op )( dims ) )
+
+@pytest.mark.parametrize( "chunks", [ None, { "time": 7, "y": 3 } ] )
+@pytest.mark.parametrize( "dims", [ ["y"], ["y","x"], ["time","y","x"] ] )
+def test_weighted_moment_reduction( chunks, dims ):
+    array = getTestArray( chunks=chunks )
+    weights = np.cos( np.deg2rad( array.y ) )
+    reduction = MomentReduction( array, dims, weights )
+    assert reduction.weights.shape == ( 1, array.sizes["y"], 1 )
+    assertEqual( reduction.reduce( [ "mean" ] )["mean"], array.weighted( weights ).mean( dims ) )
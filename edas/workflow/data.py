@@ -6,12 +6,13 @@ import string, random, os, re, copy
 from edas.collection.agg import Archive
 import abc, math, time, itertools
 import xarray as xa
-from xarray.core.resample import DatasetResample
+from xarray.core.resample import DatasetResample, DataArrayResample
 from edas.data.sources.timeseries import TimeIndexer
 from edas.util.logging import EDASLogger
 from xarray.core.groupby import DataArrayGroupBy
 from edas.process.operation import WorkflowNode, OperationConnector
 from edas.data.processing import Parser
+from edas.data.reduction import GroupReduction, MomentReduction
 from collections import OrderedDict
 import xarray.plot as xrplot
 import numpy as np
@@ -112,7 +113,7 @@ class EDASArray:
     def size(self) -> int: return self.xr.size
 
     @property
-    def bsize(self) -> int: return self.xr.size * 4
+    def bsize(self) -> int: return self.xrArray.nbytes
 
     @property
     def product(self) -> Optional[str]: return self.get("product",None)
@@ -121,20 +122,31 @@ class EDASArray:
     def product(self, value: str ): self["product"] = value
 
     def persist(self) -> Union[xa.DataArray,DataArrayGroupBy]:
+        # Holds the persisted array (futures on the distributed cluster, in-memory data otherwise) until release() is called
         from dask.distributed import Client
         xrd: xa.DataArray = self.xr
-        if isinstance(xrd,DataArrayGroupBy):
+        if isinstance(xrd,(DataArrayGroupBy,DataArrayResample)):
             self.logger.warn( " EDASArray.persist returning DataArrayGroupBy" )
             return xrd
         if self.loaded_data is None:
-            client = Client.current()
-            if client is None:
-                self.loaded_data = xrd.load().persist()
+            try:                client = Client.current()
+            except ValueError:  client = None
+            if ( client is None ) or ( xrd.chunks is None ):
+                self.loaded_data = xrd.compute()
             else:
-                client.persist( xrd )
-                self.loaded_data = xrd
+                self.loaded_data = client.persist( xrd )
         return self.loaded_data
 
+    @property
+    def persisted(self) -> bool: return self.loaded_data is not None
+
+    @property
+    def persistedSize(self) -> int: return self.loaded_data.nbytes if self.loaded_data is not None else 0
+
+    def release(self):
+        # Drops the reference to the persisted data, which is freed once no lazy result derived from it remains
+        self.loaded_data = None
+
     @property
     def xr(self) -> Union[xa.DataArray,DataArrayGroupBy]:
         if self.loaded_data is not None:
@@ -147,7 +159,7 @@ class EDASArray:
         if self.loaded_data is not None:
             return self.loaded_data
         else:
-            return self._data._obj if isinstance(self._data,DataArrayGroupBy) else self._data
+            return self._data._obj if isinstance(self._data,(DataArrayGroupBy,DataArrayResample)) else self._data
 
     @property
     def xrp(self) -> xa.DataArray: return self.persist()
@@ -281,17 +293,17 @@ class EDASArray:
         xrInput = self.xr
         if 't' in xrInput.dims: xrInput = xrInput.rename({'t': 'time'})
         self.logger.info( f" timeResample({xrInput.name}): coords = {list(xrInput.coords.keys())} ")
-        resampled_data: DatasetResample = xrInput.resample( time = freq, keep_attrs=True )
-        results: List["EDASArray"] = []
         ops = operations.split(",")
+        GroupReduction.checkStatistics( ops, "timeResample" )
+        reduction = GroupReduction.resample( xrInput, 'time', freq )
+        if reduction is not None:
+            aggregations = reduction.reduce( ops )
+        else:
+            resampled_data: DatasetResample = xrInput.resample( time = freq, keep_attrs=True )
+            aggregations = { op: getattr( resampled_data, "mean" if op == "ave" else op )('time') for op in ops }
+        results: List["EDASArray"] = []
         for op in ops:
-            if op == "mean":  aggregation = resampled_data.mean('time')
-            elif op == "ave": aggregation = resampled_data.mean('time')
-            elif op == "max": aggregation = resampled_data.max('time')
-            elif op == "min": aggregation = resampled_data.min( 'time')
-            elif op == "sum": aggregation = resampled_data.sum( 'time')
-            elif op == "std": aggregation = resampled_data.std('time')
-            else: raise Exception( "Unrecognised operation in timeResample operation: " + op )
+            aggregation = aggregations[op]
             self.logger.info(f" --> Result[{op}]: coords = {list(aggregation.coords.keys())}, shape = {list(aggregation.shape)} ")
             results.append( self.updateXa(aggregation, "timeResample-" + op ) )
         return results
@@ -300,17 +312,12 @@ class EDASArray:
         xrInput = self.xr
         if 't' in xrInput.dims: xrInput = xrInput.rename( {'t':'time'} )
         self.logger.info( f" TimeAgg({xrInput.name}): input coords = {list(xrInput.coords.keys())}, input shape = {list(xrInput.shape)}  ")
-        grouped_data: DataArrayGroupBy = xrInput.groupby( "time." + period, False )
-        results: List["EDASArray"] = []
         ops = operations.split(",")
+        GroupReduction.checkStatistics( ops, "timeAgg" )
+        aggregations = GroupReduction.groupby( xrInput, 'time', period ).reduce( ops )
+        results: List["EDASArray"] = []
         for op in ops:
-            if op == "mean":  aggregation: xa.DataArray = grouped_data.mean('time')
-            elif op == "ave": aggregation: xa.DataArray = grouped_data.mean('time')
-            elif op == "max": aggregation: xa.DataArray = grouped_data.max('time')
-            elif op == "min": aggregation: xa.DataArray = grouped_data.min('time')
-            elif op == "sum": aggregation: xa.DataArray = grouped_data.sum('time')
-            elif op == "std": aggregation: xa.DataArray = grouped_data.std('time')
-            else: raise Exception( "Unrecognised operation in timeAgg operation: " + op )
+            aggregation: xa.DataArray = aggregations[op]
             self.logger.info(f" --> Result[{op}]: dims = {list(aggregation.dims)}, coords = {list(aggregation.coords.keys())}, shape = {list(aggregation.shape)} ")
             if 'month' in aggregation.coords.keys(): aggregation = aggregation.rename( {'month':'m'} )
             if 'day' in aggregation.coords.keys():   aggregation = aggregation.rename({'day': 'd'})
@@ -350,7 +357,7 @@ class EDASArray:
         return result
 
     def filter( self, axis: Axis, condition: str ) -> "EDASArray":
-        data = self.persist()
+        data = self.xr
         assert axis == Axis.T, "Filter only supported on time axis"
         if "=" in condition:
             period,selector = condition.split("=")
@@ -378,22 +385,23 @@ class EDASArray:
     def min( self, axes: List[str], **kwargs ) -> "EDASArray":
         return self.updateXa(self.xr.min(dim=axes, keep_attrs=True), kwargs.get("name","min") )
 
+    def reduceMoments( self, op: str, axes: List[str], weights: Optional[xa.DataArray] = None ) -> xa.DataArray:
+        xrd = self.xr
+        if isinstance( xrd, xa.DataArray ): return MomentReduction( xrd, axes, weights ).reduce( [op] )[op]
+        # Grouped (groupby or resample) arrays are reduced group by group
+        if weights is None: return getattr( xrd, op )( dim=axes, keep_attrs=True )
+        return xrd.map( lambda group: MomentReduction( group, axes, weights ).reduce( [op] )[op] )
+
     def mean( self, axes: List[str], **kwargs ) -> "EDASArray":                          # Unweighted
-        return self.updateXa( self.xr.mean(dim=axes, keep_attrs=True), kwargs.get("name","mean") )
+        return self.updateXa( self.reduceMoments( "mean", axes ), kwargs.get("name","mean") )
 
     def ave(self, axes: List[str], **kwargs ) -> "EDASArray":                           # Weighted
         weights = self.getWeights( axes )
         if weights is None:
             return self.mean( axes, **kwargs )
         else:
-            data = self.persist()
-            weighted_var: xa.DataArray = data * weights
-            self.logger.info( f"Computing Weighted ave: weighted_var shape = {weighted_var.shape}, axes = {axes}")
-            sum = weighted_var.sum( axes )
-            axes.remove("y")
-            norm = weights * data.count( axes ) if len( axes ) else weights
-            new_data =  sum / norm.sum("y")
-            return self.updateXa(new_data, kwargs.get("name","ave") )
+            self.logger.info( f"Computing Weighted ave: shape = {self.xrArray.shape}, axes = {axes}")
+            return self.updateXa( self.reduceMoments( "mean", axes, weights ), kwargs.get("name","ave") )
 
     def getWeights(self, axes: List[str]  ) -> Optional[xa.Dataset]:
         if 'y' in axes:
@@ -407,10 +415,10 @@ class EDASArray:
         return self.updateXa(self.xr.median(dim=axes, keep_attrs=True), kwargs.get("name","median") )
 
     def var( self, axes: List[str], **kwargs ) -> "EDASArray":
-        return self.updateXa(self.xr.var(dim=axes, keep_attrs=True), kwargs.get("name","var") )
+        return self.updateXa( self.reduceMoments( "var", axes ), kwargs.get("name","var") )
 
     def std( self, axes: List[str], **kwargs ) -> "EDASArray":
-        return self.updateXa(self.xr.std(dim=axes, keep_attrs=True), kwargs.get("name","std") )
+        return self.updateXa( self.reduceMoments( "std", axes ), kwargs.get("name","std") )
 
     def sum( self, axes: List[str], **kwargs ) -> "EDASArray":
         return self.updateXa(self.xr.sum(dim=axes, keep_attrs=True), kwargs.get("name","sum") )
@@ -467,6 +475,12 @@ class EDASDataset:
         for array in self.arrayMap.values(): array.persist()
         return self
 
+    def release(self):
+        for array in self.arrayMap.values(): array.release()
+
+    @property
+    def persistedSize(self) -> int: return sum( [ array.persistedSize for array in self.arrayMap.values() ] )
+
     def addDomains( self, domains: Set[str] ):
         for domain in domains:
             for array in self.arrayMap.values():
@@ -6,15 +6,20 @@ from edas.process.operation import WorkflowNode, SourceNode, OpNode
 from edas.data.sources.timeseries import TimeConversions
 from edas.collection.agg import Archive
 import xarray as xr
+import numpy as np
 from edas.workflow.data import KernelSpec, EDASDataset, EDASArray, EDASDatasetCollection
 from edas.process.source import SourceType, DataSource
 from edas.process.node import Param, Node
 from edas.collection.agg import Collection
 from edas.config import EdasEnv
 from edas.util.logging import EDASLogger
-from edas.data.cache import EDASKCacheMgr
-from edas.process.domain import Domain, Axis
+from edas.data.cache import EDASKCacheMgr, EDASRegionCache
+from edas.data.rechunk import EDASRechunker
+from edas.data.dap import EDASDapPool
+from edas.process.domain import Domain, Axis, AxisBounds
 from collections import OrderedDict
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from requests import Session
 
 class Kernel:
@@ -28,11 +33,15 @@ class Kernel:
         self._minInputs = 1
         self._maxInputs = 100000
         self.requiredOptions = []
+        self._cacheable = True
         self._id: str  = self._spec.name + "-" + ''.join([ random.choice( string.ascii_letters + string.digits ) for n in range(5) ] )
 
     @property
     def name(self): return self._spec.name
 
+    @property
+    def cacheable(self) -> bool: return self._cacheable
+
     def spansInputs(self, op: WorkflowNode) -> bool:
         return (op.ensDim is not None) or ( self._minInputs > 1 )
 
@@ -70,9 +79,16 @@ class Kernel:
         for key,value in kwargs.items(): result[key] = value
         archive = node.getParm("archive")
         if archive: result["archive"] = archive
-        if node.isBranch:
-            result.persist()
-        return result
+        return request.plan.materialize( node, result )
+
+    def getWorkerMemoryBudget(self) -> Optional[int]:
+        # Per-thread share of the smallest worker memory limit, with 2x headroom for intermediate results
+        try:
+            from dask.distributed import default_client
+            workers = default_client().scheduler_info()["workers"].values()
+            return min( [ int( worker["memory_limit"] / ( 2 * max( worker.get("nthreads",1), 1 ) ) ) for worker in workers if worker.get("memory_limit") ] )
+        except Exception:
+            return None
 
     def archivePath(self, id: str, attrs: Dict[str, Any] )-> str:
         return Archive.getFilePath( attrs["proj"], attrs["exp"], id )
@@ -86,6 +102,7 @@ class OpKernel(Kernel):
 
     def __init__(self, spec: KernelSpec):
         self._decomposable = True
+        self._preferredChunks: Dict[str,int] = {}      # Chunk size by dim of the inputs to processVariable, -1 for the full extent
         super(OpKernel, self).__init__(spec)
         self.addRequiredOptions( ["input"] )
 
@@ -171,7 +188,16 @@ class OpKernel(Kernel):
             preprop_result = resultDataset.align( alignmentTarget )
             result: EDASDataset = preprop_result.groupby( op.grouping ).resample( op.resampling )
         print( " $$$$ processInputCrossSection: " + op.name + " -> " + str( result.ids ) )
-        return result.purge()
+        inputFingerprints = [ request.fingerprints.get( inputNode.instanceId ) for inputNode in op.inputNodes ]
+        sourceToken = None if ( None in inputFingerprints ) else "|".join( sorted( inputFingerprints ) )
+        return self.rechunkInputs( result.purge(), sourceToken )
+
+    def rechunkInputs( self, inputDataset: EDASDataset, sourceToken: Optional[str] = None ) -> EDASDataset:
+        # sourceToken: fingerprints (including the source version tokens) of the inputs, None if they can't be fingerprinted
+        if not self._preferredChunks or not EdasEnv.getBool( "rechunk.inputs", True ): return inputDataset
+        budget = self.getWorkerMemoryBudget()
+        resultArrays: OrderedDict[str,EDASArray] = OrderedDict( [ ( aid, EDASRechunker.rechunk( array, self._preferredChunks, budget, sourceToken ) ) for aid, array in inputDataset.arrayMap.items() ] )
+        return EDASDataset( resultArrays, inputDataset.attrs )
 
     def mergeEnsembles(self, op: OpNode, dset: EDASDataset ) -> EDASDataset:
         self.logger.info( " ---> Merge Ensembles: ")
@@ -228,6 +254,42 @@ class CacheStatus:
         assert not parm, "Unrecognized cache status: " + parm
         return cls.Ignore
 
+class DomainCrop:
+    # Picklable open_mfdataset preprocess hook: crops each file to the spatial window of the domain at open time.
+    # The window is padded by one cell so that the later exact subset (including 'nearest' point selection) is unchanged.
+
+    @classmethod
+    def new(cls, domain: Optional[Domain] ) -> Optional["DomainCrop"]:
+        if (domain is None) or not EdasEnv.getBool( "mfdataset.crop", True ): return None
+        bounds: List[Tuple[Axis,float,float]] = []
+        for axis, bound in domain.axisBounds.items():
+            if ( axis not in [ Axis.T, Axis.UNKNOWN ] ) and bound.isValueType:
+                try: bounds.append( ( axis, min( float(bound.start), float(bound.end) ), max( float(bound.start), float(bound.end) ) ) )
+                except ValueError: pass
+        return DomainCrop( bounds ) if len( bounds ) else None
+
+    def __init__(self, bounds: List[Tuple[Axis,float,float]] ):
+        self.bounds = bounds
+
+    @property
+    def axes(self) -> List[Axis]:
+        return [ bound[0] for bound in self.bounds ]
+
+    def __call__(self, dset: xr.Dataset ) -> xr.Dataset:
+        for dim in list( dset.dims ):
+            coord = dset.coords.get( dim )
+            if (coord is None) or (coord.ndim != 1) or not np.issubdtype( coord.dtype, np.number ): continue
+            axis = Axis.parse( coord.attrs.get( "axis", dim ) )
+            for ( baxis, lo, hi ) in self.bounds:
+                if baxis == axis:
+                    values = coord.values
+                    inside = np.nonzero( (values >= lo) & (values <= hi) )[0]
+                    if len( inside ):                                       i0, i1 = inside[0], inside[-1]
+                    elif (lo > values.max()) or (hi < values.min()):        continue
+                    else:                                                   i0 = i1 = int( np.abs( values - (lo+hi)/2 ).argmin() )
+                    dset = dset.isel( { dim: slice( max( i0-1, 0 ), i1+2 ) } )
+        return dset
+
 class InputKernel(Kernel):
     def __init__( self ):
         Kernel.__init__( self, KernelSpec("input", "Data Input","Data input and workflow source node" ) )
@@ -246,18 +308,53 @@ class InputKernel(Kernel):
                 return EDASDataset.init( OrderedDict( [ (cid, variable) ] ), {} )
         return None
 
-    def importToDatasetCollection(self, collection: EDASDatasetCollection, request: TaskRequest, snode: SourceNode, dset: xr.Dataset):
-        pdest = self.processDataset(request, dset, snode)
+    def importToDatasetCollection(self, collection: EDASDatasetCollection, request: TaskRequest, snode: SourceNode, dset: xr.Dataset, timeIndexOffset: int = 0 ):
+        pdest = self.processDataset(request, dset, snode, timeIndexOffset)
+        for vid in snode.varSource.ids: collection[vid] = pdest.subselect(vid)
+
+    def getRegionKey( self, snode: SourceNode ) -> Optional[str]:
+        if not EDASRegionCache.enabled or (snode.domain is None) or (snode.offset is not None) or snode.getParm( "cache" ): return None
+        dataSource: DataSource = snode.varSource.dataSource
+        versionToken = dataSource.versionToken( snode.varSource.names() )
+        return None if versionToken is None else "|".join( [ str(dataSource), ",".join( snode.varSource.names() ), versionToken ] )
+
+    def importCachedRegion(self, collection: EDASDatasetCollection, request: TaskRequest, snode: SourceNode, regionKey: Optional[str] ) -> bool:
+        if regionKey is None: return False
+        domain = request.operationManager.getDomain( snode.domain )
+        region = EDASRegionCache.find( regionKey, domain )
+        if region is None: return False
+        ( cachedDomain, cachedArrays, attrs ) = region
+        arrays: OrderedDict[str,EDASArray] = OrderedDict()
+        for vid in snode.varSource.vids:
+            xarray: xr.DataArray = cachedArrays[vid.name].xr.copy( deep=False )
+            xarray.attrs = { key: value for key, value in xarray.attrs.items() if key != "domain_history" }
+            arrays[vid.id] = EDASArray( vid.id, snode.domain, xarray )
+        residual = cachedDomain.residual( domain )
+        subsetDomain = Domain( residual.name, { axis: request.cropBounds( axis, bounds, arrays.values() ) for axis, bounds in residual.axisBounds.items() } )
+        pdest = self.signResult( EDASDataset( arrays, dict(attrs) ).subset( subsetDomain ), request, snode, sources=snode.varSource.getId() )
         for vid in snode.varSource.ids: collection[vid] = pdest.subselect(vid)
+        return True
+
+    def cacheRegion(self, collection: EDASDatasetCollection, request: TaskRequest, snode: SourceNode, regionKey: Optional[str] ):
+        if regionKey is None: return
+        try:
+            arrays = { vid.name: collection[vid.id].arrayMap[vid.id] for vid in snode.varSource.vids }
+            attrs = collection[ snode.varSource.vids[0].id ].attrs
+            EDASRegionCache.cache( regionKey, request.operationManager.getDomain( snode.domain ), arrays, attrs )
+        except Exception as err:
+            self.logger.error( f"Error caching input region for {snode.varSource.getId()}: {err}" )
 
     def buildWorkflow(self, request: TaskRequest, node: WorkflowNode, inputs: EDASDatasetCollection )  -> EDASDatasetCollection:
         snode: SourceNode = node
         results = EDASDatasetCollection( "InputKernel.build-" + node.name )
         t0 = time.time()
         dset = self.getCachedDataset( snode )
+        regionKey = None if dset is not None else self.getRegionKey( snode )
         if dset is not None:
-            self.importToDatasetCollection(results, request, snode, dset.xr )
+            self.importToDatasetCollection(results, request, snode, dset.xr[0] )
             self.logger.info( "Access input data from cache: " + dset.id )
+        elif self.importCachedRegion( results, request, snode, regionKey ):
+            self.logger.info( f"Access input data from cached region: {snode.varSource.getId()}, time = {time.time() - t0} sec" )
         else:
             dataSource: DataSource = snode.varSource.dataSource
             if dataSource.type == SourceType.collection:
@@ -266,82 +363,110 @@ class InputKernel(Kernel):
                 self.logger.info("Input collection: " + dataSource.address )
                 aggs = collection.sortVarsByAgg( snode.varSource.vids )
                 domain = request.operationManager.domains.getDomain( snode.domain )
-                if domain is not None:
-                    timeBounds = domain.findAxisBounds(Axis.T)
-                    startDate = None if (domain is None or timeBounds is None) else TimeConversions.parseDate(timeBounds.start)
-                    endDate   = None if (domain is None or timeBounds is None) else TimeConversions.parseDate(timeBounds.end)
-                else: startDate = endDate = None
-                for ( aggId, vars ) in aggs.items():
+                timeBounds = domain.findAxisBounds(Axis.T) if domain is not None else None
+                indexBounds = timeBounds if (timeBounds is not None) and not timeBounds.isValueType else None
+                startDate = None if (timeBounds is None or indexBounds is not None) else TimeConversions.parseDate(timeBounds.start)
+                endDate   = None if (timeBounds is None or indexBounds is not None) else TimeConversions.parseDate(timeBounds.end)
+                nThreads = min( len(aggs), int( EdasEnv.get( "collections.open.threads", "8" ) ) )
+                if nThreads > 1:
+                    with ThreadPoolExecutor( max_workers=nThreads ) as executor:
+                        opened = list( executor.map( lambda agg: self.openCollectionAggregation( request, collection, agg[0], agg[1], domain, indexBounds, startDate, endDate ), aggs.items() ) )
+                else:
+                    opened = [ self.openCollectionAggregation( request, collection, aggId, vars, domain, indexBounds, startDate, endDate ) for ( aggId, vars ) in aggs.items() ]
+                opened = [ ( dset[vars], timeIndexOffset ) for ( vars, ( dset, timeIndexOffset ) ) in zip( aggs.values(), opened ) if dset is not None ]
+                if len( opened ) > 0:
                     try:
-                        use_chunks = True
-                        pathList = collection.pathList(aggId) if startDate is None else collection.periodPathList(aggId,startDate,endDate)
-                        assert len(pathList) > 0, f"No files found in aggregation {aggId} for date range {startDate} - {endDate} "
-                        nFiles = len(pathList)
-                        if use_chunks:
-                            nReadPartitions = int( EdasEnv.get( "mfdataset.npartitions", 250 ) )
-                            agg = collection.getAggregation(aggId)
-                            nchunks, fileSize = agg.getChunkSize( nReadPartitions, nFiles )
-                            chunk_kwargs = {} if nchunks is None else dict(chunks={"time": nchunks})
-                            self.logger.info( f"Open mfdataset: vars={vars}, NFILES={nFiles}, FileSize={fileSize}, FILES[0]={pathList[0]}, chunk_kwargs={chunk_kwargs}, startDate={startDate}, endDate={endDate}, domain={domain}" )
-                        else:
-                            chunk_kwargs = {}
-                            self.logger.info( f"Open mfdataset: vars={vars},  NFILES={nFiles}, FILES[0]={pathList[0]}" )
-                        dset = xr.open_mfdataset( pathList, engine='netcdf4', data_vars=vars, parallel=True, **chunk_kwargs )
+                        timeIndexOffsets = { timeIndexOffset for ( dset, timeIndexOffset ) in opened }
+                        assert len( timeIndexOffsets ) == 1, f"Aggregations of collection {dataSource.address} have different file boundaries in the time index domain"
+                        dset = opened[0][0] if len( opened ) == 1 else xr.merge( [ dset for ( dset, timeIndexOffset ) in opened ], combine_attrs="override" )
                         self.logger.info(f"Import to collection")
-                        self.importToDatasetCollection( results, request, snode, dset )
+                        self.importToDatasetCollection( results, request, snode, dset, timeIndexOffsets.pop() )
                         self.logger.info(f"Collection import complete.")
                     except Exception as err:
-                        self.logger.error( f"Error importing aggregation {aggId}: {err}\n:{traceback.format_exc()}")
+                        self.logger.error( f"Error importing aggregations {list(aggs.keys())}: {err}\n:{traceback.format_exc()}")
             elif dataSource.type == SourceType.file:
                 self.logger.info( "Reading data from address: " + dataSource.address )
                 files = glob.glob( dataSource.address )
                 parallel = len(files) > 1
                 assert len(files) > 0, f"No files matching path {dataSource.address}"
-                dset = xr.open_mfdataset(dataSource.address, engine='netcdf4', data_vars=snode.varSource.ids, parallel=parallel )
+                crop = DomainCrop.new( request.operationManager.domains.getDomain( snode.domain ) )
+                dset = xr.open_mfdataset(dataSource.address, engine='netcdf4', data_vars=snode.varSource.ids, parallel=parallel, preprocess=crop )
                 self.importToDatasetCollection(results, request, snode, dset)
+            elif dataSource.type == SourceType.zarr:
+                self.logger.info( "Reading data from zarr store: " + dataSource.address )
+                assert os.path.isdir( dataSource.address ), f"No zarr store at path {dataSource.address}"
+                dset = xr.open_zarr( dataSource.address, consolidated=True, chunks={} )
+                crop = DomainCrop.new( request.operationManager.domains.getDomain( snode.domain ) )
+                self.importToDatasetCollection(results, request, snode, dset if crop is None else crop(dset) )
             elif dataSource.type == SourceType.archive:
                 self.logger.info( "Reading data from archive: " + dataSource.address )
                 dataPath =  request.archivePath( dataSource.address )
                 dset = xr.open_mfdataset( [dataPath] )
                 self.importToDatasetCollection(results, request, snode, dset)
             elif dataSource.type == SourceType.dap:
-                nchunks = request.runargs.get( "ncores", 8 )
                 self.logger.info( f" --------------->>> Reading data from address: {dataSource.address}" )
-                dset = xr.open_dataset( dataSource.address, engine="netcdf4", chunks={"time":nchunks} )
+                dset = EDASDapPool.openDataset( dataSource.address, dataSource.auth )
                 self.logger.info(f" --------------->>> Completed Reading dataset, variables: {dset.variables.keys()}")
-                self.importToDatasetCollection( results, request, snode, dset )
+                crop = DomainCrop.new( request.operationManager.domains.getDomain( snode.domain ) )
+                self.importToDatasetCollection( results, request, snode, dset if crop is None else crop(dset) )
             self.logger.info( f"Access input data source {dataSource.address}, time = {time.time() - t0} sec" )
             self.logger.info( "@L: LOCATION=> host: {}, thread: {}, proc: {}".format( socket.gethostname(), threading.get_ident(), os.getpid() ) )
+            self.cacheRegion( results, request, snode, regionKey )
         return results
 
+    def openCollectionAggregation(self, request: TaskRequest, collection: Collection, aggId: str, vars: List[str], domain: Optional[Domain], indexBounds: Optional[AxisBounds], startDate: Optional[datetime], endDate: Optional[datetime] ) -> Tuple[Optional[xr.Dataset],int]:
+        try:
+            use_chunks = True
+            timeIndexOffset = 0
+            if indexBounds is not None:   pathList, timeIndexOffset = collection.indexPathList( aggId, int(indexBounds.start), int(indexBounds.end) )
+            elif startDate is not None:   pathList = collection.periodPathList(aggId,startDate,endDate)
+            else:                         pathList = collection.pathList(aggId)
+            assert len(pathList) > 0, f"No files found in aggregation {aggId} for date range {startDate} - {endDate} "
+            nFiles = len(pathList)
+            crop = DomainCrop.new( domain )
+            if use_chunks:
+                agg = collection.getAggregation(aggId)
+                chunk_kwargs = dict( chunks=agg.getChunkPlan( vars, domain, self.getWorkerMemoryBudget(), crop.axes if crop else [] ) )
+                self.logger.info( f"Open mfdataset[{request.uid}]: vars={vars}, NFILES={nFiles}, FILES[0]={pathList[0]}, chunk_kwargs={chunk_kwargs}, crop={crop.bounds if crop else None}, startDate={startDate}, endDate={endDate}, domain={domain.signature if domain else None}" )
+            else:
+                chunk_kwargs = {}
+                self.logger.info( f"Open mfdataset: vars={vars},  NFILES={nFiles}, FILES[0]={pathList[0]}" )
+            dset = self.openZarrStore( collection, aggId, pathList, crop )
+            if dset is not None: timeIndexOffset = 0
+            else: dset = self.openAggregation( collection, aggId, pathList, vars, chunk_kwargs.get("chunks"), crop )
+            if dset is None: dset = xr.open_mfdataset( pathList, engine='netcdf4', data_vars=vars, parallel=True, preprocess=crop, **chunk_kwargs )
+            return dset, timeIndexOffset
+        except Exception as err:
+            self.logger.error( f"Error importing aggregation {aggId}: {err}\n:{traceback.format_exc()}")
+            return None, 0
+
+    def openZarrStore(self, collection: Collection, aggId: str, pathList: List[str], crop: Optional[DomainCrop] ) -> Optional[xr.Dataset]:
+        try:
+            storePath = collection.getAggregation(aggId).getZarrStore( pathList )
+            if storePath is None: return None
+            self.logger.info( f"Reading aggregation {aggId} from zarr store {storePath}" )
+            dset = xr.open_zarr( storePath, consolidated=True, chunks={} )
+            return dset if crop is None else crop( dset )
+        except Exception as err:
+            self.logger.warning( f"Can't open zarr store for aggregation {aggId}, reverting to netcdf: {err}" )
+            return None
+
+    def openAggregation(self, collection: Collection, aggId: str, pathList: List[str], vars: List[str], chunks: Optional[Dict[str,int]], crop: Optional[DomainCrop] ) -> Optional[xr.Dataset]:
+        if not EdasEnv.getBool( "mfdataset.metadata.cache", True ): return None
+        try:
+            return collection.getAggregation(aggId).openDataset( pathList, vars, chunks, crop )
+        except Exception as err:
+            self.logger.warning( f"Can't open aggregation {aggId} from cached metadata, reverting to open_mfdataset: {err}" )
+            return None
+
     def getSession( self, dataSource: DataSource ) -> Session:
-        session: Session = None
-        if dataSource.auth == "esgf":
-            from pydap.cas.esgf import setup_session
-            openid = EdasEnv.get("esgf.openid", "")
-            password = EdasEnv.get("esgf.password", "")
-            username = EdasEnv.get("esgf.username", openid.split("/")[-1])
-            session = setup_session( openid, password, username, check_url=dataSource.address )
-        elif dataSource.auth == "urs":
-            from pydap.cas.urs import setup_session
-            username = EdasEnv.get("urs.username", "")
-            password = EdasEnv.get("urs.password", "")
-            session = setup_session( username, password, check_url=dataSource.address )
-        elif dataSource.auth == "cookie":
-            from pydap.cas.get_cookies import setup_session
-            username = EdasEnv.get("auth.username", "")
-            password = EdasEnv.get("auth.password", "")
-            auth_url = EdasEnv.get("auth.url", "")
-            session = setup_session( auth_url, username, password )
-        elif dataSource.auth is not None:
-            raise Exception( "Unknown authentication method: " + dataSource.auth )
-        return session
-
-    def processDataset(self, request: TaskRequest, dset: xr.Dataset, snode: SourceNode) -> EDASDataset:
+        return EDASDapPool.getSession( dataSource.address, dataSource.auth )
+
+    def processDataset(self, request: TaskRequest, dset: xr.Dataset, snode: SourceNode, timeIndexOffset: int = 0 ) -> EDASDataset:
         coordMap = Axis.getDatasetCoordMap( dset )
         filteredCoordMap = snode.varSource.name2id(coordMap)
         edset: EDASDataset = EDASDataset.new( dset, { id:snode.domain for id in snode.varSource.ids}, filteredCoordMap )
-        processed_domain: Domain  = request.cropDomain( snode.domain, edset.inputs, snode.offset )
+        processed_domain: Domain  = request.cropDomain( snode.domain, edset.inputs, snode.offset, timeIndexOffset )
         result = edset.subset( processed_domain ) if snode.domain else edset
         self.logger.info( f"###### ProcessDataset, coordMap = {filteredCoordMap}, dset coords = {list(edset.xr[0].coords.keys())}")
         return self.signResult(result, request, snode, sources=snode.varSource.getId())
@@ -1,14 +1,18 @@
-import sys, inspect, logging, os, traceback
+import sys, inspect, logging, os, traceback, threading
 from abc import ABCMeta, abstractmethod
 from edas.workflow.kernel import Kernel, InputKernel, EDASDataset, EDASDatasetCollection
 from os import listdir
 from os.path import isfile, join, os
-from edas.process.operation import WorkflowNode,  WorkflowConnector, MasterNode, OpNode
+from edas.process.operation import WorkflowNode,  WorkflowConnector, MasterNode, OpNode, SourceNode
+from edas.data.cache import EDASResultCache
 from edas.process.task import TaskRequest, Job
 from edas.util.logging import EDASLogger
+from edas.config import EdasEnv
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Callable, Set, Optional
 import xarray as xa
 from collections import OrderedDict
+import hashlib
 
 class OperationModule:
     __metaclass__ = ABCMeta
@@ -40,6 +44,7 @@ class KernelModule(OperationModule):
         self.logger =  EDASLogger.getLogger()
         self._kernels: Dict[str,Callable[[str],Kernel]] = kernels
         self._instances: Dict[str,Kernel] = {}
+        self._lock = threading.Lock()
         OperationModule.__init__( self, name )
 
     def clear(self, node: WorkflowNode ):
@@ -62,13 +67,14 @@ class KernelModule(OperationModule):
         return self.createKernel( node.op.lower(), node.instanceId )
 
     def createKernel(self, op: str, instanceName: str ) -> Kernel:
-        instance = self._instances.get( instanceName, None )
-        if instance is None:
-            constructor = self._kernels.get( op )
-            assert constructor is not None, f"Unidentified Kernel: {op}, kernels = {list(self._kernels.keys())}"
-            instance = constructor()
-            self._instances[instanceName] = instance
-        return instance
+        with self._lock:
+            instance = self._instances.get( instanceName, None )
+            if instance is None:
+                constructor = self._kernels.get( op )
+                assert constructor is not None, f"Unidentified Kernel: {op}, kernels = {list(self._kernels.keys())}"
+                instance = constructor()
+                self._instances[instanceName] = instance
+            return instance
 
     def getCapabilitiesXml(self): return '<module name="{}"> {} </module>'.format(self.getName(), " ".join([kernel().getCapabilitiesXml() for kernel in self._kernels.values()]))
     def getCapabilitiesJson(self): return dict(name=self.getName(), kernels=[kernel().getCapabilities() for kernel in self._kernels.values()])
@@ -162,17 +168,67 @@ class KernelManager:
     def getInputDatasets(self, request: TaskRequest, op: WorkflowNode ) -> EDASDatasetCollection:
         dsetColl = EDASDatasetCollection("GetInputDatasets")
         print(" %%%% PROCESSING inputs ")
-        for inputNode in op.inputNodes:
+        inputNodes = list( op.inputNodes )
+        nThreads = min( len(inputNodes), int( EdasEnv.get( "workflow.input.threads", "4" ) ) )
+        if nThreads > 1:
+            with ThreadPoolExecutor( max_workers=nThreads ) as executor:
+                inputs = list( executor.map( lambda inputNode: self.buildSubWorkflow( request, inputNode ), inputNodes ) )
+        else:
+            inputs = [ self.buildSubWorkflow( request, inputNode ) for inputNode in inputNodes ]
+        for inputNode, input in zip( inputNodes, inputs ):
             print(" %%%% ADD INPUT : " + inputNode.name )
-            dsetColl += self.buildSubWorkflow(request, inputNode )
+            dsetColl += input
         print( " $$$$ getInputDatasets: " + op.name + " -> " + dsetColl.arrayIds)
         return dsetColl
 
     def buildSubWorkflow(self, request: TaskRequest, op: WorkflowNode ) -> EDASDatasetCollection:
+        with request.nodeLock( op.instanceId ):
+            return self._buildSubWorkflow( request, op )
+
+    def _buildSubWorkflow(self, request: TaskRequest, op: WorkflowNode ) -> EDASDatasetCollection:
         print( " %%%% BuildSubWorkflow: " + op.name )
+        fingerprint = self.getFingerprint( request, op )
+        outputs = [ connector.output for connector in op.connectors ]
+        cachedResult = EDASResultCache.get( fingerprint, outputs )
+        if cachedResult is not None:
+            request.plan.completed( op, cachedResult )
+            return self.signCachedResult( request, cachedResult )
         subWorkflowDatasets: EDASDatasetCollection = self.getInputDatasets( request, op ).filterByOperation( op )
         result: EDASDatasetCollection =  self.getKernel( op ).getResultDataset( request, op, subWorkflowDatasets )
+        request.plan.completed( op, result )
         print( " $$$$ buildSubWorkflow[ " + op.name + "]: " + subWorkflowDatasets.arrayIds + " -> " + result.arrayIds)
+        if fingerprint is not None:
+            if op.isResult():
+                for dsid, dset in result.items(): dset.persist()
+            EDASResultCache.cache( fingerprint, outputs, result )
+        return result
+
+    def getFingerprint(self, request: TaskRequest, op: WorkflowNode ) -> Optional[str]:
+        if op.instanceId not in request.fingerprints:
+            request.fingerprints[op.instanceId] = self.computeFingerprint( request, op )
+        return request.fingerprints[op.instanceId]
+
+    def computeFingerprint(self, request: TaskRequest, op: WorkflowNode ) -> Optional[str]:
+        if not self.getKernel( op ).cacheable: return None
+        elements = [ op.name, ",".join( [ f"{key}={value}" for key, value in sorted( op.metadata.items() ) ] ) ]
+        if op.domain: elements.append( request.operationManager.getDomain( op.domain ).signature )
+        if isinstance( op, SourceNode ):
+            if op.getParm( "cache" ): return None
+            versionToken = op.varSource.dataSource.versionToken( op.varSource.names() )
+            if versionToken is None: return None
+            elements.extend( [ str( op.varSource ), versionToken ] )
+        for connector in op.connectors:
+            elements.append( ",".join( connector.inputs ) )
+            for inputNode in connector.inputNodes:
+                inputFingerprint = self.getFingerprint( request, inputNode )
+                if inputFingerprint is None: return None
+                elements.append( inputFingerprint )
+        return hashlib.sha1( "|".join( elements ).encode() ).hexdigest()
+
+    def signCachedResult(self, request: TaskRequest, result: EDASDatasetCollection ) -> EDASDatasetCollection:
+        for dsid, dset in result.items():
+            for key, value in [ ("proj", request.project), ("exp", request.experiment), ("uid", str(request.uid)) ]:
+                if key in dset.attrs: dset[key] = value
         return result
 
     def buildRequest(self, request: TaskRequest ) -> List[EDASDataset]:
@@ -186,6 +242,7 @@ class KernelManager:
             self.logger.info( "Build Request, resultOps = " + str( [ node.name for node in resultOps ] ))
             result = EDASDatasetCollection("BuildRequest")
             for op in resultOps: result += self.buildSubWorkflow( request, op )
+            self.logger.info( request.plan.report() )
             self.cleanup( request )
             return result.getResultDatasets()
 
@@ -199,6 +256,7 @@ class KernelManager:
             return EDASDataset( OrderedDict(), metrics )
 
     def cleanup(self, request: TaskRequest):
+        request.plan.release()
         ops: List[WorkflowNode] = request.getOperations()
         for op in ops:
             module: KernelModule = self.getModule( op )
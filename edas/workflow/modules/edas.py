@@ -10,6 +10,7 @@ from typing import List, Optional, Dict, Union
 from  scipy import stats, signal
 from edas.process.domain import Axis, DomainManager
 from edas.data.cache import EDASKCacheMgr
+from edas.data.climatology import EDASClimatologies
 from eofs.xarray import Eof
 from collections import OrderedDict
 import numpy as np
@@ -78,7 +79,6 @@ class NormKernel(OpKernel):
         OpKernel.__init__( self, KernelSpec("norm", "Normalization Kernel","Normalizes input arrays by centering (computing anomaly) and then dividing by the standard deviation along the given axes." ) )
 
     def processVariable( self, request: TaskRequest, node: OpNode, variable: EDASArray ) -> EDASArray:
-        variable.persist()
         centered_result =  variable - variable.ave( node.axes )
         return centered_result / centered_result.std( node.axes )
 
@@ -98,14 +98,13 @@ class DecycleKernel(OpKernel):
         OpKernel.__init__( self, KernelSpec("decycle", "Decycle Kernel","Removes the seasonal cycle from the temporal dynamics" ) )
 
     def processVariable( self, request: TaskRequest, node: OpNode, variable: EDASArray ) -> EDASArray:
-        data = variable.persist()
+        data = variable.xr
         norm = bool(node.getParm("norm", False))
         grouping = node.getParm("groupby", 't.month')
-        climatology = data.groupby(grouping).mean('t')
-        anomalies = data.groupby(grouping) - climatology
-        if norm:
-            anomalies = anomalies.groupby(grouping) / data.groupby(grouping).std('t')
-        return variable.updateXa( anomalies, "decycle" )
+        baseline = node.getParm("baseline", None)
+        key = EDASClimatologies.getKey( [ request.fingerprints.get( inputNode.instanceId ) for inputNode in node.inputNodes ], data, grouping, baseline )
+        climatology = EDASClimatologies.getClimatology( key, data, grouping, baseline )
+        return variable.updateXa( climatology.anomalies( data, norm ), "decycle" )
 
 class TimeAggKernel(OpKernel):
     def __init__(self):
@@ -116,7 +115,6 @@ class TimeAggKernel(OpKernel):
         return self.buildProduct( inputs.id, request, node, resultArrays, inputs.attrs )
 
     def processVariables(self, request: TaskRequest, node: OpNode, variable: EDASArray) -> List[EDASArray]:
-        variable.persist()
         period = node.getParm("period", 'month')
         operation = str(node.getParm("op", 'mean')).lower()
         return variable.timeAgg( period, operation)
@@ -130,7 +128,6 @@ class TimeResampleKernel(OpKernel):
         return self.buildProduct( inputs.id, request, node, resultArrays, inputs.attrs )
 
     def processVariables(self, request: TaskRequest, node: OpNode, variable: EDASArray) -> List[EDASArray]:
-        variable.persist()
         freq = node.getParm("freq", 'month')
         operation = str(node.getParm("op", 'mean')).lower()
         return variable.timeResample( freq, operation )
@@ -185,7 +182,6 @@ class WorldClimKernel(OpKernel):
             resultXarray =  target.isel( { taxis:self.stack( selectedMonth) } )
             resultVar = selectionVar
         else:
-            selectedMonth.persist()
             targetVars = []
             selectors = [ ( selectedMonth - 1 ) % 12, selectedMonth, (selectedMonth + 1) % 12 ]
             target: xa.DataArray = self.stack( targetVar.xr)
@@ -199,7 +195,6 @@ class WorldClimKernel(OpKernel):
 
     def setResult( self, key: str, value: EDASArray ):
         self.logger.info( f"Computed value for WorldClim field bio-{key}")
-        value.persist()
         self.results[key] = value
 
     def processInputCrossSection( self, request: TaskRequest, node: OpNode, inputs: EDASDataset  ) -> EDASDataset:
@@ -238,7 +233,6 @@ class WorldClimKernel(OpKernel):
         TKave = Tave + 273.15
         Trange = (Tmax-Tmin)/2.0
         self.start_time = time.time()
-        Tave.persist(); monthlyPrecip.persist()
 
 #         self.logger.info( f"Tmax sample: {Tmax.xr.to_masked_array()[2,10:12,10:12]}")
 #         self.logger.info( f"Tmin sample: {Tmin.xr.to_masked_array()[2,10:12,10:12]}")
@@ -274,9 +268,10 @@ class DetrendKernel(OpKernel):
         OpKernel.__init__( self, KernelSpec("detrend", "Detrend Kernel","Detrends input arrays by "
                             "('method'='highapss'): subtracting the result of applying a 1D convolution (lowpass) filter along the given axes, "
                             "or ('method'='linear'): linear detrend over 'nbreaks' evenly spaced segments." ) )
+        self._preferredChunks = { "t": -1 }
 
     def processVariable( self, request: TaskRequest, node: OpNode, variable: EDASArray ) -> EDASArray:
-        data = variable.persist()
+        data = variable.xr
         axisIndex = variable.getAxisIndex( node.axes, 0, 0 )
         dim = data.dims[axisIndex]
         window_size = node.getParm("wsize", data.shape[axisIndex] // 8)
@@ -307,7 +302,6 @@ class TeleconnectionKernel(OpKernel):
                             "(in roi) with location specified by 'lat' and 'lon' parameters." ) )
 
     def processVariable( self, request: TaskRequest, node: OpNode, variable: EDASArray ) -> EDASArray:
-        variable.persist()
         parms = self.getParameters( node, [ Param("lat"), Param("lon")])
         aIndex = variable.xr.get_axis_num('t')
         center: xa.DataArray = variable.selectPoint( float(parms["lon"]), float(parms["lat"]) ).xr
@@ -320,9 +314,9 @@ class TeleconnectionKernel(OpKernel):
 class LowpassKernel(OpKernel):
     def __init__( self ):
         OpKernel.__init__( self, KernelSpec("lowpass", "Lowpass Kernel","Smooths the input arrays by applying a 1D convolution (lowpass) filter along the given axes." ) )
+        self._preferredChunks = { "t": -1 }
 
     def processVariable( self, request: TaskRequest, node: OpNode, variable: EDASArray ) -> EDASArray:
-        variable.persist()
         axisIndex = variable.getAxisIndex( node.axes, 0, 0 )
         dim = variable.xr.dims[axisIndex]
         window_size = node.getParm("wsize", variable.xr.shape[axisIndex]//8 )
@@ -333,6 +327,7 @@ class LowpassKernel(OpKernel):
 class EofKernel(TimeOpKernel):
     def __init__( self ):
         TimeOpKernel.__init__( self, KernelSpec("eof", "Eof Kernel","Computes PCs and EOFs along the time axis." ) )
+        self._preferredChunks = { "t": -1 }
         self._requiresAlignment = True
 
     def get_cdms_variables( self, inputDset ):
@@ -398,7 +393,6 @@ class AnomalyKernel(OpKernel):
         OpKernel.__init__( self, KernelSpec("anomaly", "Anomaly Kernel", "Centers the input arrays by subtracting off the mean along the given axes." ) )
 
     def processVariable( self, request: TaskRequest, node: OpNode, variable: EDASArray ) -> EDASArray:
-        variable.persist()
         return  variable - variable.ave( node.axes )
 
 class VarKernel(OpKernel):
@@ -442,6 +436,7 @@ class CacheKernel(OpKernel):
     def __init__( self ):
         Kernel.__init__( self, KernelSpec("cache", "Cache Kernel","Cache kernel used to cache input rois for low latency access by subsequest requests ." ) )
         self._maxInputs = 1
+        self._cacheable = False
 
     def processVariable( self, request: TaskRequest, node: OpNode, variable: EDASArray ) -> EDASArray:
         cacheId = node.getParm( "result" )
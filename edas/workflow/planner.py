@@ -0,0 +1,75 @@
+from typing import Dict, List, Optional, Union, Set
+from edas.process.operation import WorkflowNode
+from edas.workflow.data import EDASDataset, EDASDatasetCollection
+from edas.util.logging import EDASLogger
+import threading
+
+class MaterializationPlan:
+    # Decides which node results of a request are materialized (persisted) while its workflow is built.
+    # Kernels keep their results lazy, so a downstream reduction can stream its inputs chunk by chunk; only the result of a
+    # node with more than one consumer (a branch) is persisted, once, so that its consumers don't each recompute it.
+    # Materialized results are retained until all their consumers are built and released at the end of the request at the latest,
+    # which gives the predicted peak memory of the request: the retained results plus the result being built, at the worst point of the build.
+
+    def __init__(self):
+        self.logger = EDASLogger.getLogger()
+        self.materialized: Dict[str,List[EDASDataset]] = {}
+        self.pending: Dict[str,int] = {}
+        self.completedNodes: Set[str] = set()
+        self.releasable: Set[str] = set()
+        self.retainedSize = 0
+        self.peakSize = 0
+        self.peakNode: Optional[str] = None
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def requiresMaterialization( node: WorkflowNode ) -> bool:
+        return node.isBranch
+
+    @staticmethod
+    def getSize( result: Union[EDASDataset,EDASDatasetCollection] ) -> int:
+        datasets = [ dset for dsid, dset in result.items() ] if isinstance( result, EDASDatasetCollection ) else [ result ]
+        return sum( [ array.xrArray.nbytes for dset in datasets for array in dset.arrayMap.values() ] )
+
+    def materialize( self, node: WorkflowNode, result: EDASDataset ) -> EDASDataset:
+        if self.requiresMaterialization( node ):
+            result.persist()
+            self.logger.info( f"Materialized result of node {node.name}, consumers = {len(node.outputNodes)}, size = {result.persistedSize}" )
+            with self._lock:
+                if node.instanceId not in self.materialized: self.pending[node.instanceId] = len( node.outputNodes )
+                self.materialized.setdefault( node.instanceId, [] ).append( result )
+                self.retainedSize += result.persistedSize
+                if not node.isResult(): self.releasable.add( node.instanceId )
+        return result
+
+    def completed( self, node: WorkflowNode, result: EDASDatasetCollection ):
+        # Called once the result of node is built: its inputs have one consumer less to wait for
+        resultSize = 0 if node.instanceId in self.materialized else self.getSize( result )
+        with self._lock:
+            if node.instanceId in self.completedNodes: return
+            self.completedNodes.add( node.instanceId )
+            if self.retainedSize + resultSize > self.peakSize:
+                self.peakSize, self.peakNode = self.retainedSize + resultSize, node.name
+            for inputNode in node.inputNodes:
+                if inputNode.instanceId in self.pending:
+                    self.pending[inputNode.instanceId] -= 1
+                    if self.pending[inputNode.instanceId] <= 0: self.retire( inputNode.instanceId )
+
+    def retire( self, nodeId: str ):
+        # All consumers of the node are built, so the plan no longer needs to hold its materialized result
+        del self.pending[nodeId]
+        for result in self.materialized.get( nodeId, [] ):
+            self.retainedSize -= result.persistedSize
+            if nodeId in self.releasable: result.release()
+
+    def release(self):
+        # End of the request lifecycle: frees every intermediate result still held by the plan
+        with self._lock:
+            releasedSize = 0
+            for nodeId in list( self.pending.keys() ):
+                releasedSize += sum( [ result.persistedSize for result in self.materialized.get( nodeId, [] ) if nodeId in self.releasable ] )
+                self.retire( nodeId )
+            self.logger.info( f"Released materialized results: {releasedSize} bytes" )
+
+    def report(self) -> str:
+        return f"Materialization plan: {len(self.materialized)} node results materialized, predicted peak memory = {self.peakSize} bytes (at node {self.peakNode}), retained = {self.retainedSize} bytes"